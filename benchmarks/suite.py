@@ -0,0 +1,390 @@
+"""
+Benchmarks of the Postmind operations against a throwaway local PostgreSQL.
+
+A cluster is created with initdb in a temporary directory (its binaries are
+found with --pg-bin, pg_config or the PATH) and removed afterwards, unless
+--uri points to an existing database. A synthetic table of --rows rows is
+generated with --width float columns, an integer, a text and a float8[]
+column of --dim elements, plus a csv export of it for the csv and FDW
+operations.
+
+Each operation runs in its own process (peak RSS is per operation): one
+warm up run, then --repeat timed runs (20 by default, so that p90 is not
+just the slowest run). The report gives the p50 / p90 latencies, the
+throughput (rows/s at the median latency) and the peak RSS. An operation
+still running after --timeout seconds is killed and reported as failed.
+Operations needing a missing extension (plpythonu, madlib, file_fdw,
+multicorn) are skipped.
+
+    python benchmarks/suite.py [--rows 100000] [--width 10] [--dim 16] [--repeat 20]
+                               [--timeout 3600] [--only collect,head]
+                               [--save-baseline base.json]
+                               [--baseline base.json] [--threshold 0.2]
+
+With --baseline, the p50 latency and peak RSS of each operation are
+compared to the stored ones; the exit status is 1 when one of them grew by
+more than --threshold.
+"""
+__author__ = 'matthieu'
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import argparse
+import traceback
+from Queue import Empty
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+from postmind.context import PostmindContext
+from postmind.pg.csv import mount_csv
+from postmind.utils import pgapply
+
+TABLE = "bench"
+PERCENTILES = (50, 90)
+
+
+class LocalPostgres(object):
+    """
+    PostgreSQL cluster in a temporary directory, listening on a unix socket
+    of that directory only.
+    """
+    def __init__(self, bin_dir=None):
+        self.bin_dir = bin_dir or find_bin_dir()
+        self.path = None
+        self.port = None
+
+    def _bin(self, name):
+        return os.path.join(self.bin_dir, name) if self.bin_dir else name
+
+    @property
+    def uri(self):
+        return "postgresql://postgres@/postgres?host=%s&port=%d" % (self.path, self.port)
+
+    def start(self):
+        self.path = tempfile.mkdtemp(prefix="postmind_bench_")
+        data = os.path.join(self.path, "data")
+        self.port = free_port()
+        options = "-k %s -p %d -c listen_addresses='' -c fsync=off -c synchronous_commit=off" % (
+            self.path, self.port)
+        try:
+            self._call([self._bin("initdb"), "-D", data, "-U", "postgres", "-A", "trust", "-N"])
+            self._call([self._bin("pg_ctl"), "-D", data, "-o", options, "-w",
+                        "-l", os.path.join(self.path, "server.log"), "start"])
+        except Exception:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+            raise
+        return self
+
+    def _call(self, args):
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode:
+            raise Exception("%s failed:\n%s" % (os.path.basename(args[0]), output.decode("utf-8")))
+
+    def stop(self):
+        if self.path is None:
+            return
+        with open(os.devnull, "w") as devnull:
+            subprocess.call([self._bin("pg_ctl"), "-D", os.path.join(self.path, "data"), "-m", "fast",
+                             "-w", "stop"], stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+
+
+def find_bin_dir():
+    try:
+        return subprocess.check_output(["pg_config", "--bindir"]).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def rss_mb():
+    """
+    Current resident set size of the process, None when /proc is missing.
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / float(1 << 20)
+    except (IOError, OSError):
+        return None
+
+
+def peak_rss_mb():
+    import resource
+
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / float(1 << 20) if sys.platform == "darwin" else peak / 1024.
+
+
+def create_tables(ctx, env):
+    """
+    Synthetic table of env["rows"] rows and its csv export.
+    """
+    floats = ", ".join("random() as f%d" % i for i in range(env["width"]))
+    ctx.execute("DROP TABLE IF EXISTS %s" % TABLE)
+    ctx.execute("""CREATE TABLE {table} AS
+        SELECT g.i as id, {floats}, (random() * 1000)::int as n, md5(g.i::text) as s,
+               (select array_agg(random()) from generate_series(1, {dim}) where g.i > 0) as a
+        FROM generate_series(1, {rows}) as g(i)""".format(table=TABLE, floats=floats, dim=env["dim"],
+                                                          rows=env["rows"]))
+    ctx.execute("ANALYZE %s" % TABLE)
+    columns = ", ".join(["id"] + ["f%d" % i for i in range(env["width"])] + ["n", "s"])
+    ctx.execute("COPY (SELECT %s FROM %s) TO '%s' WITH (format csv, header true)" % (
+        columns, TABLE, env["csv"]))
+
+
+def has_extension(ctx, name):
+    try:
+        ctx.execute("CREATE EXTENSION IF NOT EXISTS %s" % name)
+        return True
+    except Exception:
+        return False
+
+
+def bench_collect(ctx, env):
+    return len(ctx.tables[TABLE].collect())
+
+
+def bench_collect_copy(ctx, env):
+    return len(ctx.tables[TABLE].collect(engine="copy"))
+
+
+def bench_head(ctx, env):
+    return len(ctx.tables[TABLE].head(100))
+
+
+def bench_summary(ctx, env):
+    ctx.tables[TABLE].a.summary()
+    return env["rows"]
+
+
+def bench_to_csv(ctx, env):
+    file_name = os.path.join(env["tmp"], "to_csv.csv")
+    ctx.tables[TABLE].to_csv(file_name, compression=False)
+    os.remove(file_name)
+    return env["rows"]
+
+
+def _apply_rows(n):
+    return range(n)
+
+
+def bench_apply(ctx, env):
+    return len(ctx.apply(_apply_rows, env["rows"]).collect())
+
+
+def bench_mount_csv(ctx, env):
+    # the select creating the foreign table is committed, the read below
+    # runs on another connection of the pool
+    ctx.execute(pgapply(ctx, mount_csv, env["csv"], "bench_mount", sep=",", infer_limit=1000).
+                execution_options(autocommit=True))
+    return len(ctx.read_sql("select * from bench_mount"))
+
+
+def bench_fdw(ctx, env):
+    ctx.execute("DROP FOREIGN TABLE IF EXISTS bench_fdw")
+    ctx.execute("""CREATE FOREIGN TABLE bench_fdw (id bigint, num float8[], txt text[])
+        SERVER bench_pandas OPTIONS (path '%s', args '{"meta": ["id"]}')""" % env["csv"])
+    return len(ctx.read_sql("select * from bench_fdw"))
+
+
+def setup_fdw(ctx, env):
+    ctx.execute("DROP SERVER IF EXISTS bench_pandas CASCADE")
+    ctx.execute("CREATE SERVER bench_pandas FOREIGN DATA WRAPPER multicorn "
+                "OPTIONS (wrapper 'postmind.pg.mount.custom.PandasFDW')")
+
+
+# name -> (function, extensions it needs, setup run once before the timings)
+OPERATIONS = OrderedDict([
+    ("collect", (bench_collect, (), None)),
+    ("collect_copy", (bench_collect_copy, (), None)),
+    ("head", (bench_head, (), None)),
+    ("summary", (bench_summary, ("madlib",), None)),
+    ("to_csv", (bench_to_csv, (), None)),
+    ("apply", (bench_apply, ("plpythonu",), None)),
+    ("mount_csv", (bench_mount_csv, ("plpythonu", "file_fdw"), None)),
+    ("fdw_scan", (bench_fdw, ("multicorn",), setup_fdw)),
+])
+
+
+def run_operation(name, uri, env, repeat, out):
+    """
+    Time an operation in the current (child) process and put its result
+    in the out queue.
+    """
+    try:
+        fun, extensions, setup = OPERATIONS[name]
+        ctx = PostmindContext(uri, schema_cache=False)
+        missing = [ext for ext in extensions if not has_extension(ctx, ext)]
+        if missing:
+            out.put({"skipped": "missing %s" % ", ".join(missing)})
+            return
+        if setup is not None:
+            setup(ctx, env)
+        start_rss = rss_mb()
+        fun(ctx, env)
+        latencies = []
+        rows = 0
+        for _ in range(repeat):
+            start = time.time()
+            rows = fun(ctx, env)
+            latencies.append(time.time() - start)
+        result = OrderedDict(("p%d" % p, float(np.percentile(latencies, p))) for p in PERCENTILES)
+        result["rows"] = rows
+        result["rows_per_s"] = rows / max(result["p50"], 1e-9)
+        result["peak_rss_mb"] = peak_rss_mb()
+        result["rss_growth_mb"] = result["peak_rss_mb"] - start_rss if start_rss is not None else None
+        out.put(result)
+    except Exception:
+        out.put({"error": traceback.format_exc()})
+
+
+def wait_result(proc, out, timeout):
+    """
+    Result the child process proc put in out, or an error when it exited
+    without one or is still running after timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return out.get(timeout=1)
+        except Empty:
+            if proc.exitcode is not None:
+                # the result may have been put just before the exit
+                try:
+                    return out.get(timeout=1)
+                except Empty:
+                    return {"error": "process exited with code %d" % proc.exitcode}
+            if time.time() > deadline:
+                proc.terminate()
+                return {"error": "timed out after %ds" % timeout}
+
+
+def run(uri, env, repeat, names, timeout=3600):
+    results = OrderedDict()
+    for name in names:
+        out = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_operation, args=(name, uri, env, repeat, out))
+        proc.start()
+        result = wait_result(proc, out, timeout)
+        proc.join()
+        results[name] = result
+        report_line(name, result)
+    return results
+
+
+def report_header():
+    print "%-13s %10s %10s %12s %10s %10s" % ("operation", "p50 ms", "p90 ms", "rows/s", "peak MB",
+                                               "growth MB")
+
+
+def report_line(name, result):
+    if "skipped" in result:
+        print "%-13s skipped (%s)" % (name, result["skipped"])
+    elif "error" in result:
+        print "%-13s failed\n%s" % (name, result["error"])
+    else:
+        print "%-13s %10.1f %10.1f %12.0f %10.1f %10s" % (
+            name, 1000 * result["p50"], 1000 * result["p90"], result["rows_per_s"],
+            result["peak_rss_mb"], "%.1f" % result["rss_growth_mb"] if result["rss_growth_mb"] is not None
+            else "-")
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of each operation against the baseline and return the
+    names of the operations that regressed.
+    """
+    regressions = []
+    print "\n%-13s %10s %10s" % ("operation", "p50", "peak RSS")
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None or "p50" not in base or "p50" not in result:
+            continue
+        time_ratio = result["p50"] / max(base["p50"], 1e-9)
+        rss_ratio = result["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9)
+        flag = ""
+        if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print "%-13s %+9.1f%% %+9.1f%%%s" % (name, 100 * (time_ratio - 1), 100 * (rss_ratio - 1), flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the Postmind operations")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--width", type=int, default=10, help="number of float columns")
+    parser.add_argument("--dim", type=int, default=16, help="length of the array column")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--timeout", type=int, default=3600, help="seconds allowed per operation")
+    parser.add_argument("--only", help="comma separated operations, among %s" % ", ".join(OPERATIONS))
+    parser.add_argument("--pg-bin", help="directory of initdb and pg_ctl")
+    parser.add_argument("--uri", help="existing database to use instead of a throwaway cluster")
+    parser.add_argument("--save-baseline", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file of results to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative p50 / peak RSS growth reported as a regression")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(OPERATIONS)
+    unknown = [name for name in names if name not in OPERATIONS]
+    if unknown:
+        parser.error("unknown operations %s" % ", ".join(unknown))
+    server = None if args.uri else LocalPostgres(args.pg_bin).start()
+    tmp = tempfile.mkdtemp(prefix="postmind_bench_data_")
+    if args.uri:
+        # the csv files are written by the server, which may run as another
+        # user of this machine
+        os.chmod(tmp, 0o777)
+    try:
+        uri = args.uri or server.uri
+        env = {"rows": args.rows, "width": args.width, "dim": args.dim, "tmp": tmp,
+               "csv": os.path.join(tmp, "bench.csv")}
+        ctx = PostmindContext(uri, schema_cache=False)
+        start = time.time()
+        create_tables(ctx, env)
+        ctx.con.dispose()
+        print "%d rows x %d floats + array[%d] generated in %.1fs\n" % (args.rows, args.width, args.dim,
+                                                                       time.time() - start)
+        report_header()
+        results = run(uri, env, args.repeat, names, args.timeout)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if server is not None:
+            server.stop()
+
+    params = {"rows": args.rows, "width": args.width, "dim": args.dim, "repeat": args.repeat}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fp:
+            json.dump({"params": params, "results": results}, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline.get("params") != params:
+            print "\nwarning: baseline parameters %s differ from %s" % (baseline.get("params"), params)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
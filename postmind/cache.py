@@ -0,0 +1,257 @@
+__author__ = 'matthieu'
+
+import os
+import re
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+logger = logging.getLogger('pom')
+
+# relations named in the query and, through their rewrite rules, the
+# relations read by the views among them
+VERSIONS_QUERY = """
+    with recursive rels(oid) as (
+        select c.oid from pg_class c where c.relname = any(:names)
+        union
+        select d.refobjid
+        from rels join pg_class v on v.oid = rels.oid and v.relkind = 'v'
+        join pg_rewrite r on r.ev_class = v.oid
+        join pg_depend d on d.classid = 'pg_rewrite'::regclass and d.objid = r.oid
+                        and d.refclassid = 'pg_class'::regclass and d.refobjid <> v.oid
+    )
+    select c.relname, c.relkind, c.relfilenode,
+           coalesce(s.n_tup_ins, 0), coalesce(s.n_tup_upd, 0), coalesce(s.n_tup_del, 0),
+           case when c.relkind = 'v' then pg_get_viewdef(c.oid) end
+    from rels join pg_class c on c.oid = rels.oid
+    left join pg_stat_all_tables s on s.relid = c.oid
+    where c.relkind in ('r', 'm', 'f', 'p', 'v')
+    order by c.oid
+"""
+
+VOLATILE_QUERY = """
+    select exists (select 1 from pg_proc where proname = any(:names) and provolatile = 'v')
+"""
+
+# quoted identifiers keep their case, the others are folded to lower case
+IDENTIFIER = re.compile(r'"((?:[^"]|"")+)"|([A-Za-z_][A-Za-z0-9_$]*)')
+FUNCTION = re.compile(r'(?:"((?:[^"]|"")+)"|([A-Za-z_][A-Za-z0-9_$]*))\s*\(')
+SAMPLE_METHOD = re.compile(r'\btablesample\s+[A-Za-z_][A-Za-z0-9_$]*\s*\(', re.I)
+UNSEEDED_SAMPLE = re.compile(r'\btablesample\b(?![^()]*\([^()]*\)\s*repeatable\b)', re.I)
+
+
+def _names(matches):
+    return set(quoted.replace('""', '"') if quoted else name.lower() for quoted, name in matches)
+
+
+def relations(sql):
+    """
+    Candidate relation names of sql: every identifier of the query text
+    (folded to lower case unless quoted), the catalog lookup keeping only
+    the existing relations.
+    """
+    return sorted(_names(IDENTIFIER.findall(sql)))
+
+
+def relation_versions(con, sql):
+    """
+    Version of each relation read by sql, directly or through views: name,
+    relfilenode and insert / update / delete counters.
+
+    None when the result of sql cannot be versioned: it reads a foreign
+    table (whose data may change outside of the database), calls a volatile
+    function (random(), UDFs...) or samples a table without REPEATABLE.
+    """
+    names = relations(sql)
+    versions = []
+    texts = [sql]
+    rows = con.execute(sa.text(VERSIONS_QUERY), names=names) if names else []
+    for name, kind, filenode, inserts, updates, deletes, definition in rows:
+        if kind == "f":
+            return None
+        if kind == "v":
+            texts.append(definition)
+        else:
+            versions.append((name, filenode, inserts, updates, deletes))
+    if any(UNSEEDED_SAMPLE.search(text) for text in texts):
+        return None
+    names = sorted(set().union(*[functions(text) for text in texts]))
+    if names and con.execute(sa.text(VOLATILE_QUERY), names=names).scalar():
+        return None
+    return tuple(versions)
+
+
+def functions(sql):
+    """
+    Names of the functions called by sql (sampling methods excluded).
+    """
+    sql = SAMPLE_METHOD.sub("tablesample (", sql)
+    return _names(FUNCTION.findall(sql))
+
+
+def is_query(statement):
+    """
+    True when statement only reads (select, show or explain).
+    """
+    if isinstance(statement, sa.sql.Select):
+        return True
+    if isinstance(statement, sa.sql.elements.TextClause):
+        statement = statement.text
+    return isinstance(statement, basestring) and \
+        statement.lstrip().lower().startswith(("select", "show", "explain"))
+
+
+class QueryCache(object):
+    """
+    Cache of query results keyed on the SQL text and on the version of the
+    relations the query reads.
+
+    Results are kept in a LRU bounded by max_entries and max_bytes, and
+    optionally written to path as .npz files (bounded by max_disk_bytes).
+    The version of a relation is its relfilenode and its insert / update /
+    delete counters from pg_stat_all_tables. Those counters are only updated
+    once a transaction commits and the statistics are flushed, so writers
+    can also pass a watermark (value or callable) that is part of the key;
+    statements other than queries run through PostmindContext.execute
+    invalidate the cache right away. Versions are looked up again after
+    check_interval seconds at most: within that interval a hit runs no
+    catalog query, but writes made outside of the context are not seen;
+    with check_interval=0 every lookup runs the catalog queries. The
+    versions of the last max_entries statements are remembered.
+
+    Queries that cannot be versioned (see relation_versions: foreign
+    tables, volatile functions, unseeded samples) are never cached.
+    """
+    def __init__(self, ctx, max_entries=128, max_bytes=1 << 28, path=None, max_disk_bytes=1 << 32,
+                 watermark=None, check_interval=1.):
+        self.ctx = ctx
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.watermark = watermark
+        self.check_interval = check_interval
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+    def relations(self, sql):
+        return relations(sql)
+
+    def versions(self, sql):
+        now = time.time()
+        checked = self._versions.pop(sql, None)
+        if checked is None or now - checked[0] >= self.check_interval:
+            checked = (now, relation_versions(self.ctx.con, sql))
+        self._versions[sql] = checked
+        while len(self._versions) > self.max_entries:
+            self._versions.popitem(last=False)
+        return checked[1]
+
+    def key(self, sql):
+        """
+        Cache key of sql, None when its result cannot be cached.
+        """
+        versions = self.versions(sql)
+        if versions is None:
+            return None
+        watermark = self.watermark() if callable(self.watermark) else self.watermark
+        content = repr((sql, versions, watermark, self.generation))
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def get(self, sql, run):
+        """
+        Return the cached result of sql, or run() and cache its result.
+        """
+        key = self.key(sql)
+        if key is None:
+            self.uncached += 1
+            return run()
+        df = self._entries.pop(key, None)
+        if df is not None:
+            self._entries[key] = df
+        elif self.path is not None:
+            df = self._load(key)
+            if df is not None:
+                self._put(key, df)
+        if df is not None:
+            self.hits += 1
+            return df.copy()
+        self.misses += 1
+        df = run()
+        self._put(key, df)
+        if self.path is not None:
+            self._save(key, df)
+        return df.copy()
+
+    def on_execute(self, statement):
+        """
+        Invalidate the cached results when statement may write.
+        """
+        if is_query(statement):
+            return
+        self.generation += 1
+        self._versions.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._versions.clear()
+        self.nbytes = 0
+
+    def _put(self, key, df):
+        self._entries[key] = df
+        self.nbytes += _nbytes(df)
+        while self._entries and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            _, old = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(old)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def _load(self, key):
+        file_name = self._file(key)
+        if not os.path.exists(file_name):
+            return None
+        try:
+            with np.load(file_name, allow_pickle=True) as npz:
+                names = list(npz["__columns__"])
+                df = pd.DataFrame(OrderedDict((name, npz["c%d" % i]) for i, name in enumerate(names)),
+                                  columns=names)
+            os.utime(file_name, None)
+            return df
+        except Exception as ex:
+            logger.warning("Cannot read cached result %s: %s" % (file_name, ex))
+            return None
+
+    def _save(self, key, df):
+        arrays = dict(("c%d" % i, df.iloc[:, i].values) for i in range(df.shape[1]))
+        arrays["__columns__"] = np.array(list(df.columns), dtype=object)
+        tmp = self._file(key) + ".%d.npz" % os.getpid()
+        np.savez(tmp, **arrays)
+        os.rename(tmp, self._file(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".npz")]
+        files = sorted((os.stat(f).st_atime, os.stat(f).st_size, f) for f in files)
+        total = sum(size for _, size, _ in files)
+        for _, size, file_name in files:
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(file_name)
+            total -= size
+
+
+def _nbytes(df):
+    return int(df.memory_usage(index=True).sum())
@@ -7,8 +7,11 @@ from sqlalchemy.sql.expression import func
 import logging
 import numpy as np
 from joblib import Parallel, delayed
-from .utils import pgapply, gen_table_name, cached_property, process_query
+from .utils import pgapply, gen_table_name, cached_property, process_query, parallel_map
 from pobject import PObject
+from .export import to_csv_parallel
+from .sample import sample_query
+from .sketch import HyperLogLog, CountMinSketch, KLLSketch, element_matrix
 
 class Column(PObject):
     def __init__(self, ctx, data, table, name=gen_table_name()):
@@ -69,20 +72,64 @@ class Column(PObject):
         except:
             raise Exception("Not an array type")
 
-    def distinct_count(self, approx=True):
-        query = self.data.alias(name="col")
+    def _values_sql(self):
+        """
+        SQL returning the column values as the single column v.
+        """
+        data = self.data
+        if not isinstance(data, sa.sql.Select):
+            data = sa.select([data])
+        return "select * from (%s) as q(v)" % self.ctx.to_sql(data)
+
+    def _sketch(self, sketch, batch_size=100000, engine=None):
+        for df in self.ctx.iter_sql(self._values_sql(), batch_size=batch_size, engine=engine):
+            sketch.update(df["v"].values)
+        return sketch
+
+    def hll(self, p=14, method="sql", batch_size=100000, engine=None):
+        """
+        HyperLogLog sketch of the column values (see sketch.HyperLogLog).
+
+        method "sql" builds the registers in the database with one
+        aggregate query, method "client" hashes batches of batch_size values
+        fetched with iter_sql.
+        """
+        if method == "sql":
+            return HyperLogLog.from_sql(self.ctx, self._values_sql(), p=p)
+        if method == "client":
+            return self._sketch(HyperLogLog(p), batch_size, engine)
+        raise Exception("Unknown sketch method '%s'" % method)
+
+    def count_min(self, k=32, width=1 << 14, depth=4, batch_size=100000, engine=None):
+        """
+        Count-Min sketch of the column values with its k heavy hitters,
+        computed over batches fetched with iter_sql (see
+        sketch.CountMinSketch).
+        """
+        return self._sketch(CountMinSketch(width, depth, k), batch_size, engine)
+
+    def distinct_count(self, approx=True, **kwargs):
         if approx:
-            return self.ctx.read_sql(sa.select([sa.text("madlib.fmsketch_dcount(col)")]).
-                                      select_from(query)).values[0][0]
-        else:
-            return self.ctx.read_sql(sa.select([sa.text("count(distinct col)")]).
-                                      select_from(query)).values[0][0]
+            return self.hll(**kwargs).count()
+        return self.ctx.read_sql("select count(distinct v) from (%s) s" % self._values_sql()).values[0][0]
 
-    def values_count(self, count=10):
-        query = self.data.alias(name="col")
-        vcount = sa.select([sa.text("madlib.mfvsketch_top_histogram(col, %s)::text"
-                                                     %count)]).select_from(query)
-        return self.ctx.read_sql(vcount).values[0][0]
+    def values_count(self, count=10, approx=False, **kwargs):
+        """
+        Most frequent values as a list of (value, count) pairs, most
+        frequent first (the MADlib version returned the text of
+        mfvsketch_top_histogram).
+
+        The exact counts come from one aggregate query (cached with
+        read_sql). With approx=True the values are streamed with iter_sql
+        into a Count-Min sketch whose top values and counts are estimates,
+        in bounded memory whatever the number of distinct values (see
+        count_min for the keyword arguments).
+        """
+        if approx:
+            return self.count_min(k=max(count, 32), **kwargs).top(count)
+        df = self.ctx.read_sql("select v, count(*) as n from (%s) s where v is not null group by v "
+                               "order by n desc limit %d" % (self._values_sql(), count))
+        return [(v, int(n)) for v, n in zip(df["v"], df["n"])]
 
     @cached_property
     def shape(self):
@@ -106,29 +153,103 @@ class Column(PObject):
             print ex
             return 0
 
-    def summary(self, count=32, out_table=None, prange=None, pjob=4):
+    def summary(self, count=32, out_table=None, prange=None, pjob=4, backend="processes", method="scan"):
+        """
+        Distinct count and top values histogram of each position of an array
+        column.
+
+        method "scan" computes every position in a single pass over the table
+        (unnest with ordinality grouped by position); method "element" runs
+        one query per position in parallel (pjob workers on backend).
+        """
         if self.ndims > 0:
             if_exists = "replace"
             if out_table == None:
                 out_table = "%s_%s_summary" %(self.table, self.name)
                 out_table = out_table.replace("[", "_").replace("]", "_")
-            def query(i):
-                self.logger.info("Processing column %d (of %d)" %(i, self.shape[0]))
-                query = self[i].data.alias(name="col")
-                q1 = sa.select([sa.text("madlib.fmsketch_dcount(col) as count"),
-                                sa.text("madlib.mfvsketch_top_histogram(col, %s) as top" %count)]).select_from(query)
-                return [q1, i]
-            if prange == None:
-                prange = range(1, self.shape[0] + 1)
-            queries = [query(i) for i in prange]
-            dfs = Parallel(n_jobs=pjob)(delayed(process_query)(q) for q in queries)
-            dfs = pd.concat(dfs)
-            dfs.index = prange
+            if method == "scan":
+                dfs = self._summary_scan(count, prange)
+            elif method == "element":
+                dfs = self._summary_elements(count, prange, pjob, backend)
+            else:
+                raise Exception("Unknown summary method '%s'" % method)
             dfs["table"] = self.table
             dfs["column"] = self.name
             return dfs
 
-    def percentiles(self, n=10):
+    def _summary_elements(self, count, prange, pjob, backend):
+        def query(i):
+            self.logger.info("Processing column %d (of %d)" %(i, self.shape[0]))
+            query = self[i].data.alias(name="col")
+            q1 = sa.select([sa.text("madlib.fmsketch_dcount(col) as count"),
+                            sa.text("madlib.mfvsketch_top_histogram(col, %s) as top" %count)]).select_from(query)
+            return [q1, i]
+        if prange == None:
+            prange = range(1, self.shape[0] + 1)
+        queries = [query(i) for i in prange]
+        dfs = parallel_map(self.ctx, process_query, queries, n_jobs=pjob, backend=backend)
+        dfs = pd.concat(dfs)
+        dfs.index = prange
+        return dfs
+
+    def _summary_scan(self, count, prange):
+        self.logger.info("Processing all positions of %s.%s in one scan" %(self.table, self.name))
+        where = ""
+        if prange != None:
+            where = "where u.pos in (%s)" % ",".join(str(int(i)) for i in prange)
+        q = """select u.pos, madlib.fmsketch_dcount(u.val) as count,
+                      madlib.mfvsketch_top_histogram(u.val, {count}) as top
+               from (select e.val, e.pos
+                     from {table}, unnest({table}.{col}) with ordinality as e(val, pos)) u
+               {where}
+               group by u.pos order by u.pos""".format(count=int(count), table=self.table,
+                                                       col=self.name, where=where)
+        dfs = self.ctx.read_sql(q)
+        dfs.index = list(dfs.pop("pos"))
+        return dfs
+
+    def quantile_sketch(self, eps=0.01, batch_size=100000, engine="copy"):
+        """
+        KLL quantile sketch of the column values with a rank error of about
+        eps, computed in one scan without sorting. Array columns get one
+        sketch per (flattened) position, all updated in the same scan.
+        Sketches of disjoint parts of the data (partitions, new rows...)
+        are combined with merge().
+        """
+        k = int(np.ceil(1.65 / eps))
+        # ndims is None for an array column holding only NULLs
+        array = self.ndims != 0
+        sketch = [] if array else KLLSketch(k)
+        for df in self.ctx.iter_sql(self._values_sql(), batch_size=batch_size, engine=engine):
+            values = df["v"].values
+            if not array:
+                sketch.update(values)
+                continue
+            matrix = element_matrix(values)
+            if matrix is None:
+                # only NULL arrays in this batch
+                continue
+            sketch.extend(KLLSketch(k) for _ in range(matrix.shape[1] - len(sketch)))
+            for j in range(matrix.shape[1]):
+                sketch[j].update(matrix[:, j])
+        return sketch
+
+    def percentiles(self, n=10, approx=False, eps=0.01, **kwargs):
+        """
+        Percentiles 1/n, 2/n... of the column.
+
+        The exact percentiles of a scalar column are returned as a Column
+        (percentile_disc query); with approx=True they are computed from a
+        quantile sketch (see quantile_sketch) and returned as an array, or as
+        a DataFrame with a row per position for array columns.
+        """
+        if approx:
+            pvalues = np.arange(1, n) / float(n)
+            sketch = self.quantile_sketch(eps, **kwargs)
+            if isinstance(sketch, list):
+                return pd.DataFrame([s.quantiles(pvalues) for s in sketch],
+                                    index=range(1, len(sketch) + 1), columns=pvalues)
+            return sketch.quantiles(pvalues)
         if self.ndims == 0:
             step = 1. / n
             pvalues = np.arange(step, 1, step)
@@ -138,10 +259,38 @@ class Column(PObject):
                 select_from(self.table)
             return Column(self.ctx, query, self.table, "percentile")
 
-    def collect(self):
-        return self.ctx.read_sql(sa.select([self.data]))
+    def sample(self, n=None, fraction=None, method=None, seed=None):
+        """
+        Column of a sample of the values: about n values, or each value with
+        probability fraction. See sample.sample_query for the methods.
+        """
+        data = self.data if isinstance(self.data, sa.sql.Select) else sa.select([self.data])
+        q = sample_query(self.ctx, data, n=n, fraction=fraction, method=method, seed=seed)
+        return Column(self.ctx, q, self.table, self.name)
+
+    def iter_batches(self, batch_size=10000, engine=None, records=False):
+        """
+        Iterate over the column values by DataFrames (or record arrays) of at
+        most batch_size rows. See PostmindContext.iter_sql.
+        """
+        return self.ctx.iter_sql(sa.select([self.data]), batch_size=batch_size, engine=engine,
+                                 records=records)
+
+    def collect(self, engine=None):
+        return self.ctx.read_sql(sa.select([self.data]), engine=engine)
+
+    def to_csv(self, file_name, alias=None, compression=True, parallel=None, key=None):
+        """
+        Export to a (gzip compressed) csv file on the database server.
 
-    def to_csv(self, file_name, alias=None, compression=True):
+        With parallel=n the export is split in n part files written by
+        concurrent COPY statements, plus a manifest (see
+        export.to_csv_parallel); key is the column hashed to split results
+        that are not a plain scan of a table.
+        """
+        if parallel:
+            return to_csv_parallel(self.ctx, self.data, file_name, parts=parallel, key=key,
+                                   compression=compression)
         from sqlalchemy.dialects import postgresql
 
         data = self.data
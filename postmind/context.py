@@ -32,16 +32,26 @@ import os
 import json
 from prettytable import PrettyTable
 from postmind import pg
+from postmind.io import pgcopy
+from postmind.io.ingest import load_csv
 import uuid
 import pandas as pd
 from sqlalchemy.sql.expression import func
 import logging
 from logging.handlers import RotatingFileHandler
 import numpy as np
+import atexit
+import weakref
+import fnmatch
 
 from .column import Column
 from .table import Table
-from utils import gen_table_name, pgapply
+from .schema import SchemaCache, describe_table, build_table
+from .udf import UDFRegistry
+from .persist import MaterializationRegistry
+from .instrument import Instrumentation, track, hold, frame_bytes
+from .cache import QueryCache, is_query
+from utils import gen_table_name, pgapply, estimated_counts, qualified_name, call_alive
 
 
 queries_templates = {
@@ -161,22 +171,44 @@ class TableSet(object):
         for tbl in tables:
             setattr(self, tbl.name, tbl)
         self.tables = tables
+        self._show_sizes = False
 
     def __getitem__(self, i):
         return self.tables[i]
 
+    def show_sizes(self, show=True):
+        """
+        Display the estimated row count of each table (see
+        Table.count), read from the catalog in one query.
+        """
+        self._show_sizes = show
+        return self
+
+    def _sizes(self, tables):
+        if not tables:
+            return []
+        names = [qualified_name(tbl.data.name, tbl.data.schema) if isinstance(tbl.data, sa.Table)
+                 else qualified_name(tbl.name) for tbl in tables]
+        return estimated_counts(tables[0].ctx, names)
+
     def _tablify(self):
-        tbl = PrettyTable(["Table", "Columns"])
+        header = ["Table", "Columns"] + (["Rows (est.)"] if self._show_sizes else [])
+        tbl = PrettyTable(header)
         tbl.align["Table"] = "l"
         tbl.align["Columns"] = "l"
-        for table in self.tables:
+        tables = self.tables
+        sizes = self._sizes(tables) if self._show_sizes else []
+        for i, table in enumerate(tables):
             column_names = [col.name for col in table._columns]
             column_names = ", ".join(column_names)
             pretty_column_names = ""
-            for i in range(0, len(column_names), 80):
-                pretty_column_names += column_names[i:(i+80)] + "\n"
+            for start in range(0, len(column_names), 80):
+                pretty_column_names += column_names[start:(start+80)] + "\n"
             pretty_column_names = pretty_column_names.strip()
-            tbl.add_row([table.name, pretty_column_names])
+            row = [table.name, pretty_column_names]
+            if self._show_sizes:
+                row.append("?" if sizes[i] is None else sizes[i])
+            tbl.add_row(row)
         return tbl
 
     def __repr__(self):
@@ -186,6 +218,61 @@ class TableSet(object):
     def _repr_html_(self):
         return self._tablify().get_html_string()
 
+    @property
+    def names(self):
+        return [tbl.name for tbl in self.tables]
+
+class LazyTableSet(TableSet):
+    """
+    Set of Tables known by name only, each Table being reflected the first
+    time it is accessed.
+    """
+    def __init__(self, names, loader):
+        self._names = list(names)
+        self._loader = loader
+        self._loaded = {}
+        self._show_sizes = False
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    @property
+    def tables(self):
+        return [self._get(name) for name in self._names]
+
+    def _get(self, name):
+        if name not in self._loaded:
+            self._loaded[name] = self._loader(name)
+        return self._loaded[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in self._names:
+            raise AttributeError(name)
+        return self._get(name)
+
+    def __getitem__(self, i):
+        if isinstance(i, basestring):
+            if i not in self._names:
+                raise KeyError(i)
+            return self._get(i)
+        return self._get(self._names[i])
+
+    def __iter__(self):
+        for name in self._names:
+            yield self._get(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        """
+        List the table name, reflected again when next accessed.
+        """
+        if name not in self._names:
+            self._names.append(name)
+        self._loaded.pop(name, None)
+
 class ColumnSet(object):
     """
     Set of Columns. Used for displaying search results in terminal/ipython
@@ -214,7 +301,18 @@ class ColumnSet(object):
         return self._tablify().get_html_string()
 
 class PostmindContext(object):
-    def __init__(self, uri=None, profile="default"):
+    def __init__(self, uri=None, profile="default", schema_cache=None):
+        """
+        Parameters
+        ----------
+        uri: str
+            Database uri, read from the profile credentials when None
+        profile: str
+            Credentials profile
+        schema_cache: str or bool
+            Directory of the on-disk schema cache (~/.postmind when None),
+            False to reflect the schema without caching it
+        """
         if uri is None:
             self.load_credentials(profile)
         else:
@@ -222,7 +320,19 @@ class PostmindContext(object):
         self._query_templates = queries_templates
 
         self.con = sa.create_engine(self.uri)
-
+        self.udfs = UDFRegistry(self)
+        self.instrumentation = None
+        self.materializations = MaterializationRegistry(self)
+        # weak references: a context dropped by the program can be collected
+        atexit.register(call_alive, weakref.ref(self.materializations), "drop")
+        self.cache = None
+        # statements other than queries run through execute, see Table.count
+        self.writes = 0
+
+        self.schema_cache = None
+        if schema_cache is not False:
+            self.schema_cache = SchemaCache(self, schema_cache)
+            atexit.register(call_alive, weakref.ref(self.schema_cache), "save")
         self.tables = TableSet([])
         self.refresh_schema()
 
@@ -235,6 +345,17 @@ class PostmindContext(object):
     def __delete__(self):
         del self.con
 
+    def close(self):
+        """
+        Drop the relations created by Table.persist, save the schema cache
+        and close the connections of the pool.
+        """
+        self.materializations.drop()
+        if self.schema_cache is not None:
+            self.schema_cache.save()
+        self.disable_instrumentation()
+        self.con.dispose()
+
     def apply(self, fun, *args, **kwargs):
         q = pgapply(self, fun, *args, **kwargs)
         return Table(self, gen_table_name(), q)
@@ -286,20 +407,22 @@ class PostmindContext(object):
             return [json.dumps(qws)]
         return self.apply(_setup)
 
-    def read_csv(self, file_name, **kwargs):
-        def _read_csv(in_file_name, out_table_name, sep=",", header=True, infer_limit=1000, index=None, expr='*', **kwargs):
-            import plpy
-
-            columns = []
-            columns_types = []
-            return columns, columns_types
-        return self.apply(_read_csv, file_name, **kwargs)
+    def read_csv(self, file_name, table=None, **kwargs):
+        """
+        Load a csv file of the database server into a typed table and return
+        it. See io.ingest.load_csv for the options.
+        """
+        name = load_csv(self, file_name, table, **kwargs)
+        if self.schema_cache is not None:
+            self.schema_cache.forget(name)
+        self.tables.add(name)
+        return self.tables[name]
 
     def find_table(self, search):
         tables = []
-        for table in self.tables:
-            if glob.fnmatch.fnmatch(table.name, search):
-                tables.append(table)
+        for name in self.tables.names:
+            if fnmatch.fnmatch(name, search):
+                tables.append(self.tables[name])
         return TableSet(tables)
 
     def find_column(self, search, data_type=None):
@@ -308,11 +431,13 @@ class PostmindContext(object):
         cols = []
         for table in self.tables:
             for col in vars(table):
-                if glob.fnmatch.fnmatch(col, search):
+                if fnmatch.fnmatch(col, search):
                     if data_type and isinstance(getattr(table, col), Column) and getattr(table, col).type not in data_type:
                         continue
                     if isinstance(getattr(table, col), Column):
                         cols.append(getattr(table, col))
+        if self.schema_cache is not None:
+            self.schema_cache.save()
         return ColumnSet(cols)
 
     def _assign_limit(self, q, limit=1000):
@@ -434,7 +559,7 @@ class PostmindContext(object):
             pass
         else:
             q = self._assign_limit(q, limit)
-        return pd.io.sql.read_sql(q, self.con)
+        return self.read_sql(q)
 
     def query_from_file(self, filename, limit=None):
         """
@@ -490,19 +615,31 @@ class PostmindContext(object):
         return self.query(open(filename).read(), limit)
 
     def refresh_schema(self):
-        meta = sa.MetaData()
-        meta.reflect(bind=self.con)
-        tables = []
-        for table in meta.tables:
-            tables.append(Table(self, table, meta.tables[table]))
-        from sqlalchemy import create_engine, inspect
-
-        ins = inspect(self.con)
-        for table in ins.get_foreign_table_names():
-            cols = ins.get_columns(table)
-            ocols = map(lambda x: sa.Column(x["name"], x["type"]), cols)
-            tables.append(Table(self, table, sa.Table(table, sa.MetaData(), *ocols)))
-        self.tables = TableSet(tables)
+        """
+        List the tables of the database. Each table schema is only reflected
+        (or read from the schema cache) when the table is first accessed.
+        """
+        cache = self.schema_cache
+        if cache is not None and cache.load():
+            names = cache.names
+        else:
+            ins = sa.inspect(self.con)
+            names = ins.get_table_names() + ins.get_foreign_table_names()
+            if cache is not None:
+                cache.set_names(names)
+                cache.save()
+        self.tables = LazyTableSet(names, self._reflect_table)
+
+    def _reflect_table(self, name):
+        # schema qualified names (schema.table) are listed as such
+        schema, _, table = name.rpartition(".")
+        cache = self.schema_cache
+        description = cache.get(name) if cache is not None else None
+        if description is None:
+            description = describe_table(sa.inspect(self.con), table, schema or None)
+            if cache is not None:
+                cache.put(name, description)
+        return Table(self, name, build_table(table, description, schema or None))
 
     def _try_command(self, cmd):
         try:
@@ -513,14 +650,144 @@ class PostmindContext(object):
             print ("Exception: {0}".format(e))
             self.con.rollback()
 
-    def textFile(self, path, sep=","):
-        return self.apply(pg.csv.mount_csv, path, "tmp", sep=sep)
+    def textFile(self, path, sep=",", mode="mount", table=None, infer_limit=1000, **kwargs):
+        """
+        Expose a csv file of the database server as a table.
+
+        mode "mount" creates a file_fdw foreign table (nothing is loaded, the
+        file is parsed on each scan) and "load" copies the file in a table
+        (see read_csv). Both use the column types inferred from the first
+        infer_limit lines.
+        """
+        if mode == "load":
+            return self.read_csv(path, table, sep=sep, infer_limit=infer_limit, **kwargs)
+        elif mode != "mount":
+            raise Exception("Unknown mode '%s'" % mode)
+        return self.apply(pg.csv.mount_csv, path, table or "tmp", sep=sep, infer_limit=infer_limit, **kwargs)
 
     def execute(self, *args, **kwargs):
+        if args and not is_query(args[0]):
+            self.writes += 1
+        if self.cache is not None and args:
+            self.cache.on_execute(args[0])
         return self.con.execute(*args, **kwargs)
 
-    def read_sql(self, query):
-        return pd.io.sql.read_sql(query, self.con)
+    def enable_cache(self, **kwargs):
+        """
+        Cache the results of read_sql (and of everything built on it: query,
+        head, distinct_count, values_count, ...). The keyword arguments are
+        passed to QueryCache.
+        """
+        self.cache = QueryCache(self, **kwargs)
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+    def enable_instrumentation(self, **kwargs):
+        """
+        Record every query run by the context: originating method, SQL
+        fingerprint, wall time, rows and bytes (see
+        instrument.Instrumentation for the keyword arguments: exporters,
+        explain, max_records).
+        """
+        self.disable_instrumentation()
+        self.instrumentation = Instrumentation(self, **kwargs)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        if self.instrumentation is not None:
+            self.instrumentation.close()
+        self.instrumentation = None
+
+    def stats(self, summary=False):
+        """
+        Records of the queries run since enable_instrumentation, or with
+        summary=True their totals per method and SQL fingerprint.
+        """
+        if self.instrumentation is None:
+            raise Exception("Instrumentation is not enabled, call enable_instrumentation first")
+        return self.instrumentation.stats(summary)
+
+    def read_sql(self, query, engine=None, cache=True):
+        """
+        Run a query and return its result as a DataFrame.
+
+        Parameters
+        ----------
+        query: str or sqlalchemy selectable
+            Query to run
+        engine: str
+            None to go through pandas, "copy" to stream the result with a
+            binary COPY decoded straight into NumPy columns
+        cache: bool
+            Use the result cache when it is enabled
+        """
+        if engine not in (None, "copy"):
+            raise Exception("Unknown engine '%s'" % engine)
+        if cache and self.cache is not None:
+            sql = query if isinstance(query, basestring) else self.to_sql(query)
+            return self.cache.get(sql, lambda: self._read_sql(sql, engine))
+        return self._read_sql(query, engine)
+
+    def _read_sql(self, query, engine):
+        if engine == "copy":
+            sql = query if isinstance(query, basestring) else self.to_sql(query)
+            return pgcopy.read_sql_copy(self, sql).to_frame()
+        with hold(self) as records:
+            df = pd.io.sql.read_sql(query, self.con)
+            if records:
+                records[-1].nbytes = frame_bytes(df)
+        return df
+
+    def iter_sql(self, query, batch_size=10000, engine=None, records=False):
+        """
+        Run a query and iterate over its result by batches of at most
+        batch_size rows, without holding the whole result in memory.
+
+        Parameters
+        ----------
+        query: str or sqlalchemy selectable
+            Query to run
+        batch_size: int
+            Maximum number of rows per batch
+        engine: str
+            None to fetch the batches from a named server-side cursor, "copy"
+            to stream them through a binary COPY
+        records: bool
+            Yield NumPy record arrays instead of DataFrames
+        """
+        sql = query if isinstance(query, basestring) else self.to_sql(query)
+        if engine == "copy":
+            batches = pgcopy.iter_sql_copy(self, sql, batch_size=batch_size)
+        elif engine is None:
+            batches = self._iter_cursor(sql, batch_size)
+        else:
+            raise Exception("Unknown engine '%s'" % engine)
+        for df in batches:
+            yield df.to_records(index=False) if records else df
+
+    def _iter_cursor(self, sql, batch_size):
+        conn = self.con.raw_connection()
+        try:
+            with track(self, sql, "cursor") as query:
+                cursor = conn.cursor(name=gen_table_name("cur_"))
+                cursor.itersize = batch_size
+                cursor.execute(sql)
+                query.rows = 0
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    query.rows += len(rows)
+                    df = pd.DataFrame.from_records(rows, columns=[d[0] for d in cursor.description])
+                    if self.instrumentation is not None:
+                        query.nbytes = (query.nbytes or 0) + frame_bytes(df)
+                    yield df
+                cursor.close()
+        finally:
+            conn.rollback()
+            conn.close()
 
     def to_sql(self, qsa):
         from sqlalchemy.dialects import postgresql
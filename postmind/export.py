@@ -0,0 +1,178 @@
+__author__ = 'matthieu'
+
+import json
+import logging
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from .utils import parallel_map, _engine
+from .plan import as_select
+
+logger = logging.getLogger('pom')
+
+
+def copy_statement(data, file_name, compression=True):
+    """
+    COPY statement (and its parameters) writing data to file_name on the
+    database server.
+    """
+    c = as_select(data).compile(dialect=postgresql.dialect())
+    if compression:
+        q = "COPY (%s) TO PROGRAM 'gzip > %s'" %(c, file_name)
+    else:
+        q = "COPY (%s) TO '%s'" %(c, file_name)
+    q += " WITH (format csv, header false, DELIMITER '|')"
+    return q, c.params
+
+
+def part_name(file_name, i):
+    if file_name.endswith(".gz"):
+        return "%s.part%04d.gz" %(file_name[:-3], i)
+    return "%s.part%04d" %(file_name, i)
+
+
+def base_table(q):
+    """
+    Table scanned by q when q is a plain filter / projection of one table.
+    """
+    if isinstance(q, sa.Table):
+        return q
+    if not isinstance(q, sa.sql.Select) or len(q.froms) != 1 or not isinstance(q.froms[0], sa.Table):
+        return None
+    if q._group_by_clause.clauses or q._distinct or q._limit_clause is not None or q._offset_clause is not None:
+        return None
+    return q.froms[0]
+
+
+def block_ranges(ctx, table, parts):
+    """
+    Split the blocks of table in parts ctid conditions; the last range is
+    left open so rows added to new blocks are still exported.
+    """
+    name = postgresql.dialect().identifier_preparer.format_table(table)
+    nblocks = ctx.execute(sa.text("select pg_relation_size(cast(:name as regclass)) / "
+                                  "current_setting('block_size')::int"),
+                          name=name).scalar()
+    bounds = [int(nblocks * i / parts) for i in range(parts)] + [None]
+    conditions = []
+    for i in range(parts):
+        cond = "%s.ctid >= '(%d,0)'::tid" %(name, bounds[i])
+        if bounds[i + 1] is not None:
+            cond += " and %s.ctid < '(%d,0)'::tid" %(name, bounds[i + 1])
+        conditions.append(sa.text(cond))
+    return conditions
+
+
+def key_ranges(ctx, table, column, parts):
+    """
+    Split the values of the integer column of table in parts range
+    conditions; the first and last ranges are left open.
+    """
+    col = table.c[column]
+    low, high = ctx.execute(sa.select([sa.func.min(col), sa.func.max(col)])).first()
+    if low is None:
+        return [sa.true()] + [sa.false()] * (parts - 1)
+    bounds = [None] + [low + (high - low + 1) * i // parts for i in range(1, parts)] + [None]
+    conditions = []
+    for i in range(parts):
+        cond = [col >= bounds[i]] if bounds[i] is not None else []
+        cond += [col < bounds[i + 1]] if bounds[i + 1] is not None else []
+        conditions.append(sa.and_(*cond) if cond else sa.true())
+    return conditions
+
+
+def range_key(table):
+    """
+    Name of the single integer primary key column of table, or None.
+    """
+    columns = list(table.primary_key.columns)
+    if len(columns) == 1 and isinstance(columns[0].type, sa.Integer):
+        return columns[0].name
+    return None
+
+
+def export_snapshot(con):
+    """
+    Connection holding an open repeatable read transaction and the id of its
+    exported snapshot, for the parts to read the same data.
+    """
+    conn = con.connect()
+    trans = conn.begin()
+    conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    snapshot = conn.execute("select pg_export_snapshot()").scalar()
+    return conn, trans, snapshot
+
+
+def _copy_part(part, con):
+    q, params, snapshot = part
+    with _engine(con).begin() as conn:
+        # the snapshot must be set before any query of the transaction
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        conn.execute("SET TRANSACTION SNAPSHOT '%s'" % snapshot)
+        return conn.execute(q, params).rowcount
+
+
+def to_csv_parallel(ctx, data, file_name, parts=4, key=None, compression=True):
+    """
+    Export data with parts concurrent COPY statements, each one writing (and
+    compressing) its own part file, plus a JSON manifest listing the parts
+    and their row counts (file_name + ".manifest.json", also returned).
+
+    The rows are split by ctid block ranges when data scans a single table,
+    or by a hash of the key column otherwise (each part then runs the whole
+    query, keeping only its share of the rows). ctid ranges only restrict
+    the blocks read from PostgreSQL 14 (TID range scans): on older servers
+    a table with an integer primary key is split on ranges of that key, and
+    otherwise each part scans the whole table.
+
+    All the parts read the snapshot exported by a transaction held open
+    during the export, so they add up to a consistent copy of data even
+    while it is being written.
+    """
+    q = as_select(data)
+    table = base_table(q)
+    split = "key" if key is not None else "ctid"
+    version = int(ctx.execute("show server_version_num").scalar())
+    if key is None and table is not None and version < 140000:
+        pk = range_key(table)
+        if pk is not None:
+            split = "range"
+        else:
+            logger.warning("No TID range scan before PostgreSQL 14: each part of %s scans the whole table"
+                           % table.name)
+    if key is not None:
+        alias = q.alias("q")
+        selects = [sa.select(['*']).select_from(alias).
+                   where(sa.text("mod(hashtext(q.%s::text)::bigint + 2147483648, %d) = %d" %(key, parts, i)))
+                   for i in range(parts)]
+    elif split == "range":
+        selects = [q.where(cond) for cond in key_ranges(ctx, table, pk, parts)]
+    elif table is not None:
+        selects = [q.where(cond) for cond in block_ranges(ctx, table, parts)]
+    else:
+        raise Exception("Parallel export of a derived query needs a key column")
+    names = [part_name(file_name, i) for i in range(len(selects))]
+    conn, trans, snapshot = export_snapshot(ctx.con)
+    try:
+        copies = [copy_statement(s, name, compression) + (snapshot,) for s, name in zip(selects, names)]
+        counts = parallel_map(ctx, _copy_part, copies, n_jobs=len(copies), backend="threads")
+    finally:
+        trans.rollback()
+        conn.close()
+    manifest = {"file_name": file_name,
+                "compression": "gzip" if compression else None,
+                "split": split,
+                "key": key,
+                "rows": sum(counts),
+                "parts": [{"file_name": name, "rows": count} for name, count in zip(names, counts)]}
+    write_server_file(ctx, file_name + ".manifest.json", json.dumps(manifest))
+    return manifest
+
+
+def write_server_file(ctx, file_name, content):
+    # csv format with control characters as delimiter and quote so the
+    # content is written as is
+    ctx.execute(sa.text("COPY (select cast(:content as text)) TO '%s' "
+                        "WITH (format csv, delimiter e'\\x02', quote e'\\x01')" % file_name),
+                content=content)
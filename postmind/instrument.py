@@ -0,0 +1,276 @@
+"""
+Per query instrumentation of a PostmindContext.
+
+Instrumentation listens to the before / after_cursor_execute events of the
+context engine and records, for every statement, the Postmind method it
+comes from (the outermost postmind frame of the call stack), a fingerprint
+of its SQL (literals and parameters replaced by ?), its wall time and the
+number of rows it returned, optionally with its plan. Queries run on raw
+DBAPI connections (binary COPY, server-side cursors) do not go through the
+engine events and are recorded with track().
+
+The DBAPI does not expose the size of the results it fetches, so bytes is
+the size of the stream for the binary COPY and the memory of the decoded
+DataFrames (memory_usage(deep=True)) for read_sql through pandas and for
+the server-side cursors; it is None for the other statements.
+
+Every record is passed to the exporters, callables taking a QueryRecord, so
+the records can be shipped to a metrics system as they happen.
+"""
+__author__ = 'matthieu'
+
+import re
+import sys
+import time
+import hashlib
+import logging
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+import sqlalchemy as sa
+
+from .cache import functions
+
+logger = logging.getLogger('pom')
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\$\d+|\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I)
+SPACES = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    """
+    Normalized text of sql (literals and parameters replaced by ?,
+    whitespace collapsed) and its hash.
+    """
+    normalized = SPACES.sub(" ", LITERALS.sub("?", sql)).strip().lower()
+    return normalized, hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def api_method():
+    """
+    Name (Class.method) of the outermost postmind function of the current
+    call stack, the public method the user called.
+    """
+    frame = sys._getframe(1)
+    method = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if (module == "postmind" or module.startswith("postmind.")) and module != __name__:
+            code = frame.f_code
+            owner = frame.f_locals.get("self") if code.co_varnames[:1] == ("self",) else None
+            method = code.co_name if owner is None else "%s.%s" % (type(owner).__name__, code.co_name)
+        frame = frame.f_back
+    return method
+
+
+class QueryRecord(object):
+    def __init__(self, sql, method=None, source="engine"):
+        self.sql = sql
+        self.normalized, self.fingerprint = fingerprint(sql)
+        self.method = method
+        self.source = source
+        self.start = time.time()
+        self.duration = None
+        self.rows = None
+        self.nbytes = None
+        self.plan = None
+        self.error = None
+
+    def as_dict(self):
+        return OrderedDict([("start", self.start), ("method", self.method), ("fingerprint", self.fingerprint),
+                            ("duration", self.duration), ("rows", self.rows), ("bytes", self.nbytes),
+                            ("source", self.source), ("error", self.error), ("sql", self.normalized),
+                            ("plan", self.plan)])
+
+
+def log_exporter(record):
+    """
+    Exporter writing each record to the pom logger.
+    """
+    logger.debug("query %s %s %.3fs rows=%s bytes=%s" % (record.method, record.fingerprint, record.duration,
+                                                         record.rows, record.nbytes))
+
+
+class Instrumentation(object):
+    """
+    Records of the statements run by a context, the last max_records being
+    kept in memory.
+
+    Parameters
+    ----------
+    ctx: PostmindContext
+        Instrumented context
+    exporters: list
+        Callables called with each QueryRecord
+    explain: bool or str
+        Also record the EXPLAIN output (estimated plan) of each select, or
+        with "analyze" its EXPLAIN (ANALYZE, BUFFERS) output: the select then
+        runs a second time, except when it calls a function of the UDF
+        registry (see udf.UDFRegistry.is_udf), which may have side effects
+    max_records: int
+        Number of records kept for stats()
+    """
+    def __init__(self, ctx, exporters=None, explain=False, max_records=10000):
+        self.ctx = ctx
+        self.exporters = list(exporters or [])
+        self.explain = explain
+        self.records = deque(maxlen=max_records)
+        self._local = threading.local()
+        sa.event.listen(ctx.con, "before_cursor_execute", self._before)
+        sa.event.listen(ctx.con, "after_cursor_execute", self._after)
+        sa.event.listen(ctx.con, "handle_error", self._error)
+
+    def close(self):
+        sa.event.remove(self.ctx.con, "before_cursor_execute", self._before)
+        sa.event.remove(self.ctx.con, "after_cursor_execute", self._after)
+        sa.event.remove(self.ctx.con, "handle_error", self._error)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def _pending(self):
+        if not hasattr(self._local, "pending"):
+            self._local.pending = []
+        return self._local.pending
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self._pending().append(QueryRecord(statement, api_method()))
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        pending = self._pending()
+        if not pending:
+            return
+        record = pending.pop()
+        record.duration = time.time() - record.start
+        record.rows = cursor.rowcount if cursor.rowcount >= 0 else None
+        if self.explain and not executemany and self._explainable(statement):
+            record.plan = self._explain(cursor, statement, parameters)
+        self._record(record)
+
+    def _error(self, context):
+        pending = self._pending()
+        if pending:
+            record = pending.pop()
+            record.duration = time.time() - record.start
+            record.error = str(context.original_exception).strip()
+            self._record(record)
+
+    def _record(self, record):
+        held = getattr(self._local, "held", None)
+        if held is not None:
+            held.append(record)
+        else:
+            self.add(record)
+
+    def _explainable(self, statement):
+        if not statement.lstrip().lower().startswith("select"):
+            return False
+        # EXPLAIN ANALYZE runs the select again: not the ones calling UDFs
+        return self.explain != "analyze" or not any(self.ctx.udfs.is_udf(name) for name in functions(statement))
+
+    def _explain(self, cursor, statement, parameters):
+        # a DBAPI cursor of the same connection: the plan is not recorded
+        # itself and the result of the statement is left untouched
+        explain = cursor.connection.cursor()
+        try:
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) " if self.explain == "analyze" else "EXPLAIN "
+            explain.execute(prefix + statement, parameters)
+            return "\n".join(row[0] for row in explain.fetchall())
+        except Exception as ex:
+            logger.warning("Cannot explain query: %s" % ex)
+            return None
+        finally:
+            explain.close()
+
+    def add(self, record):
+        self.records.append(record)
+        for exporter in self.exporters:
+            try:
+                exporter(record)
+            except Exception as ex:
+                logger.warning("Query exporter %r failed: %s" % (exporter, ex))
+
+    def stats(self, summary=False):
+        """
+        DataFrame of the records, or with summary=True one row per method
+        and fingerprint: calls, total / mean / max time, rows and bytes
+        (when known, see the module documentation).
+        """
+        df = pd.DataFrame([record.as_dict() for record in self.records],
+                          columns=list(QueryRecord("").as_dict().keys()))
+        df["start"] = pd.to_datetime(df["start"], unit="s")
+        if not summary:
+            return df
+        grouped = df.groupby(["method", "fingerprint"], sort=False)
+        out = pd.DataFrame(OrderedDict([
+            ("calls", grouped["duration"].size()),
+            ("total", grouped["duration"].sum()),
+            ("mean", grouped["duration"].mean()),
+            ("max", grouped["duration"].max()),
+            ("rows", grouped["rows"].sum(min_count=1)),
+            ("bytes", grouped["bytes"].sum(min_count=1)),
+            ("sql", grouped["sql"].first()),
+        ]))
+        return out.sort_values("total", ascending=False)
+
+
+class UnrecordedQuery(object):
+    """
+    Stand-in for the QueryRecord of track() when the context is not
+    instrumented.
+    """
+    rows = None
+    nbytes = None
+    error = None
+
+
+@contextmanager
+def track(ctx, sql, source="dbapi"):
+    """
+    Record a query run on a raw DBAPI connection: the block sets the rows
+    and nbytes of the yielded QueryRecord. Nothing is recorded (nor
+    fingerprinted) when the context is not instrumented.
+    """
+    instrumentation = getattr(ctx, "instrumentation", None)
+    if instrumentation is None:
+        yield UnrecordedQuery()
+        return
+    record = QueryRecord(sql, api_method(), source)
+    try:
+        yield record
+    except Exception as ex:
+        record.error = str(ex).strip()
+        raise
+    finally:
+        record.duration = time.time() - record.start
+        instrumentation.add(record)
+
+
+@contextmanager
+def hold(ctx):
+    """
+    Hold the records of the statements run through the engine by the
+    current thread in the block, and add them once it ends, so the block can
+    set their bytes. Yields the list of held records (empty when the context
+    is not instrumented).
+    """
+    instrumentation = getattr(ctx, "instrumentation", None)
+    if instrumentation is None:
+        yield []
+        return
+    held = instrumentation._local.held = []
+    try:
+        yield held
+    finally:
+        instrumentation._local.held = None
+        for record in held:
+            instrumentation.add(record)
+
+
+def frame_bytes(df):
+    """
+    Memory of a DataFrame, object values included.
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
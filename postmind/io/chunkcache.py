@@ -0,0 +1,215 @@
+"""
+Sidecar cache of parsed csv chunks.
+
+The first read of a file through ChunkCache.frames parses it with
+pd.read_csv and writes each column of each chunk to a .npy file, next to a
+small json manifest. Entries are keyed on the file path, size and mtime and
+on the reader options; later reads memory-map the column files of the
+requested columns instead of parsing the csv again. String columns are
+stored as the concatenated (utf-8) bytes of their values and the offsets
+of each value, so no value is padded to the longest one. Entries are
+evicted in least recently used order once the cache holds more than
+max_bytes.
+"""
+__author__ = 'matthieu'
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('pom')
+
+MANIFEST = "manifest.json"
+# version of the column files, part of the entry keys
+FORMAT = 2
+
+
+class ChunkCache(object):
+    def __init__(self, path=None, max_bytes=1 << 32):
+        if path is None:
+            path = os.path.join(os.path.expanduser("~"), ".postmind", "chunks")
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def key(self, file_name, options):
+        st = os.stat(file_name)
+        content = json.dumps([FORMAT, os.path.abspath(file_name), st.st_size, repr(st.st_mtime), options],
+                             sort_keys=True, default=repr)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def frames(self, file_name, usecols=None, **kwargs):
+        """
+        Chunks of the csv file read with the pd.read_csv options kwargs
+        (chunksize defaults to 100000).
+
+        usecols (column names or positions, or a callable on the names) is
+        applied to the cached columns, so all the projections of a file
+        share one cache entry.
+        """
+        kwargs.setdefault("chunksize", 100000)
+        entry = os.path.join(self.path, self.key(file_name, kwargs))
+        manifest = self.manifest(entry)
+        if manifest is None:
+            logger.info("Caching parsed chunks of %s in %s" %(file_name, entry))
+            return self._parse(file_name, entry, usecols, kwargs)
+        return self._load(entry, manifest, usecols)
+
+    def manifest(self, entry):
+        try:
+            with open(os.path.join(entry, MANIFEST)) as fp:
+                manifest = json.load(fp)
+            # the entry mtime is its last use
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return manifest
+
+    def _parse(self, file_name, entry, usecols, kwargs):
+        tmp = "%s.tmp%d" %(entry, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        columns = None
+        chunks = []
+        try:
+            for i, df in enumerate(pd.read_csv(file_name, **kwargs)):
+                if columns is None:
+                    columns = list(df.columns)
+                encodings = [write_column(tmp, i, j, df.iloc[:, j]) for j in range(len(columns))]
+                chunks.append({"rows": len(df), "encodings": encodings})
+                yield df.iloc[:, select_positions(columns, usecols)]
+            with open(os.path.join(tmp, MANIFEST), "w") as fp:
+                json.dump({"file_name": file_name, "columns": columns or [], "chunks": chunks}, fp)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # cached by a concurrent reader
+                pass
+            self.evict()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load(self, entry, manifest, usecols):
+        columns = [column_name(name) for name in manifest["columns"]]
+        positions = select_positions(columns, usecols)
+        start = 0
+        for i, chunk in enumerate(manifest["chunks"]):
+            rows = chunk["rows"]
+            data = OrderedDict((columns[j], read_column(entry, i, j, chunk["encodings"][j], rows))
+                               for j in positions)
+            yield pd.DataFrame(data, index=pd.RangeIndex(start, start + rows),
+                               columns=[columns[j] for j in positions])
+            start += rows
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_bytes.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if ".tmp" in name or not os.path.exists(os.path.join(entry, MANIFEST)):
+                continue
+            nbytes = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), nbytes, entry))
+            total += nbytes
+        for _, nbytes, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.info("Evicting chunk cache entry %s" % entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= nbytes
+
+
+def read_chunks(file_name, cache=None, **kwargs):
+    """
+    Chunks of pd.read_csv(file_name, **kwargs), read through cache (a
+    ChunkCache or a cache directory) when given.
+    """
+    if cache is None:
+        return pd.read_csv(file_name, **kwargs)
+    if not isinstance(cache, ChunkCache):
+        cache = ChunkCache(cache)
+    return cache.frames(file_name, **kwargs)
+
+
+def write_column(path, chunk, pos, values):
+    """
+    Write a chunk column to path. Returns its encoding: "npy" for arrays
+    that can be memory-mapped, "str" for byte strings and "utf8" for
+    unicode strings (plus a null mask for "str_null" and "utf8_null"), and
+    "object" for other object columns (pickled).
+    """
+    values = np.asarray(values)
+    name = os.path.join(path, "c%05d_%d" %(chunk, pos))
+    if values.dtype.kind != "O":
+        np.save(name + ".npy", values)
+        return "npy"
+    null = pd.isnull(values)
+    present = values[~null]
+    if all(isinstance(v, bytes) for v in present):
+        encoding, strings = "str", np.where(null, b"", values).tolist()
+    elif all(isinstance(v, unicode) for v in present):
+        encoding, strings = "utf8", [v.encode("utf-8") for v in np.where(null, u"", values).tolist()]
+    else:
+        np.save(name + ".npy", values)
+        return "object"
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in strings], out=offsets[1:])
+    np.save(name + ".npy", np.frombuffer(b"".join(strings), dtype=np.uint8))
+    np.save(name + ".offsets.npy", offsets)
+    if null.any():
+        np.save(name + ".null.npy", null)
+        return encoding + "_null"
+    return encoding
+
+
+def read_column(path, chunk, pos, encoding, rows):
+    name = os.path.join(path, "c%05d_%d" %(chunk, pos))
+    if encoding == "object":
+        return np.load(name + ".npy", allow_pickle=True)
+    values = np.load(name + ".npy", mmap_mode="r" if rows else None)
+    if encoding == "npy":
+        return values
+    buf = values.tobytes()
+    offsets = np.load(name + ".offsets.npy").tolist()
+    values = np.empty(rows, dtype=object)
+    if encoding.startswith("utf8"):
+        values[:] = [buf[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+    else:
+        values[:] = [buf[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    if encoding.endswith("_null"):
+        values[np.load(name + ".null.npy")] = np.nan
+    return values
+
+
+def select_positions(columns, usecols):
+    if usecols is None:
+        return list(range(len(columns)))
+    if callable(usecols):
+        return [j for j, name in enumerate(columns) if usecols(name)]
+    usecols = set(usecols)
+    return [j for j, name in enumerate(columns) if name in usecols or j in usecols]
+
+
+def column_name(name):
+    # json gives unicode names back, keep ascii names str under Python 2
+    if isinstance(name, unicode):
+        try:
+            return str(name)
+        except UnicodeEncodeError:
+            pass
+    return name
@@ -0,0 +1,65 @@
+__author__ = 'matthieu'
+
+import json
+
+import sqlalchemy as sa
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from postmind.pg.csv import csv_layout
+from postmind.utils import gen_table_name, pgapply, parallel_map, execute_query
+
+
+def sql_literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def load_csv(ctx, file_name, table=None, sep=",", header=True, infer_limit=1000, unlogged=True,
+             analyze=True, jobs=4):
+    """
+    Load a csv file of the database server into a table.
+
+    The column types are inferred from the first infer_limit lines, then
+    the file is split in jobs line aligned byte ranges loaded by concurrent
+    COPY FROM statements (quoted values must not contain new lines when
+    jobs > 1).
+
+    Parameters
+    ----------
+    ctx: PostmindContext
+        Context of the database
+    file_name: str
+        Path of the csv file on the database server
+    table: str
+        Name of the table to (re)create, generated when None
+    unlogged: bool
+        Create an UNLOGGED table (faster to load, not crash safe)
+    analyze: bool
+        ANALYZE the table once loaded
+    jobs: int
+        Number of concurrent COPY statements
+    """
+    table = table or gen_table_name()
+    layout = ctx.read_sql(pgapply(ctx, csv_layout, file_name, sep=sep, header=header,
+                                  infer_limit=infer_limit, chunks=jobs), cache=False).values[0][0]
+    if not isinstance(layout, dict):
+        layout = json.loads(layout)
+    columns = ", ".join('"%s" %s' %(col.replace('"', '""'), tp)
+                        for col, tp in zip(layout["columns"], layout["types"]))
+    ctx.execute("DROP TABLE IF EXISTS %s; CREATE %sTABLE %s (%s);"
+                %(table, "UNLOGGED " if unlogged else "", table, columns))
+    copies = []
+    for offset, length in layout["chunks"]:
+        program = "tail -c +%d %s | head -c %d" %(offset + 1, quote(file_name), length)
+        copy = "COPY %s FROM PROGRAM %s WITH (format csv, header false, delimiter %s)" \
+               %(table, sql_literal(program), sql_literal(sep))
+        copies.append(sa.text(copy.replace(":", "\\:")).execution_options(autocommit=True))
+    if copies:
+        parallel_map(ctx, execute_query, copies, n_jobs=len(copies), backend="threads")
+    if analyze:
+        # not autocommitted by SQLAlchemy, the statistics would be rolled back
+        ctx.execute(sa.text("ANALYZE %s" % table).execution_options(autocommit=True))
+    return table
@@ -0,0 +1,275 @@
+"""
+Client side export of a query result to a memory-mapped structured .npy
+file.
+
+The result is streamed through a binary COPY (see pgcopy) and each decoded
+chunk is written into a memory map of the file, which grows by doubling its
+row capacity; the .npy header is rewritten in place with the final shape
+once the stream ends. At most one decoded chunk is resident at a time.
+"""
+__author__ = 'matthieu'
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from . import pgcopy
+
+MAGIC = b"\x93NUMPY"
+# the header keeps room for this many digits of row count, so growing the
+# file never changes its length
+SHAPE_WIDTH = 24
+HEADER_ALIGN = 64
+
+
+class NpyWriter(object):
+    """
+    Structured .npy file filled chunk by chunk.
+
+    The dtype is taken from the first chunk and widened when a later chunk
+    needs it (longer strings, integer column holding NULLs, array column
+    only NULL so far...), in which case the rows already written are copied
+    to a file of the new dtype. String columns at least double their width
+    (see widen), so the rows are copied a logarithmic number of times. hint is the dtype of the result columns
+    (see empty_dtype), used for the columns of the first chunk holding only
+    NULLs.
+    """
+    def __init__(self, file_name, capacity=1 << 16, hint=None):
+        self.file_name = file_name
+        self.capacity = capacity
+        self.hint = hint
+        self.nrows = 0
+        self.dtype = None
+        self._map = None
+        self._offset = None
+
+    def append(self, columns):
+        chunk = to_records(columns, self.dtype if self.dtype is not None else self.hint)
+        if self.dtype is None:
+            self._create(chunk.dtype, max(self.capacity, len(chunk)))
+        elif chunk.dtype != self.dtype:
+            dtype = widen(self.dtype, chunk.dtype)
+            if dtype != self.dtype:
+                self._rewrite(dtype)
+            chunk = chunk.astype(self.dtype)
+        if self.nrows + len(chunk) > self.capacity:
+            self._resize(max(2 * self.capacity, self.nrows + len(chunk)))
+        self._map[self.nrows:self.nrows + len(chunk)] = chunk
+        self.nrows += len(chunk)
+
+    def close(self, dtype=None):
+        """
+        Truncate the file to the rows written and write its final header.
+        dtype is used when no chunk was appended.
+        """
+        if self.dtype is None:
+            self._create(dtype, 0)
+        self._resize(self.nrows)
+
+    def _create(self, dtype, capacity):
+        self.dtype = dtype
+        header = npy_header(dtype, capacity)
+        self._offset = len(header)
+        with open(self.file_name, "wb") as fp:
+            fp.write(header)
+        self._resize(capacity)
+
+    def _resize(self, capacity):
+        self._map = None
+        with open(self.file_name, "r+b") as fp:
+            fp.write(npy_header(self.dtype, capacity))
+            fp.truncate(self._offset + capacity * self.dtype.itemsize)
+        self.capacity = capacity
+        if capacity:
+            self._map = np.memmap(self.file_name, dtype=self.dtype, mode="r+",
+                                  offset=self._offset, shape=(capacity,))
+
+    def _rewrite(self, dtype):
+        old_name = self.file_name + ".old"
+        os.rename(self.file_name, old_name)
+        old = self._map
+        self._create(dtype, self.capacity)
+        step = max(1, (1 << 26) // dtype.itemsize)
+        for start in range(0, self.nrows, step):
+            end = min(self.nrows, start + step)
+            for name in dtype.names:
+                field = dtype.fields[name][0]
+                if old.dtype.fields[name][0].shape == field.shape:
+                    self._map[name][start:end] = old[name][start:end]
+                else:
+                    # array column only NULL so far
+                    self._map[name][start:end] = missing(field.base)
+        del old
+        os.remove(old_name)
+
+
+def npy_header(dtype, nrows):
+    """
+    Version 1.0 .npy header of a 1d array of nrows records, padded so its
+    length does not depend on nrows.
+    """
+    descr = np.lib.format.dtype_to_descr(dtype)
+    shape = ("%d," % nrows).ljust(SHAPE_WIDTH)
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%s), }" % (descr, shape)
+    version, size = b"\x01\x00", "<H"
+    if len(header) + 12 + HEADER_ALIGN > 0xffff:
+        version, size = b"\x02\x00", "<I"
+    prefix = len(MAGIC) + 2 + struct.calcsize(size)
+    header += " " * ((-(prefix + len(header) + 1)) % HEADER_ALIGN) + "\n"
+    return MAGIC + version + struct.pack(size, len(header)) + header.encode("latin1")
+
+
+def missing(dtype):
+    """
+    Value standing for NULL in a column of dtype.
+    """
+    return u"" if dtype.kind == "U" else np.datetime64("NaT") if dtype.kind == "M" else np.nan
+
+
+def to_records(columns, dtype=None):
+    """
+    Structured array of the decoded columns of a chunk. dtype is the dtype
+    of the previous chunks, or the hint of the writer for the first one.
+    """
+    fields = []
+    values = []
+    for name, col in columns.items():
+        if col.dtype.kind == "O":
+            hint = dtype.fields[name][0] if dtype is not None and name in dtype.names else None
+            col = object_column(name, col, hint)
+        fields.append((name, col.dtype, col.shape[1:]))
+        values.append(col)
+    out = np.empty(len(values[0]) if values else 0, dtype=fields)
+    for (name, _, _), col in zip(fields, values):
+        out[name] = col
+    return out
+
+
+def object_column(name, col, hint=None):
+    """
+    Fixed width array of an object column: text values become unicode
+    strings (NULL as empty string), NULL numeric arrays are filled with NaN
+    (NaT for dates and timestamps). A column of NULL arrays whose length is
+    not known yet (hint of shape (0,)) has no element.
+    """
+    present = [v for v in col if v is not None]
+    if not present and hint is not None:
+        base = hint.base
+        if base.kind in "iu" and hint.shape:
+            # the arrays of the later chunks are filled with NaN
+            base = np.dtype(np.float64)
+        if base.kind not in "UfM":
+            raise Exception("NULL values in column %s, cast it to float" % name)
+        out = np.empty((len(col),) + hint.shape, dtype=base)
+        out[...] = missing(base)
+        return out
+    if all(isinstance(v, basestring) for v in present):
+        col = np.array([u"" if v is None else v for v in col], dtype=np.unicode_)
+        return col if col.dtype.itemsize else col.astype("U1")
+    shape = getattr(present[0], "shape", None)
+    if all(isinstance(v, np.ndarray) and v.dtype.kind in "iufM" and v.shape == shape for v in present):
+        dtype = np.result_type(*[v.dtype for v in present])
+        if dtype.kind in "iu":
+            dtype = np.dtype(np.float64)
+        out = np.empty((len(col),) + shape, dtype=dtype)
+        out[...] = np.nan if dtype.kind == "f" else np.datetime64("NaT")
+        for i, v in enumerate(col):
+            if v is not None:
+                out[i] = v
+        return out
+    raise Exception("Column %s holds NULL booleans or arrays of varying dimensions / with NULL elements, "
+                    "it cannot be stored in a .npy file" % name)
+
+
+def widen(dtype, other):
+    """
+    dtype able to hold the records of both structured dtypes. A string
+    column of dtype too narrow for other at least doubles its width.
+    """
+    if dtype.names != other.names:
+        raise Exception("Column names changed while streaming")
+    fields = []
+    for name in dtype.names:
+        a, b = dtype.fields[name][0], other.fields[name][0]
+        shape = a.shape
+        if a.shape == (0,) and b.shape:
+            # the length of the arrays is now known
+            shape = b.shape
+        elif a.shape != b.shape:
+            raise Exception("Array column %s changed dimensions (%s, %s), it cannot be stored in a "
+                            ".npy file" % (name, a.shape, b.shape))
+        a, b = a.base, b.base
+        if a.kind == "U" or b.kind == "U":
+            if a.kind != b.kind:
+                raise Exception("Column %s changed type while streaming" % name)
+            base = a if a.itemsize >= b.itemsize else np.dtype((a.type, max(2 * a.itemsize, b.itemsize) // 4))
+        elif a == b:
+            base = a
+        else:
+            base = np.promote_types(a, b)
+        fields.append((name, base, shape))
+    return np.dtype(fields)
+
+
+def empty_dtype(fields):
+    """
+    Structured dtype of a result without rows.
+    """
+    out = []
+    for name, oid in fields:
+        oid = pgcopy.wire_oid(oid)
+        if oid in pgcopy.FIXED_TYPES:
+            out.append((name, pgcopy.finalize_fixed(np.empty(0, dtype=np.dtype(
+                pgcopy.FIXED_TYPES[oid]).newbyteorder("=")), oid).dtype))
+        elif oid in pgcopy.ARRAY_TYPES:
+            out.append((name, np.dtype(pgcopy.FIXED_TYPES[pgcopy.ARRAY_TYPES[oid]]).newbyteorder("="), (0,)))
+        else:
+            out.append((name, np.dtype("U1")))
+    return np.dtype(out)
+
+
+def write_npy(ctx, sql, file_name=None, mmap=True, chunk_bytes=1 << 25):
+    """
+    Stream the result of sql to a structured .npy file.
+
+    Parameters
+    ----------
+    ctx: PostmindContext
+        Context the query runs on
+    sql: str
+        Query to run
+    file_name: str
+        Destination .npy file, a temporary file when None (removed once
+        loaded, or once mapped on POSIX systems, where the mapping outlives
+        the file name)
+    mmap: bool
+        Return the result memory-mapped from the file instead of loaded in
+        memory
+    chunk_bytes: int
+        Size of the COPY stream chunks decoded and written at once
+    """
+    temporary = file_name is None
+    if temporary:
+        fd, file_name = tempfile.mkstemp(suffix=".npy", prefix="postmind_")
+        os.close(fd)
+    conn = ctx.con.raw_connection()
+    try:
+        hint = empty_dtype(pgcopy.describe(conn.cursor(), sql))
+        conn.commit()
+    finally:
+        conn.close()
+    writer = NpyWriter(file_name, hint=hint)
+    pgcopy.read_sql_copy(ctx, sql, callback=lambda columns, nrows: writer.append(columns),
+                         chunk_bytes=chunk_bytes)
+    writer.close(hint)
+    if mmap:
+        values = np.load(file_name, mmap_mode="r")
+        if temporary and os.name == "posix":
+            os.remove(file_name)
+        return values
+    values = np.load(file_name)
+    if temporary:
+        os.remove(file_name)
+    return values
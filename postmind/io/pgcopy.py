@@ -0,0 +1,576 @@
+"""
+Client side decoder for ``COPY (...) TO STDOUT (FORMAT binary)`` streams.
+
+Fixed width values (integers, floats, booleans, dates, timestamps and arrays
+of those) are gathered straight from the wire buffer into typed NumPy arrays,
+without building a Python object per row.  Variable width values (text, json,
+...) are decoded one by one.  Types the decoder does not know are cast to text
+on the server.
+"""
+__author__ = 'matthieu'
+
+import struct
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from ..instrument import track
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+# oid -> big-endian wire dtype of fixed width scalar types
+FIXED_TYPES = {
+    16: "?",      # bool
+    20: ">i8",    # int8
+    21: ">i2",    # int2
+    23: ">i4",    # int4
+    26: ">u4",    # oid
+    700: ">f4",   # float4
+    701: ">f8",   # float8
+    1082: ">i4",  # date, days since 2000-01-01
+    1114: ">i8",  # timestamp, microseconds since 2000-01-01
+    1184: ">i8",  # timestamptz, microseconds since 2000-01-01 UTC
+}
+
+# array oid -> element oid
+ARRAY_TYPES = {
+    1000: 16, 1016: 20, 1005: 21, 1007: 23, 1028: 26, 1021: 700, 1022: 701,
+    1182: 1082, 1115: 1114, 1185: 1184,
+}
+
+TEXT_TYPES = set([18, 19, 25, 114, 1042, 1043, 3802])
+UUID_TYPE = 2950
+
+# types cast on the server before being copied out (numeric follows
+# read_sql's coerce_float behaviour)
+CAST_TYPES = {1700: "float8"}
+
+DATE_TYPES = set([1082])
+TIMESTAMP_TYPES = set([1114, 1184])
+
+PG_EPOCH_DAYS = np.datetime64("2000-01-01", "D").astype(np.int64)
+PG_EPOCH_US = np.datetime64("2000-01-01T00:00:00", "us").astype(np.int64)
+NULL_INT = np.iinfo(np.int64).min
+
+# rows checked at once against the fixed layout, and rows parsed one by one
+# at most before trying it again (see BinaryCopyReader._scan)
+MIN_WINDOW = 64
+MAX_WINDOW = 1 << 16
+MAX_BACKOFF = 1024
+
+_int16 = struct.Struct("!h")
+_int32 = struct.Struct("!i")
+
+
+def describe(cursor, sql):
+    """
+    Return the ``(name, type oid)`` of each column returned by ``sql``.
+    """
+    cursor.execute("select * from (%s) q limit 0" % sql.rstrip().rstrip(";"))
+    return [(d[0], d[1]) for d in cursor.description]
+
+
+def copy_statement(sql, fields):
+    """
+    Build the binary ``COPY`` statement for ``sql``, casting the columns the
+    decoder cannot read natively.
+    """
+    sql = sql.rstrip().rstrip(";")
+    if any(not is_native(oid) for _, oid in fields):
+        cols = []
+        for name, oid in fields:
+            qname = '"%s"' % name.replace('"', '""')
+            if is_native(oid):
+                cols.append("q.%s" % qname)
+            else:
+                cols.append("q.%s::%s as %s" % (qname, CAST_TYPES.get(oid, "text"), qname))
+        sql = "select %s from (%s) q" % (", ".join(cols), sql)
+    return "COPY (%s) TO STDOUT (FORMAT binary)" % sql
+
+
+def is_native(oid):
+    return oid in FIXED_TYPES or oid in ARRAY_TYPES or oid in TEXT_TYPES or oid == UUID_TYPE
+
+
+def wire_oid(oid):
+    """
+    Type oid of a column once it went through ``copy_statement``.
+    """
+    if is_native(oid):
+        return oid
+    return 701 if CAST_TYPES.get(oid) == "float8" else 25
+
+
+class BinaryCopyReader(object):
+    """
+    File-like sink for ``cursor.copy_expert`` decoding a binary COPY stream.
+
+    Bytes are buffered until ``chunk_bytes`` are available, then every
+    complete row of the buffer is decoded into one column chunk.  Chunks are
+    either passed to ``callback(columns, nrows)`` as they are decoded, or kept
+    and assembled by ``to_frame``.
+    """
+
+    def __init__(self, fields, callback=None, chunk_bytes=1 << 25):
+        self.names = [f[0] for f in fields]
+        self.oids = [wire_oid(f[1]) for f in fields]
+        self.callback = callback
+        self.chunk_bytes = chunk_bytes
+        self.nrows = 0
+        self.nbytes = 0
+        self._buf = bytearray()
+        self._header = False
+        self._done = False
+        self._layout = None
+        self._window = MIN_WINDOW
+        self._backoff = 1
+        self._chunks = [[] for _ in self.names]
+
+    def write(self, data):
+        self.nbytes += len(data)
+        self._buf.extend(data)
+        if len(self._buf) >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        buf = self._buf
+        pos = 0
+        if not self._header:
+            if len(buf) < len(SIGNATURE) + 8:
+                return
+            if bytes(buf[:len(SIGNATURE)]) != SIGNATURE:
+                raise Exception("Not a binary COPY stream")
+            ext = _int32.unpack_from(buf, len(SIGNATURE) + 4)[0]
+            pos = len(SIGNATURE) + 8 + ext
+            self._header = True
+        offsets, lengths, pos = self._scan(buf, pos)
+        if len(offsets):
+            self._emit(self._gather(buf, offsets, lengths))
+        del buf[:pos]
+
+    def close(self):
+        self.flush()
+        if not self._done:
+            raise Exception("Truncated binary COPY stream")
+
+    def _scan(self, buf, pos):
+        """
+        Locate the fields of every complete row in ``buf[pos:]``.
+
+        Rows matching the fixed layout are located by windows of at most
+        ``_window`` rows, the window doubling while every row matches. After
+        a row that does not match, the next ``_backoff`` rows are parsed one
+        by one before the fixed layout is tried again, the backoff doubling
+        while the attempts fail, so a column with scattered NULLs costs a
+        bounded number of vectorized checks per row.
+
+        Returns the (nrows, nfields) offset and length arrays and the position
+        after the last complete row.
+        """
+        nf = len(self.names)
+        offsets = []
+        lengths = []
+        end = len(buf)
+        skip = 0
+        while pos + 2 <= end and not self._done:
+            if self._layout and skip == 0:
+                offs, lens, pos = self._scan_fixed(buf, pos, self._window)
+                if len(offs):
+                    offsets.append(offs)
+                    lengths.append(lens)
+                    full = len(offs) == self._window
+                    self._window = min(2 * self._window, MAX_WINDOW) if full else MIN_WINDOW
+                    self._backoff = 1
+                    continue
+                skip = self._backoff
+                self._backoff = min(2 * self._backoff, MAX_BACKOFF)
+            row_offs = []
+            row_lens = []
+            n = _int16.unpack_from(buf, pos)[0]
+            if n == -1:
+                self._done = True
+                pos += 2
+                break
+            if n != nf:
+                raise Exception("Unexpected field count %d (expected %d)" % (n, nf))
+            p = pos + 2
+            for _ in range(nf):
+                if p + 4 > end:
+                    break
+                ln = _int32.unpack_from(buf, p)[0]
+                p += 4
+                row_offs.append(p)
+                row_lens.append(ln)
+                if ln > 0:
+                    p += ln
+            if len(row_offs) < nf or p > end:
+                break
+            offsets.append(np.array([row_offs], dtype=np.int64))
+            lengths.append(np.array([row_lens], dtype=np.int32))
+            if self._layout is None:
+                self._layout = self._fixed_layout(row_lens)
+            skip = max(0, skip - 1)
+            pos = p
+        if not offsets:
+            return np.empty((0, nf), np.int64), np.empty((0, nf), np.int32), pos
+        return np.concatenate(offsets), np.concatenate(lengths), pos
+
+    def _fixed_layout(self, row_lens):
+        """
+        Record the row layout when every field of the first row has a fixed
+        width, so following rows can be located without a Python loop.
+        Returns False when the rows have to be scanned one by one.
+        """
+        for oid, ln in zip(self.oids, row_lens):
+            if ln < 0 or not (oid in FIXED_TYPES or oid in ARRAY_TYPES):
+                return False
+        names = ["n"]
+        formats = [">i2"]
+        offsets = [0]
+        field_offsets = []
+        p = 2
+        for k, ln in enumerate(row_lens):
+            names.append("l%d" % k)
+            formats.append(">i4")
+            offsets.append(p)
+            field_offsets.append(p + 4)
+            p += 4 + ln
+        dtype = np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": p})
+        return dtype, np.array(field_offsets, dtype=np.int64), np.array(row_lens, dtype=np.int32)
+
+    def _scan_fixed(self, buf, pos, window):
+        """
+        Locate the rows matching the fixed layout among the next window rows
+        of ``buf[pos:]``.
+        """
+        if not self._layout:
+            return (), (), pos
+        dtype, field_offsets, row_lens = self._layout
+        stride = dtype.itemsize
+        nrows = min(window, (len(buf) - pos) // stride)
+        if nrows == 0:
+            return (), (), pos
+        view = np.ndarray((nrows,), dtype=dtype, buffer=buf, offset=pos)
+        valid = view["n"] == len(self.names)
+        for k in range(len(row_lens)):
+            valid &= view["l%d" % k] == row_lens[k]
+        if not valid.all():
+            nrows = int(np.argmin(valid))
+            if nrows == 0:
+                return (), (), pos
+        starts = pos + np.arange(nrows, dtype=np.int64) * stride
+        offs = starts[:, None] + field_offsets[None, :]
+        lens = np.repeat(row_lens[None, :], nrows, axis=0)
+        return offs, lens, pos + nrows * stride
+
+    def _gather(self, buf, offsets, lengths):
+        u8 = np.frombuffer(buf, dtype=np.uint8)
+        columns = []
+        for k, oid in enumerate(self.oids):
+            offs = offsets[:, k]
+            lens = lengths[:, k]
+            if oid in FIXED_TYPES:
+                columns.append(_gather_fixed(u8, offs, lens, oid))
+            elif oid in ARRAY_TYPES:
+                columns.append(_gather_array(buf, u8, offs, lens, ARRAY_TYPES[oid]))
+            else:
+                columns.append(np.array([_decode_value(buf, o, l, oid) for o, l in zip(offs, lens)],
+                                        dtype=object))
+        return columns
+
+    def _emit(self, columns):
+        nrows = len(columns[0]) if columns else 0
+        self.nrows += nrows
+        if self.callback is not None:
+            self.callback(OrderedDict(zip(self.names, columns)), nrows)
+        else:
+            for chunks, col in zip(self._chunks, columns):
+                chunks.append(col)
+
+    def columns(self):
+        """
+        Concatenate the decoded chunks of each column.
+        """
+        return OrderedDict((name, concat_chunks(chunks, oid))
+                           for name, oid, chunks in zip(self.names, self.oids, self._chunks))
+
+    def to_frame(self):
+        return to_frame(self.columns(), self.oids)
+
+
+def concat_chunks(chunks, oid=None):
+    if not chunks:
+        if oid in FIXED_TYPES:
+            return finalize_fixed(np.empty(0, dtype=np.dtype(FIXED_TYPES[oid]).newbyteorder("=")), oid)
+        return np.empty(0, dtype=object)
+    if any(c.ndim != chunks[0].ndim for c in chunks) or \
+            (chunks[0].ndim > 1 and any(c.shape[1:] != chunks[0].shape[1:] for c in chunks)):
+        chunks = [rows_to_object(c) for c in chunks]
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
+
+
+def rows_to_object(values):
+    """
+    One-dimensional object array holding a view on each row of ``values``.
+    """
+    if values.ndim == 1:
+        return values
+    out = np.empty(len(values), dtype=object)
+    for i in range(len(values)):
+        out[i] = values[i]
+    return out
+
+
+def to_frame(columns, oids):
+    data = OrderedDict()
+    for (name, values), oid in zip(columns.items(), oids):
+        if values.ndim > 1:
+            values = rows_to_object(values)
+        series = pd.Series(values)
+        if oid == 1184 and values.dtype.kind == "M":
+            series = series.dt.tz_localize("UTC")
+        data[name] = series
+    return pd.DataFrame(data, columns=list(columns.keys()))
+
+
+def _gather_bytes(u8, offs, size):
+    out = np.empty((len(offs), size), dtype=np.uint8)
+    for j in range(size):
+        out[:, j] = u8[offs + j]
+    return out
+
+
+def finalize_fixed(raw, oid):
+    """
+    Convert raw wire values (with ``NULL_INT`` marking NULL dates and
+    timestamps) to their NumPy representation.
+    """
+    if oid in DATE_TYPES:
+        raw = raw.astype(np.int64)
+        out = np.where(raw == NULL_INT, NULL_INT, raw + PG_EPOCH_DAYS)
+        return out.astype("datetime64[D]")
+    if oid in TIMESTAMP_TYPES:
+        raw = raw.astype(np.int64)
+        out = np.where(raw == NULL_INT, NULL_INT, raw + PG_EPOCH_US)
+        return out.astype("datetime64[us]")
+    return raw
+
+
+def _gather_fixed(u8, offs, lens, oid):
+    dtype = np.dtype(FIXED_TYPES[oid])
+    native = dtype.newbyteorder("=")
+    valid = lens == dtype.itemsize
+    raw = _gather_bytes(u8, offs[valid], dtype.itemsize).view(dtype).ravel().astype(native)
+    if valid.all():
+        return finalize_fixed(raw, oid)
+    if oid in DATE_TYPES or oid in TIMESTAMP_TYPES:
+        out = np.empty(len(offs), dtype=np.int64)
+        out[:] = NULL_INT
+    elif oid == 16:
+        out = np.empty(len(offs), dtype=object)
+        out[:] = None
+    else:
+        out = np.empty(len(offs), dtype=np.float64)
+        out[:] = np.nan
+    out[valid] = raw
+    return finalize_fixed(out, oid)
+
+
+def _gather_array(buf, u8, offs, lens, elem_oid):
+    """
+    Gather an array column into a (nrows, dim1, ...) array when every row
+    shares the dimensions of the first one and has no NULL element; the
+    remaining rows are decoded one by one into an object column.
+    """
+    n = len(offs)
+    dtype = np.dtype(FIXED_TYPES[elem_oid])
+    native = dtype.newbyteorder("=")
+    present = np.nonzero(lens > 0)[0]
+    if len(present) == 0:
+        return _object_column(buf, offs, lens, None, elem_oid)
+    first = int(offs[present[0]])
+    ndim = _int32.unpack_from(buf, first)[0]
+    hsize = 12 + 8 * ndim
+    header = np.frombuffer(bytes(buf[first:first + hsize]), dtype=">i4")
+    dims = tuple(int(d) for d in header[3::2])
+    nelem = int(np.prod(dims)) if ndim else 0
+    step = 4 + dtype.itemsize
+    valid = (lens == hsize + nelem * step) & (header[1] == 0)
+    if valid.any():
+        rows = np.nonzero(valid)[0]
+        hdr = _gather_bytes(u8, offs[rows], hsize).view(">i4")
+        same = (hdr == header[None, :]).all(axis=1)
+        valid[rows[~same]] = False
+    rows = np.nonzero(valid)[0]
+    if nelem == 0 or len(rows) == 0:
+        return _object_column(buf, offs, lens, None, elem_oid)
+    starts = offs[rows][:, None] + hsize + 4 + np.arange(nelem, dtype=np.int64)[None, :] * step
+    raw = np.empty((len(rows), nelem, dtype.itemsize), dtype=np.uint8)
+    for j in range(dtype.itemsize):
+        raw[:, :, j] = u8[starts + j]
+    values = finalize_fixed(raw.view(dtype).reshape((len(rows),) + dims).astype(native), elem_oid)
+    if len(rows) == n:
+        return values
+    out = _object_column(buf, offs, lens, valid, elem_oid)
+    for i, r in enumerate(rows):
+        out[r] = values[i]
+    return out
+
+
+def _object_column(buf, offs, lens, skip, elem_oid):
+    out = np.empty(len(offs), dtype=object)
+    for i in range(len(offs)):
+        if skip is None or not skip[i]:
+            out[i] = _decode_array(buf, offs[i], lens[i], elem_oid)
+    return out
+
+
+def _decode_array(buf, off, ln, elem_oid):
+    off, ln = int(off), int(ln)
+    if ln < 0:
+        return None
+    ndim, _, _ = struct.unpack_from("!iii", buf, off)
+    dims = struct.unpack_from("!" + "ii" * ndim, buf, off + 12)[::2]
+    p = off + 12 + 8 * ndim
+    values = []
+    for _ in range(int(np.prod(dims)) if ndim else 0):
+        el = _int32.unpack_from(buf, p)[0]
+        p += 4
+        values.append(_decode_value(buf, p, el, elem_oid))
+        if el > 0:
+            p += el
+    if any(v is None for v in values):
+        return np.array(values, dtype=object).reshape(dims)
+    return np.array(values, dtype=np.dtype(FIXED_TYPES[elem_oid]).newbyteorder("=")).reshape(dims)
+
+
+def _decode_value(buf, off, ln, oid):
+    off, ln = int(off), int(ln)
+    if ln < 0:
+        return None
+    raw = bytes(buf[off:off + ln])
+    if oid in FIXED_TYPES:
+        value = np.frombuffer(raw, dtype=FIXED_TYPES[oid])[0]
+        if oid in DATE_TYPES or oid in TIMESTAMP_TYPES:
+            return finalize_fixed(np.array([value]), oid)[0]
+        return value
+    if oid == 3802:
+        raw = raw[1:]
+    if oid == UUID_TYPE:
+        return str(uuid.UUID(bytes=raw))
+    return raw.decode("utf-8")
+
+
+def read_sql_copy(ctx, sql, callback=None, chunk_bytes=1 << 25):
+    """
+    Run ``sql`` through a binary COPY and decode the result.
+
+    Parameters
+    ----------
+    ctx: PostmindContext
+        Context the query runs on
+    sql: str
+        Query to run
+    callback: callable
+        When given, called with ``(columns, nrows)`` for each decoded chunk
+        instead of keeping the chunks in the returned reader
+
+    Returns the ``BinaryCopyReader`` that received the stream.
+    """
+    conn = ctx.con.raw_connection()
+    try:
+        with track(ctx, sql, "copy") as query:
+            cursor = conn.cursor()
+            fields = describe(cursor, sql)
+            reader = BinaryCopyReader(fields, callback=callback, chunk_bytes=chunk_bytes)
+            cursor.copy_expert(copy_statement(sql, fields), reader)
+            reader.close()
+            query.rows, query.nbytes = reader.nrows, reader.nbytes
+        conn.commit()
+    finally:
+        conn.close()
+    return reader
+
+
+def iter_sql_copy(ctx, sql, batch_size=10000, chunk_bytes=1 << 22, queue_size=2):
+    """
+    Stream the result of ``sql`` through a binary COPY as DataFrames of at
+    most ``batch_size`` rows.
+
+    The COPY runs in a background thread feeding a bounded queue, so no more
+    than ``queue_size`` decoded chunks are held in memory at once.
+    """
+    import threading
+    try:
+        from queue import Queue
+    except ImportError:
+        from Queue import Queue
+
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    conn = ctx.con.raw_connection()
+    cursor = conn.cursor()
+    fields = describe(cursor, sql)
+
+    def on_chunk(columns, nrows):
+        if stop.is_set():
+            raise Exception("COPY stream closed by the consumer")
+        queue.put(("chunk", columns))
+
+    def run():
+        try:
+            reader = BinaryCopyReader(fields, callback=on_chunk, chunk_bytes=chunk_bytes)
+            cursor.copy_expert(copy_statement(sql, fields), reader)
+            reader.close()
+            queue.put(("end", reader))
+        except Exception as ex:
+            queue.put(("error", ex))
+
+    oids = [wire_oid(f[1]) for f in fields]
+    names = [f[0] for f in fields]
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    with track(ctx, sql, "copy") as query:
+        pending = []
+        npending = 0
+        try:
+            while True:
+                kind, columns = queue.get()
+                if kind == "error":
+                    raise columns
+                if kind == "end":
+                    query.rows, query.nbytes = columns.nrows, columns.nbytes
+                if kind == "chunk":
+                    pending.append(list(columns.values()))
+                    npending += len(pending[-1][0]) if pending[-1] else 0
+                    if npending < batch_size:
+                        continue
+                merged = [concat_chunks([p[k] for p in pending], oid) for k, oid in enumerate(oids)]
+                pending = []
+                npending = len(merged[0]) if merged else 0
+                start = 0
+                while npending - start >= batch_size or (kind == "end" and start < npending):
+                    batch = [m[start:start + batch_size] for m in merged]
+                    start += batch_size
+                    yield to_frame(OrderedDict(zip(names, batch)), oids)
+                if kind == "end":
+                    break
+                if start < npending:
+                    pending = [[m[start:] for m in merged]]
+                    npending -= start
+                else:
+                    npending = 0
+        finally:
+            stop.set()
+            if thread.is_alive():
+                conn.cancel()
+                while thread.is_alive():
+                    while not queue.empty():
+                        queue.get()
+                    thread.join(0.1)
+            conn.close()
@@ -2,8 +2,30 @@ __author__ = 'matthieu'
 
 import pandas as pd
 import numpy as np
+from .chunkcache import read_chunks
 
-def read_csv(file_name, **kwargs):
+def hash_text(txt_df, n_features):
+    """
+    Hashing trick on the text columns of a chunk: each row is the set of
+    its "column=value" features, hashed in a sparse matrix (scipy CSR) of
+    n_features columns.
+    """
+    from sklearn.feature_extraction import FeatureHasher
+
+    hasher = FeatureHasher(n_features=n_features, input_type="string")
+    cols = [(str(name) + "=") + txt_df[name].astype(str) for name in txt_df.columns]
+    if not cols:
+        return hasher.transform([[]] * len(txt_df))
+    return hasher.transform(zip(*[col.values for col in cols]))
+
+def read_csv(file_name, cache=None, hash_features=None, **kwargs):
+    """
+    Iterate over the (numeric features, text features, meta columns)
+    DataFrames of the chunks of a csv file. cache is a ChunkCache (or a
+    cache directory) keeping the parsed chunks for the next reads. With
+    hash_features=n the text features are hashed in a sparse matrix of n
+    columns instead (see hash_text).
+    """
     if 'chunksize' not in kwargs:
         kwargs['chunksize'] = 10000
     if 'meta' in kwargs:
@@ -12,7 +34,7 @@ def read_csv(file_name, **kwargs):
     else:
         meta_cols = None
 #        kwargs["engine"] = "python"
-    frames = pd.read_csv(file_name, **kwargs)
+    frames = read_chunks(file_name, cache=cache, **kwargs)
     num_feature_cols = None
     txt_feature_cols = None
     for df in frames:
@@ -39,6 +61,8 @@ def read_csv(file_name, **kwargs):
         txt_df = df[txt_feature_cols]
         txt_df.fillna("", inplace=True)
         num_df.fillna(0, inplace=True)
+        if hash_features:
+            txt_df = hash_text(txt_df, hash_features)
         if meta_cols != None:
             meta_df = df[meta_cols]
             meta_df.columns = meta_df.columns.map(str.lower)
@@ -0,0 +1,125 @@
+"""
+Materialization of lazy Tables into physical relations.
+
+Table.persist runs the query of a table once into a temporary table, an
+unlogged table or a materialized view and returns a Table reading it. The
+registry of the context keeps one relation per (SQL, kind): persisting an
+identical plan again returns the existing relation, unless a relation it
+reads changed since (see cache.relation_versions) or a statement was run
+through PostmindContext.execute, and every relation is dropped when the
+context is closed. Plans that cannot be versioned (foreign tables,
+volatile functions) are materialized again on each call.
+"""
+__author__ = 'matthieu'
+
+import hashlib
+import logging
+
+import sqlalchemy as sa
+
+from .cache import relation_versions
+from .utils import gen_table_name, qualified_name
+
+logger = logging.getLogger('pom')
+
+KINDS = {
+    "temp": ("CREATE TEMP TABLE", "TABLE"),
+    "unlogged": ("CREATE UNLOGGED TABLE", "TABLE"),
+    "materialized_view": ("CREATE MATERIALIZED VIEW", "MATERIALIZED VIEW"),
+}
+
+
+class Materialization(object):
+    def __init__(self, name, kind, sql, versions):
+        self.name = name
+        self.kind = kind
+        self.sql = sql
+        self.versions = versions
+        self.indexes = set()
+
+
+class MaterializationRegistry(object):
+    """
+    Relations created by Table.persist on a context.
+
+    Unlogged tables are the default: temporary tables only exist in the
+    session that created them, and the statements of the context run on
+    whichever connection of the pool is free, so a later read or the drop
+    may not see them. Use "temp" only with a single connection engine.
+    """
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self._entries = {}
+        # statements run by the registry itself, not counted as writes
+        self._statements = 0
+
+    def key(self, sql, kind):
+        return hashlib.sha1(repr((sql, kind)).encode("utf-8")).hexdigest()
+
+    def persist(self, sql, kind="unlogged", indexes=None, analyze=True):
+        """
+        Name of a relation holding the result of sql, created when no
+        up-to-date relation of that kind exists yet.
+
+        Parameters
+        ----------
+        sql: str
+            Query to materialize
+        kind: str
+            "unlogged", "temp" or "materialized_view"
+        indexes: list
+            Columns to index, one index per item (a column name or a list of
+            column names)
+        analyze: bool
+            Collect the planner statistics of the new relation
+        """
+        if kind not in KINDS:
+            raise Exception("Unknown kind %s, expected one of %s" % (kind, ", ".join(sorted(KINDS))))
+        key = self.key(sql, kind)
+        versions = (self.ctx.writes - self._statements, relation_versions(self.ctx.con, sql))
+        entry = self._entries.get(key)
+        if entry is not None and (versions[1] is None or entry.versions != versions):
+            logger.info("Relations of %s changed, rebuilding it" % entry.name)
+            self._drop(entry)
+            entry = None
+        if entry is None:
+            entry = Materialization(gen_table_name("persist_"), kind, sql, versions)
+            self._execute("%s %s AS %s" % (KINDS[kind][0], qualified_name(entry.name), sql))
+            self._entries[key] = entry
+            created = True
+        else:
+            created = False
+        for columns in indexes or []:
+            columns = (columns,) if isinstance(columns, basestring) else tuple(columns)
+            if columns not in entry.indexes:
+                self._execute("CREATE INDEX ON %s (%s)" % (qualified_name(entry.name),
+                                                           ", ".join(qualified_name(c) for c in columns)))
+                entry.indexes.add(columns)
+                created = True
+        if analyze and created:
+            self._execute("ANALYZE %s" % qualified_name(entry.name))
+        return entry.name
+
+    def names(self):
+        return [entry.name for entry in self._entries.values()]
+
+    def drop(self, name=None):
+        """
+        Drop the relation name, or all the relations of the registry.
+        """
+        for key, entry in list(self._entries.items()):
+            if name is None or entry.name == name:
+                self._drop(entry)
+                del self._entries[key]
+
+    def _execute(self, statement):
+        # ANALYZE is not detected as a write by SQLAlchemy: without an
+        # explicit autocommit it is rolled back with its statistics
+        self._statements += 1
+        return self.ctx.execute(sa.text(statement.replace(":", "\\:")).execution_options(autocommit=True))
+
+    def _drop(self, entry):
+        try:
+            self._execute("DROP %s IF EXISTS %s" % (KINDS[entry.kind][1], qualified_name(entry.name)))
+        except Exception as ex:
+            logger.warning("Cannot drop %s: %s" % (entry.name, ex))
@@ -0,0 +1,58 @@
+"""
+PostgreSQL array literals of the rows of 2d NumPy arrays.
+
+The string work is done by block of rows instead of row by row: one repr of
+the nested list of the block values (ints when the values are integral),
+and text rows are joined and escaped as whole strings. Sparse matrices are densified one
+block of rows at a time.
+"""
+__author__ = 'matthieu'
+
+import numpy as np
+
+# number of values converted at once
+BLOCK_VALUES = 1 << 16
+
+
+def float_array_literals(values):
+    """
+    '{...}' float8[] literal of each row of the 2d array (or scipy sparse
+    matrix) values.
+    """
+    sparse = hasattr(values, "tocsr")
+    values = values.tocsr() if sparse else np.asarray(values, dtype=float)
+    rows, width = values.shape
+    block = max(1, BLOCK_VALUES // max(1, width))
+    literals = []
+    for start in range(0, rows, block):
+        part = values[start:start + block]
+        if sparse:
+            part = part.toarray().astype(float)
+        if part.size and np.isfinite(part).all() and (part == np.trunc(part)).all() \
+                and np.abs(part).max() < 2 ** 53:
+            # integral values: the repr of a nested list of ints is much
+            # cheaper than float formatting
+            buf = repr(part.astype(np.int64).tolist()).replace("L", "")
+        else:
+            # repr is the shortest string read back to the same float
+            buf = repr(part.tolist())
+        buf = buf[1:-1].replace("], [", "]\0[").replace("[", "{").replace("]", "}")
+        literals.extend(buf.split("\0"))
+    return literals
+
+
+def text_array_literals(values):
+    """
+    '{"...", ...}' text[] literal of each row of the 2d array values.
+    """
+    literals = []
+    for row in np.asarray(values, dtype=object).tolist():
+        try:
+            # PostgreSQL text cannot contain a NUL byte
+            buf = "\0".join(row)
+        except TypeError:
+            buf = "\0".join(v if isinstance(v, basestring) else str(v) for v in row)
+        if "\\" in buf or '"' in buf:
+            buf = buf.replace("\\", "\\\\").replace('"', '\\"')
+        literals.append('{"' + buf.replace("\0", '","') + '"}' if row else "{}")
+    return literals
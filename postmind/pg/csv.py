@@ -1,6 +1,123 @@
+from __future__ import absolute_import
 __author__ = 'matthieu'
 
-def mount_csv(in_file_name, out_table_name, sep=";", header=True, column_types = None, **kwargs):
+import re
+
+INT_RE = re.compile(r"^[+-]?\d+$")
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+TIMESTAMP_RE = re.compile(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?$")
+BOOLEANS = set(["true", "false", "t", "f"])
+
+# candidate types, from the most to the least specific
+TYPES = ["boolean", "bigint", "double precision", "date", "timestamp", "text"]
+
+
+def value_types(value):
+    """
+    Types value can be parsed as.
+    """
+    types = set(["text"])
+    v = value.strip().lower()
+    if v in BOOLEANS:
+        types.add("boolean")
+    if INT_RE.match(v) and -2**63 <= int(v) < 2**63:
+        types.add("bigint")
+    try:
+        float(v)
+        types.add("double precision")
+    except ValueError:
+        pass
+    if DATE_RE.match(v):
+        types.add("date")
+        types.add("timestamp")
+    elif TIMESTAMP_RE.match(v):
+        types.add("timestamp")
+    return types
+
+
+def open_csv(in_file_name, sep=",", offset=0):
+    """
+    csv reader over a file from the byte offset.
+    """
+    import csv
+    import io
+    import sys
+    if sys.version_info[0] < 3:
+        fp = open(in_file_name, "rb")
+    else:
+        fp = io.open(in_file_name, "r", encoding="utf-8", newline="")
+    fp.seek(offset)
+    return fp, csv.reader(fp, delimiter=str(sep or "\x00"))
+
+
+def read_header(in_file_name, sep=",", header=True):
+    """
+    Column names of a csv file and the byte offset of its first data line.
+    """
+    with open(in_file_name, "rb") as fp:
+        fp.readline()
+        offset = fp.tell()
+    fp, reader = open_csv(in_file_name, sep)
+    with fp:
+        columns = next(reader) if sep != None else ["value"]
+    if header == False:
+        columns = ["COL%d" %d for d in range(len(columns))]
+        offset = 0
+    elif type(header) == list:
+        columns = header
+        offset = 0
+    return [c.lower() for c in columns], offset
+
+
+def infer_types(in_file_name, sep=",", header=True, infer_limit=1000):
+    """
+    PostgreSQL type of each column of a csv file, inferred from its first
+    infer_limit lines. Empty values (NULL for COPY) are ignored.
+    """
+    columns, offset = read_header(in_file_name, sep, header)
+    candidates = [set(TYPES) for _ in columns]
+    fp, reader = open_csv(in_file_name, sep, offset)
+    with fp:
+        for i, row in enumerate(reader):
+            if i >= infer_limit:
+                break
+            for c, value in enumerate(row[:len(columns)]):
+                if value != "":
+                    candidates[c] &= value_types(value)
+    return columns, [[t for t in TYPES if t in cand][0] for cand in candidates]
+
+
+def split_lines(in_file_name, chunks, start=0):
+    """
+    (offset, length) of chunks byte ranges of a file, starting at start and
+    cut on line boundaries (quoted values must not contain new lines).
+    """
+    import os
+    size = os.path.getsize(in_file_name)
+    bounds = [start]
+    with open(in_file_name, "rb") as fp:
+        for i in range(1, chunks):
+            fp.seek(max(start + (size - start) * i // chunks - 1, bounds[-1]))
+            fp.readline()
+            pos = fp.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(a, b - a) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def csv_layout(in_file_name, sep=",", header=True, infer_limit=1000, chunks=4):
+    """
+    Columns, inferred types and line aligned byte ranges of a csv file.
+    """
+    import json
+    columns, types = infer_types(in_file_name, sep, header, infer_limit)
+    _, offset = read_header(in_file_name, sep, header)
+    return [json.dumps({"columns": columns, "types": types,
+                        "chunks": split_lines(in_file_name, chunks, offset)})]
+
+
+def mount_csv(in_file_name, out_table_name, sep=";", header=True, column_types = None, infer_limit=None, **kwargs):
     import plpy
 
     if sep != None:
@@ -14,6 +131,8 @@ def mount_csv(in_file_name, out_table_name, sep=";", header=True, column_types =
         columns = header
         header = False
     columns = map(lambda x: x.lower(), columns)
+    if not column_types and infer_limit:
+        column_types = infer_types(in_file_name, sep, header, infer_limit)[1]
     if not column_types:
         column_types = ["text"] * len(columns)
     try:
@@ -4,9 +4,57 @@ from multicorn import ForeignDataWrapper
 from sklearn.feature_extraction import FeatureHasher
 import pandas as pd
 import numpy as np
+import operator
 import logging
 import json
 import sys
+import os
+
+from postmind.io.chunkcache import ChunkCache, read_chunks
+from postmind.io.reader import hash_text
+from postmind.pg.arrays import float_array_literals, text_array_literals
+
+QUAL_OPERATORS = {
+    "=": operator.eq,
+    "<>": operator.ne,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+# operators evaluated on text columns: PostgreSQL orders text with the column
+# collation, not by code point
+TEXT_OPERATORS = ("=", "<>", "!=", "in")
+# operators evaluated on float columns: equality depends on the precision of
+# the pandas float parser
+FLOAT_OPERATORS = ("<", ">", "<=", ">=")
+
+# planner selectivity of the quals that cannot use a distinct count
+RANGE_SELECTIVITY = 1. / 3
+
+# statistics of the files read by the wrappers of this backend, keyed by
+# path, size, mtime and reader options
+_file_stats = {}
+
+
+def classify(df, meta_cols):
+    """
+    Split the columns of a chunk in numeric and text feature columns.
+    """
+    num_feature_cols = []
+    txt_feature_cols = []
+    for col in range(len(df.columns)):
+        tp = df.dtypes[col]
+        name = df.columns[col]
+        if meta_cols is not None and name in meta_cols:
+            continue
+        if tp in [np.float64, np.int, np.bool]:
+            num_feature_cols.append(name)
+        else:
+            txt_feature_cols.append(name)
+    return num_feature_cols, txt_feature_cols
 
 
 class PandasFDW(ForeignDataWrapper):
@@ -24,18 +72,156 @@ class PandasFDW(ForeignDataWrapper):
         self.logger.setLevel(logging.INFO)
         self.logger.info("PandasFDW options %s" %self.options)
 
+    def args(self):
+        return json.loads(self.options.get("args", "{}"))
+
+    def hash_features(self):
+        """
+        Width of the hashed text features (hash_features option): the txt
+        column is then a float4[] of that width instead of a text[].
+        """
+        return int(self.options.get("hash_features", 0))
+
+    def chunk_cache(self):
+        """
+        Cache of the parsed chunks of the file, enabled by the cache_dir
+        option (cache_size: size limit in bytes, 4GB by default).
+        """
+        if "cache_dir" not in self.options:
+            return None
+        return ChunkCache(self.options["cache_dir"], int(self.options.get("cache_size", 1 << 32)))
+
+    def file_stats(self, args):
+        """
+        Columns split, row count and distinct counts of the file, computed
+        from its first chunk and cached until the file changes.
+        """
+        path = self.options["path"]
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime, json.dumps(args, sort_keys=True))
+        if key in _file_stats:
+            return _file_stats[key]
+        kwargs = dict(args)
+        meta_cols = kwargs.pop("meta", None)
+        nrows = kwargs.pop("chunksize", 100000)
+        df = pd.read_csv(path, nrows=nrows, **kwargs)
+        num_cols, txt_cols = classify(df, meta_cols)
+        with open(path, "rb") as fp:
+            lines = fp.readlines(1 << 20)
+        line_bytes = max(1., float(sum(len(l) for l in lines)) / max(1, len(lines)))
+        rows = len(df) if len(df) < nrows else int(st.st_size / line_bytes)
+        ndistinct = {}
+        for col in meta_cols or []:
+            n = df[col].nunique()
+            ndistinct[col.lower()] = rows if n >= len(df) else max(1, n)
+        txt_width = df[txt_cols].astype(str).apply(lambda s: s.str.len()).values.mean() if txt_cols and len(df) else 0
+        stats = {"meta": meta_cols or [], "num": num_cols, "txt": txt_cols, "rows": rows,
+                 "ndistinct": ndistinct, "txt_width": float(txt_width or 0)}
+        _file_stats[key] = stats
+        return stats
+
+    def get_rel_size(self, quals, columns):
+        stats = self.file_stats(self.args())
+        rows = float(stats["rows"])
+        for qual in quals:
+            if qual.operator == "=" and qual.field_name in stats["ndistinct"]:
+                rows /= stats["ndistinct"][qual.field_name]
+            else:
+                rows *= RANGE_SELECTIVITY
+        width = 0
+        for col in columns:
+            if col == "num":
+                width += 8 * len(stats["num"])
+            elif col == "txt" and self.hash_features():
+                width += 4 * self.hash_features()
+            elif col == "txt":
+                width += int(stats["txt_width"] + 4) * len(stats["txt"])
+            else:
+                width += 16
+        return (max(1, int(rows)), max(1, width))
+
+    def get_path_keys(self):
+        stats = self.file_stats(self.args())
+        return [((col,), max(1, stats["rows"] // n)) for col, n in stats["ndistinct"].items()]
+
+    def filters(self, quals, stats):
+        """
+        Vectorized filters for the quals on meta columns. Quals whose value
+        does not match the column values type, and the quals mask cannot
+        evaluate like PostgreSQL (see TEXT_OPERATORS and FLOAT_OPERATORS),
+        are left to PostgreSQL, which checks every qual again.
+        """
+        meta = dict((col.lower(), col) for col in stats["meta"])
+        filters = []
+        for qual in quals:
+            if qual.field_name not in meta:
+                continue
+            if isinstance(qual.operator, tuple):
+                if qual.operator == ("=", True):
+                    filters.append((meta[qual.field_name], "in", list(qual.value)))
+            elif qual.operator in QUAL_OPERATORS and qual.value is not None:
+                filters.append((meta[qual.field_name], qual.operator, qual.value))
+        return filters
+
+    def mask(self, df, filters):
+        mask = np.ones(len(df), dtype=bool)
+        for col, op, value in filters:
+            values = df[col]
+            sample = value[0] if op == "in" and value else value
+            numeric = isinstance(sample, (int, long, float)) and not isinstance(sample, bool)
+            if values.dtype.kind in "iuf" and not numeric:
+                continue
+            if values.dtype.kind == "O" and not isinstance(sample, basestring):
+                continue
+            if values.dtype.kind not in "iufO":
+                continue
+            if values.dtype.kind == "O" and op not in TEXT_OPERATORS:
+                continue
+            if (values.dtype.kind == "f" or isinstance(sample, float)) and op not in FLOAT_OPERATORS:
+                continue
+            if op == "in":
+                mask &= values.isin(value).values
+            else:
+                mask &= QUAL_OPERATORS[op](values, value).values
+        return mask
+
     def execute(self, quals, columns):
         import pandas as pd
 
-        args = json.loads(self.options.get("args", "{}"))
-        for X_num, X_hash, X_meta in self.read_csv(self.options["path"], **args):
-            for num, txt, meta in zip(X_num.values, X_hash.values, X_meta.to_dict("records")):
-                rec = meta
-                rec["num"] = '{%s}' %str(num.astype(float).tolist())[1:-1]
-                rec["txt"] = '{%s}' %(str(txt.tolist())[1:-1])
+        args = self.args()
+        stats = self.file_stats(args)
+        filters = self.filters(quals, stats)
+        meta = [col for col in stats["meta"] if col.lower() in columns]
+        num = stats["num"] if "num" in columns else []
+        txt = stats["txt"] if "txt" in columns else []
+        usecols = set(meta + num + txt + [col for col, _, _ in filters])
+        if not usecols:
+            usecols = set((stats["meta"] + stats["num"] + stats["txt"])[:1])
+        args["meta"] = meta
+        args["usecols"] = lambda col: col in usecols
+        hash_features = self.hash_features()
+        for X_num, X_hash, X_meta in self.read_csv(self.options["path"], num_cols=num, txt_cols=txt,
+                                                         filters=filters, hash_features=hash_features,
+                                                         **args):
+            if X_meta is not None and len(X_meta.columns):
+                metas = X_meta.to_dict("records")
+            else:
+                metas = [{} for _ in range(len(X_num))]
+            nums = float_array_literals(X_num.values) if num else None
+            if not txt:
+                txts = None
+            elif hash_features:
+                txts = float_array_literals(X_hash)
+            else:
+                txts = text_array_literals(X_hash.values)
+            for i, rec in enumerate(metas):
+                if num:
+                    rec["num"] = nums[i]
+                if txt:
+                    rec["txt"] = txts[i]
                 yield rec
 
-    def read_csv(self, file_name, **kwargs):
+    def read_csv(self, file_name, num_cols=None, txt_cols=None, filters=None, hash_features=None, **kwargs):
         import IPython
         if 'chunksize' not in kwargs:
             kwargs['chunksize'] = 100000
@@ -46,22 +232,12 @@ class PandasFDW(ForeignDataWrapper):
             meta_cols = None
 #        kwargs["engine"] = "python"
         self.logger.info("read_csv options %s %s" %(file_name, str(kwargs)))
-        frames = pd.read_csv(file_name, **kwargs)
-        num_feature_cols = None
-        txt_feature_cols = None
+        frames = read_chunks(file_name, cache=self.chunk_cache(), **kwargs)
+        num_feature_cols = num_cols
+        txt_feature_cols = txt_cols
         for df in frames:
             if num_feature_cols == None:
-                num_feature_cols = []
-                txt_feature_cols = []
-                for col in range(len(df.columns)):
-                    tp = df.dtypes[col]
-                    name = df.columns[col]
-                    if name in meta_cols:
-                        continue
-                    if tp in [np.float64, np.int, np.bool]:
-                        num_feature_cols.append(name)
-                    else:
-                        txt_feature_cols.append(name)
+                num_feature_cols, txt_feature_cols = classify(df, meta_cols)
                 print "# columns", [(i, j) for (i, j) in enumerate(df.columns)]
                 print ""
                 print "Numeric features", num_feature_cols
@@ -69,10 +245,14 @@ class PandasFDW(ForeignDataWrapper):
                 print "Text features", txt_feature_cols
                 print ""
                 print "Meta cols", meta_cols
+            if filters:
+                df = df[self.mask(df, filters)]
             num_df = df[num_feature_cols]
             txt_df = df[txt_feature_cols]
             txt_df.fillna("", inplace=True)
             num_df.fillna(0, inplace=True)
+            if hash_features:
+                txt_df = hash_text(txt_df, hash_features)
             if meta_cols != None:
                 meta_df = df[meta_cols]
                 meta_df.columns = meta_df.columns.map(str.lower)
@@ -1,14 +1,161 @@
 __author__ = 'matthieu'
 
-def store_h5(query, name, file_name):
+H5_BATCH_SIZE = 100000
+
+
+def explain_rows(plan):
+    """
+    Row estimate of the top node of an EXPLAIN (FORMAT JSON) output.
+    """
+    import json
+
+    if not isinstance(plan, (list, dict)):
+        plan = json.loads(plan)
+    if isinstance(plan, list):
+        plan = plan[0]
+    return int(plan["Plan"]["Plan Rows"])
+
+
+def h5_query(query, fields):
+    """
+    Query reading the columns of query as types a HDF5 table stores, the
+    names of its string columns and of its date columns, and the initial
+    width of the string columns.
+
+    fields are the (name, type name, type category, length) of the columns
+    of query, length being the declared length of char / varchar columns
+    (None otherwise): numeric and money columns are read as float8, date and
+    timestamp columns as microseconds since the epoch (UTC for timestamptz,
+    infinite values as NULL; append_h5 stores them as datetime64), the
+    other non numeric and non boolean columns as text, sized with their
+    declared length when they have one. Array columns are rejected.
+    """
+    cols, strings, dates, widths = [], [], [], {}
+    for name, typname, category, length in fields:
+        qname = '"%s"' % name.replace('"', '""')
+        if category == "A":
+            raise Exception("Cannot store the array column %s in a HDF5 table" % name)
+        if typname in ("numeric", "money"):
+            cols.append("q.%s::numeric::float8 as %s" % (qname, qname))
+        elif category in ("N", "B"):
+            cols.append("q.%s" % qname)
+        elif category == "D":
+            cols.append("case when isfinite(q.%s) then (extract(epoch from q.%s) * 1000000)::int8 end as %s"
+                        % (qname, qname, qname))
+            dates.append(name)
+        else:
+            cols.append("q.%s::text as %s" % (qname, qname))
+            strings.append(name)
+            if length:
+                widths[name] = length
+    return "select %s from (%s) q" % (", ".join(cols), query), strings, dates, widths
+
+
+def append_h5(file_name, name, batches, expectedrows, min_itemsize=None, complevel=3, complib="blosc",
+              strings=None, dates=None, nan_rep="nan"):
+    """
+    Write the DataFrames of batches to the table name of a HDF5 file, one
+    append per batch.
+
+    strings are the string columns (by default the object columns of the
+    first batch); their NULLs are stored as nan_rep. dates are columns of
+    microseconds since the epoch, stored as datetime64. min_itemsize (int
+    for every string column, or dict) gives the initial width of the
+    string columns, the other ones starting at twice the longest value of
+    the first batch. A batch with a longer value rewrites the table with at
+    least twice the width (see widen_h5). The table index is built once
+    all the batches are written.
+    """
+    import sys
+    import pandas as pd
+
+    with pd.HDFStore(file_name, "a", complevel=complevel, complib=complib) as store:
+        if name in store:
+            store.remove(name)
+        sizes = None
+        for df in batches:
+            if strings is None:
+                strings = [col for col in df.columns if df[col].dtype == object]
+            for col in dates or []:
+                df[col] = pd.to_datetime(df[col].astype(float), unit="us")
+            for col in strings:
+                values = df[col].astype(object)
+                df[col] = values.where(values.notnull(), nan_rep)
+                if sys.version_info[0] == 2:
+                    # PyTables only stores byte strings under Python 2
+                    df[col] = [v.encode("utf-8") if isinstance(v, unicode) else v for v in df[col]]
+            longest = dict((col, int(df[col].str.len().max()) if len(df) else 0) for col in strings)
+            if sizes is None:
+                if isinstance(min_itemsize, dict):
+                    sizes = dict((col, w) for col, w in min_itemsize.items())
+                elif min_itemsize is not None:
+                    sizes = dict((col, min_itemsize) for col in strings)
+                else:
+                    sizes = {}
+                for col in strings:
+                    sizes[col] = max(sizes.get(col) or 2 * longest[col], len(nan_rep), 1)
+            wider = [col for col in strings if longest[col] > sizes[col]]
+            if wider:
+                for col in wider:
+                    sizes[col] = max(2 * sizes[col], longest[col])
+                widen_h5(store, name, sizes, nan_rep, expectedrows)
+            store.append(name, df, format="table", min_itemsize=sizes or None, nan_rep=nan_rep,
+                         expectedrows=expectedrows, index=False)
+        if sizes is not None:
+            store.create_table_index(name)
+
+
+def widen_h5(store, name, sizes, nan_rep, expectedrows, chunksize=H5_BATCH_SIZE):
+    """
+    Rewrite the table name of store with the string column widths sizes.
+    """
+    if name not in store:
+        return
+    tmp = name.strip("/") + "_pm_widen"
+    if tmp in store:
+        store.remove(tmp)
+    for df in store.select(name, chunksize=chunksize):
+        store.append(tmp, df, format="table", min_itemsize=sizes, nan_rep=nan_rep, expectedrows=expectedrows,
+                     index=False)
+    store.remove(name)
+    store.get_node(tmp)._f_rename(name.strip("/").split("/")[-1])
+
+
+def store_h5(query, name, file_name, batch_size=H5_BATCH_SIZE, min_itemsize=None):
+    """
+    Write the result of query to a HDF5 file from PL/Python, fetching it by
+    batches of batch_size rows through a cursor.
+    """
     import tables
-    import plnumpy
+    import plpy
     import pandas as pd
+    from postmind.pg.ops import append_h5, explain_rows, h5_query
 
-    res = plnumpy.from_table(query)
-    with pd.HDFStore(file_name, "a", complevel=3, complib='blosc') as store:
-        df = pd.DataFrame(res)
-        store.put(name, df, format='table')
+    fields = plpy.execute("select * from (%s) q limit 0" % query)
+    oids = fields.coltypes()
+    types = dict((row["oid"], (row["typname"], row["typcategory"]))
+                 for row in plpy.execute("select oid::int, typname, typcategory from pg_type where oid in (%s)"
+                                         % ", ".join(str(oid) for oid in set(oids))))
+    # char / varchar typmod: declared length + 4
+    lengths = [typmod - 4 if types[oid][1] == "S" and typmod >= 4 else None
+               for oid, typmod in zip(oids, fields.coltypmods())]
+    query, strings, dates, widths = h5_query(query, [(col,) + types[oid] + (length,) for col, oid, length
+                                                     in zip(fields.colnames(), oids, lengths)])
+    if isinstance(min_itemsize, dict):
+        widths.update(min_itemsize)
+    elif min_itemsize is not None:
+        widths = min_itemsize
+
+    def batches():
+        cursor = plpy.cursor(query)
+        while True:
+            rows = cursor.fetch(batch_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(list(rows), columns=rows.colnames())
+
+    expectedrows = explain_rows(plpy.execute("EXPLAIN (FORMAT JSON) %s" % query)[0]["QUERY PLAN"])
+    append_h5(file_name, name, batches(), expectedrows, min_itemsize=widths, strings=strings, dates=dates)
     return [1]
 
 
@@ -20,4 +167,3 @@ def store_bin(query, file_name, compress=3):
     res = plnumpy.from_table(query)
     joblib.dump(res, file_name, compress=compress)
     return [1]
-
@@ -0,0 +1,192 @@
+"""
+Logical plan of a Table.
+
+Table operations record plan nodes instead of wrapping the previous
+selectable in another subquery; SQL is only generated when the plan is
+compiled. Compilation merges a projection / filter into the projection /
+filter below it when the lower one is a plain column selection, and pushes
+limits into the branches of a union.
+"""
+__author__ = 'matthieu'
+
+import sqlalchemy as sa
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import ColumnClause
+
+MERGEABLE_KWARGS = ("whereclause", "limit", "offset", "distinct")
+
+
+class Plan(object):
+    _compiled = None
+
+    def compile(self):
+        """
+        Selectable of the node, built once.
+        """
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled
+
+    def query(self):
+        """
+        Select statement returning the rows of the node.
+        """
+        return as_select(self.compile())
+
+    def limit(self, n):
+        """
+        Select statement returning at most n rows of the node.
+        """
+        q = as_select(self.compile())
+        if has_limit(q):
+            return sa.select(['*']).select_from(q.alias()).limit(n)
+        return q.limit(n)
+
+
+class Relation(Plan):
+    """
+    Leaf of a plan: any selectable (table, select, set operation...).
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def _compile(self):
+        return self.data
+
+    def limit(self, n):
+        if isinstance(self.data, sa.sql.expression.CompoundSelect):
+            return limit_compound(self.data, n)
+        return Plan.limit(self, n)
+
+
+class Project(Plan):
+    """
+    Projection of the columns of a child plan, with an optional filter and
+    ordering (Table.select).
+    """
+    def __init__(self, child, columns, kwargs=None, order_by=None):
+        self.child = child
+        self.columns = columns
+        self.kwargs = kwargs or {}
+        self.order_by = order_by
+        # effective columns / filter / from clause / ordering once merged
+        self.select_columns = None
+        self.whereclause = None
+        self.froms = None
+        self.select_order_by = None
+
+    def _compile(self):
+        self.select_columns = self.columns
+        self.whereclause = self.kwargs.get("whereclause")
+        self.select_order_by = self.order_by
+        q = sa.select(self.columns, **self.kwargs)
+        if self.order_by is not None:
+            q = q.order_by(self.order_by)
+        merged = self._merge()
+        return q if merged is None else merged
+
+    def _merge(self):
+        child = self.child
+        if not isinstance(child, Project) or not child.is_plain():
+            return None
+        if any(key not in MERGEABLE_KWARGS for key in self.kwargs):
+            return None
+        inner = child.compile()
+        # the columns the nodes above reference: inner.c (the columns of an
+        # implicit subquery of inner with SQLAlchemy 1.4), in the order of
+        # the selected expressions
+        exported = list(inner.c)
+        if len(exported) != len(child.select_columns):
+            return None
+        mapping = dict((col, expr) for col, expr in zip(exported, child.select_columns)
+                       if isinstance(expr, ColumnClause))
+        try:
+            columns = [substitute(col, mapping) for col in self.columns]
+            where = substitute(self.kwargs.get("whereclause"), mapping)
+            order_by = substitute(self.order_by, mapping)
+        except NotMergeable:
+            return None
+        if order_by is None and child.select_order_by is not None and \
+                (self.kwargs.get("distinct") or not same_columns(columns, child.select_columns)):
+            # the ordering of the child would apply to an aggregate, DISTINCT
+            # or other columns: keep it in the subquery
+            return None
+        if child.whereclause is not None:
+            where = child.whereclause if where is None else sa.and_(child.whereclause, where)
+        kwargs = dict(self.kwargs)
+        kwargs["whereclause"] = where
+        kwargs["from_obj"] = child.froms if child.froms is not None else inner.froms
+        if order_by is None:
+            order_by = child.select_order_by
+        q = sa.select(columns, **kwargs)
+        if order_by is not None:
+            q = q.order_by(order_by)
+        self.select_columns, self.whereclause, self.select_order_by = columns, where, order_by
+        self.froms = kwargs["from_obj"]
+        return q
+
+    def is_plain(self):
+        """
+        True when the node only selects and filters rows, so its columns and
+        filter can be inlined in the node above.
+        """
+        self.compile()
+        return all(key == "whereclause" for key in self.kwargs)
+
+
+class Union(Plan):
+    def __init__(self, children):
+        self.children = children
+
+    def _compile(self):
+        return sa.union_all(*[as_select(child.compile()) for child in self.children])
+
+    def limit(self, n):
+        branches = [child.limit(n) for child in self.children]
+        return sa.select(['*']).select_from(sa.union_all(*branches).alias()).limit(n)
+
+
+class NotMergeable(Exception):
+    pass
+
+
+def substitute(expr, mapping):
+    """
+    Replace the references to the exported columns of the child in expr by
+    the expressions they select. Columns of any other selectable (another
+    table, an alias) cannot be substituted: merging would add their
+    selectable to the FROM clause.
+    """
+    if expr is None:
+        return None
+    if expr in mapping:
+        return mapping[expr]
+
+    def replace(elem):
+        if isinstance(elem, ColumnClause) and elem.table is not None:
+            if elem not in mapping:
+                raise NotMergeable()
+            return mapping[elem]
+        return None
+    return visitors.replacement_traverse(expr, {}, replace)
+
+
+def same_columns(columns, others):
+    return len(columns) == len(others) and all(a is b for a, b in zip(columns, others))
+
+
+def as_select(data):
+    if isinstance(data, (sa.sql.Select, sa.sql.expression.CompoundSelect)):
+        return data
+    return sa.select([data])
+
+
+def has_limit(q):
+    return q._limit_clause is not None or q._offset_clause is not None
+
+
+def limit_compound(data, n):
+    if data.keyword == sa.sql.expression.CompoundSelect.UNION_ALL and not has_limit(data):
+        branches = [Relation(as_select(s)).limit(n) for s in data.selects]
+        return sa.select(['*']).select_from(sa.union_all(*branches).alias()).limit(n)
+    return sa.select(['*']).select_from(data.alias()).limit(n)
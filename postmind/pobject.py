@@ -1,7 +1,8 @@
 __author__ = 'matthieu'
 from psycopg2.extensions import QuotedString
 
-from pg.ops import store_h5, store_bin
+from pg.ops import store_h5, store_bin, append_h5, explain_rows, h5_query, H5_BATCH_SIZE
+from .profile import column_types
 from .utils import pgapply
 
 class PObject(object):
@@ -15,9 +16,32 @@ class PObject(object):
     def to_sql(self):
         return self.ctx.to_sql(self.data)
 
-    def to_hdf(self, name, file_name):
+    def to_hdf(self, name, file_name, client=False, batch_size=H5_BATCH_SIZE, min_itemsize=None):
+        """
+        Write the result to the table name of a HDF5 file, appended by
+        batches of batch_size rows.
+
+        The file is written by the database server (PL/Python), or by this
+        process with client=True. min_itemsize (int or dict per column) sets
+        the initial width of the string columns, which otherwise start at
+        their declared length (varchar(n)) or at twice the longest value of
+        the first batch and are widened when a batch does not fit (see
+        pg.ops.append_h5). Dates and timestamps are stored as datetime64.
+        """
         sql = self.to_sql()
-        self.ctx.execute(pgapply(self.ctx, store_h5, sql, name, file_name))
+        if not client:
+            self.ctx.execute(pgapply(self.ctx, store_h5, sql, name, file_name, batch_size=batch_size,
+                                     min_itemsize=min_itemsize))
+            return
+
+        plan = self.ctx.execute("EXPLAIN (FORMAT JSON) %s" % sql).fetchall()[0][0]
+        query, strings, dates, widths = h5_query(sql, column_types(self.ctx, sql))
+        if isinstance(min_itemsize, dict):
+            widths.update(min_itemsize)
+        elif min_itemsize is not None:
+            widths = min_itemsize
+        append_h5(file_name, name, self.ctx.iter_sql(query, batch_size=batch_size), explain_rows(plan),
+                  min_itemsize=widths, strings=strings, dates=dates)
 
     def to_bin(self, file_name):
         sql = self.to_sql()
@@ -0,0 +1,234 @@
+"""
+Profile of the columns of a query.
+
+Counts, nulls, extrema, moments and quantiles are computed by the
+database in one aggregate query; the HyperLogLog registers of the distinct
+counts (the "pg" hash of HyperLogLog.from_sql_columns) and the top values
+in one more scan, grouping the values of every column by register and,
+for the top columns, by value (GROUPING SETS).
+
+With stream=True, the quantiles and top values are instead estimated on
+the client: the numeric and top columns are streamed by batches (see
+PostmindContext.iter_sql) into the KLL and Count-Min sketches of the
+sketch module, whose memory is bounded whatever the number of distinct
+values.
+"""
+__author__ = 'matthieu'
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .io.pgcopy import describe
+from .sketch import HyperLogLog, CountMinSketch, KLLSketch
+from .utils import qualified_name
+
+TYPES_QUERY = "select oid, typname, typcategory from pg_type where oid = any(%s)"
+# type categories (pg_type.typcategory) with min / max aggregates
+ORDERED = set(["N", "S", "D", "T"])
+INTEGERS = set(["int2", "int4", "int8", "oid"])
+
+# HyperLogLog registers (rows with b) of every column and the k most
+# frequent values (rows with v) of the columns with a value expression
+REGISTERS_TOP_QUERY = """
+    select i, b, v, n, rho from (
+        select c.i, c.b, c.v, count(*) as n, max(case when c.r = 0 then {q} + 1 else c.r - {p} end) as rho,
+               grouping(c.b) as gb,
+               row_number() over (partition by c.i, grouping(c.b) order by count(*) desc, c.v) as k
+        from (select c.i, c.v, c.h & {mask} as b, position(B'1' in ((c.h >> {p}) & {qmask})::bit(64)) as r
+              from ({query}) as q cross join lateral (values {values}) as c(i, h, v)
+              where c.h is not null) c
+        group by grouping sets ((c.i, c.b), (c.i, c.v))
+    ) s
+    where gb = 0 or (v is not null and k <= {k})
+    order by i, gb, k
+"""
+
+
+def column_types(ctx, sql):
+    """
+    (name, type name, type category, length) of each column of sql, length
+    being the declared length of char / varchar columns (None otherwise).
+    """
+    conn = ctx.con.raw_connection()
+    try:
+        cursor = conn.cursor()
+        fields = describe(cursor, sql)
+        sizes = [d.internal_size for d in cursor.description]
+        cursor.execute(TYPES_QUERY, ([oid for _, oid in fields],))
+        types = dict((oid, (name, category)) for oid, name, category in cursor.fetchall())
+        conn.commit()
+    finally:
+        conn.close()
+    return [(name,) + types[oid] + (size if types[oid][1] == "S" and size > 0 else None,)
+            for (name, oid), size in zip(fields, sizes)]
+
+
+class ColumnProfile(object):
+    def __init__(self, name, typname, category, k=10, quantiles=(), top=True, stream=False, quantile_k=200):
+        self.name = name
+        self.qname = "q.%s" % qualified_name(name)
+        self.typname = typname
+        self.category = category
+        self.k = k if top else 0
+        self.quantiles = list(quantiles) if self.numeric else []
+        self.aggregates = {}
+        self.hll = None
+        self.top = []
+        self.cms = CountMinSketch(k=max(k, 32)) if stream and self.k else None
+        self.kll = KLLSketch(quantile_k) if stream and self.quantiles else None
+
+    @property
+    def numeric(self):
+        return self.category in ("N", "B")
+
+    def expressions(self):
+        """
+        Aggregate expressions of the column, with their names.
+        """
+        exprs = [("count", "count(%s)" % self.qname)]
+        if self.category == "B":
+            exprs += [("min", "bool_and(%s)" % self.qname), ("max", "bool_or(%s)" % self.qname)]
+        elif self.category in ORDERED:
+            exprs += [("min", "min(%s)" % self.qname), ("max", "max(%s)" % self.qname)]
+        if self.numeric:
+            number = self.number()
+            exprs += [("mean", "avg(%s)" % number), ("std", "stddev_samp(%s)" % number)]
+            if self.quantiles and self.kll is None:
+                exprs += [("quantiles", "percentile_cont(array[%s]) within group (order by %s)"
+                           % (", ".join(repr(float(q)) for q in self.quantiles), number))]
+        return exprs
+
+    def number(self):
+        if self.category == "B":
+            return "%s::int::float8" % self.qname
+        if self.typname == "money":
+            return "%s::numeric::float8" % self.qname
+        return "%s::float8" % self.qname
+
+    def values(self, i):
+        """
+        Row of the lateral values of REGISTERS_TOP_QUERY: index, hash and
+        value (text) grouped for the top values.
+        """
+        top = None
+        if self.k and self.cms is None:
+            top = "%s::text" % (self.number() if self.numeric and self.category != "B" else self.qname)
+        return "(%d, hashtextextended(%s::text, 0), %s)" % (i, self.qname, top or "null::text")
+
+    def value(self, text):
+        """
+        Value of the text of a top value.
+        """
+        if self.category == "B":
+            return text == "true"
+        if self.typname in INTEGERS:
+            return int(float(text))
+        if self.numeric:
+            return float(text)
+        return text
+
+    def column(self):
+        """
+        Expression of the column in the streamed query, money being read as
+        a number.
+        """
+        if self.typname == "money":
+            return "%s as %s" % (self.number(), qualified_name(self.name))
+        return self.qname
+
+    @property
+    def streamed(self):
+        return self.kll is not None or self.cms is not None
+
+    def update(self, values):
+        present = values[~pd.isnull(values)]
+        if self.cms is not None:
+            self.cms.update(present)
+        if self.kll is not None and len(present):
+            self.kll.update(present.astype(np.float64))
+
+    def result(self, rows, quantiles):
+        count = int(self.aggregates["count"])
+        row = OrderedDict([
+            ("type", self.typname),
+            ("count", count),
+            ("nulls", rows - count),
+            ("min", self.aggregates.get("min")),
+            ("max", self.aggregates.get("max")),
+            ("mean", self.aggregates.get("mean", np.nan)),
+            ("std", self.aggregates.get("std", np.nan)),
+            ("distinct", self.hll.count()),
+        ])
+        if self.kll is not None:
+            values = self.kll.quantiles(quantiles)
+        else:
+            values = self.aggregates.get("quantiles")
+            values = [np.nan] * len(quantiles) if values is None else values
+        for q, value in zip(quantiles, values):
+            row["q%g" % (100 * q)] = value
+        if self.cms is not None:
+            row["top"] = self.cms.top(self.k)
+        else:
+            row["top"] = self.top if self.k else None
+        return row
+
+
+def profile(ctx, query, k=10, p=14, quantiles=(0.25, 0.5, 0.75), top=None, stream=False, quantile_k=200,
+            batch_size=100000, engine="copy"):
+    """
+    Profile of every column of query, one row per column: type, non null
+    count, nulls, min, max, mean, std (numeric columns), approximate
+    distinct count, quantiles (numeric columns) and top k values with
+    their counts.
+
+    top lists the columns whose top values are computed (all of them by
+    default). The quantiles and top values are exact and computed by the
+    database, which sorts or groups the values of each of those columns;
+    with stream=True they are estimated on the client instead, streaming
+    those columns by batches of batch_size rows into KLL (quantile_k) and
+    Count-Min sketches.
+    """
+    sql = query if isinstance(query, basestring) else ctx.to_sql(query)
+    sql = sql.rstrip().rstrip(";")
+    profiles = [ColumnProfile(name, typname, category, k, quantiles, top is None or name in top, stream, quantile_k)
+                for name, typname, category, _ in column_types(ctx, sql)]
+    exprs = ["count(*) as n_rows"]
+    for i, prof in enumerate(profiles):
+        exprs += ["%s as a%d_%s" % (expr, i, name) for name, expr in prof.expressions()]
+    aggregates = ctx.read_sql("select %s from (%s) q" % (", ".join(exprs), sql)).iloc[0]
+    for i, prof in enumerate(profiles):
+        prof.aggregates = dict((name, aggregates["a%d_%s" % (i, name)]) for name, _ in prof.expressions())
+    if profiles:
+        registers_top(ctx, sql, profiles, p)
+    streamed = [prof for prof in profiles if prof.streamed]
+    if streamed:
+        stream = "select %s from (%s) q" % (", ".join(prof.column() for prof in streamed), sql)
+        for df in ctx.iter_sql(stream, batch_size=batch_size, engine=engine):
+            for col, prof in zip(df.columns, streamed):
+                prof.update(df[col].values)
+    rows = [prof.result(int(aggregates["n_rows"]), quantiles) for prof in profiles]
+    return pd.DataFrame(rows, index=[prof.name for prof in profiles],
+                        columns=list(rows[0].keys()) if rows else None)
+
+
+def registers_top(ctx, sql, profiles, p):
+    """
+    Set the HyperLogLog sketch and the top values of each column profile,
+    in one scan of sql.
+    """
+    q = 64 - p
+    values = ", ".join(prof.values(i) for i, prof in enumerate(profiles))
+    k = max(prof.k for prof in profiles)
+    df = ctx.read_sql(REGISTERS_TOP_QUERY.format(query=sql, values=values, k=k, p=p, q=q, mask=(1 << p) - 1,
+                                                 qmask=(1 << q) - 1))
+    for prof in profiles:
+        prof.hll = HyperLogLog(p, hash="pg")
+    registers = df[df["b"].notnull()]
+    for i, group in registers.groupby("i"):
+        profiles[int(i)].hll.registers[group["b"].values.astype(np.int64)] = group["rho"].values.astype(np.uint8)
+    for i, v, n in df[df["b"].isnull()][["i", "v", "n"]].itertuples(index=False):
+        prof = profiles[int(i)]
+        if len(prof.top) < prof.k:
+            prof.top.append((prof.value(v), int(n)))
@@ -0,0 +1,90 @@
+"""
+Sampling of the rows of a query.
+
+A query reading a single base table (with an optional projection and
+filter) samples the table itself with TABLESAMPLE SYSTEM / BERNOULLI, so
+SYSTEM only reads the sampled blocks. Other queries (unions, aggregates,
+function results...) are sampled in one pass over their rows: a Bernoulli
+filter for a fraction, and ORDER BY random() LIMIT n otherwise, which
+PostgreSQL runs as a bounded top-n heap on the random keys (the
+"reservoir" method; it is not Vitter's algorithm R but draws the same
+uniform sample). n rows of a table sample are drawn the same way from the
+oversampled rows, as the first n rows of the sample would favour the
+first sampled blocks. With a seed the sample is repeatable: REPEATABLE
+(seed) for TABLESAMPLE, and row keys hashed with the seed instead of
+random().
+"""
+__author__ = 'matthieu'
+
+import sqlalchemy as sa
+from sqlalchemy.sql.util import ClauseAdapter
+
+from .plan import has_limit
+from .utils import estimate_rows
+
+METHODS = ("system", "bernoulli", "reservoir")
+
+# margin on the sampled percentage when n rows are requested, as a block
+# sample returns a variable number of rows
+OVERSHOOT = 1.5
+MIN_EXTRA_ROWS = 100
+
+SAMPLE_ALIAS = "_pm_sample"
+
+
+def sample_query(ctx, query, n=None, fraction=None, method=None, seed=None):
+    """
+    Select statement returning a sample of the rows of query: about n rows,
+    or each row with probability fraction.
+
+    method is "system" (default) or "bernoulli" for the TABLESAMPLE method
+    of a base table query, or "reservoir" to sample the rows of the query
+    in one pass whatever the query (ORDER BY random() LIMIT n).
+    """
+    if (n is None) == (fraction is None):
+        raise Exception("Give either n or fraction")
+    method = method or "system"
+    if method not in METHODS:
+        raise Exception("Unknown sampling method '%s'" % method)
+    base = sampled_table(query)
+    if base is not None and method != "reservoir":
+        if fraction is None:
+            rows = estimate_rows(ctx, query)
+            percent = 100. if rows <= 0 else min(100., 100. * (OVERSHOOT * n + MIN_EXTRA_ROWS) / rows)
+        else:
+            percent = 100. * fraction
+        repeatable = None if seed is None else sa.literal_column(str(int(seed)))
+        sampled = sa.tablesample(base, getattr(sa.func, method)(percent), name=SAMPLE_ALIAS, seed=repeatable)
+        q = ClauseAdapter(sampled).traverse(query)
+        return q if n is None else q.order_by(None).order_by(random_key(seed)).limit(n)
+    sub = query.alias(SAMPLE_ALIAS)
+    key = random_key(seed)
+    q = sa.select(list(sub.c)).select_from(sub)
+    if fraction is not None:
+        threshold = fraction if seed is None else int(fraction * 2147483648)
+        return q.where(key < sa.literal_column(repr(threshold)))
+    return q.order_by(key).limit(n)
+
+
+def random_key(seed=None):
+    """
+    Random sort key of the rows of SAMPLE_ALIAS: random() in [0, 1), or
+    the row hashed with seed in [0, 2^31) for a repeatable sample.
+    """
+    if seed is None:
+        return sa.func.random()
+    return sa.literal_column("(hashtextextended(%s::text, %d) & 2147483647)" % (SAMPLE_ALIAS, int(seed)))
+
+
+def sampled_table(query):
+    """
+    Base table read by query when query only projects and filters its rows.
+    """
+    if not isinstance(query, sa.sql.Select):
+        return None
+    froms = query.froms
+    if len(froms) != 1 or not isinstance(froms[0], sa.Table):
+        return None
+    if query._group_by_clause.clauses or has_limit(query) or query._distinct:
+        return None
+    return froms[0]
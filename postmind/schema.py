@@ -0,0 +1,159 @@
+__author__ = 'matthieu'
+
+import os
+import time
+import hashlib
+import logging
+import pickle
+
+import sqlalchemy as sa
+
+logger = logging.getLogger('pom')
+
+VERSION_TABLE = "postmind_schema_version"
+
+# one hash over the user relations and their attributes: a DDL statement
+# touching a table updates its pg_class row (relfilenode / xmin) or one of
+# its pg_attribute rows. Temporary relations come and go without changing
+# the schema and are left out
+USER_RELATIONS = "c.oid >= 16384 and c.relkind in ('r', 'v', 'm', 'f', 'p') and c.relpersistence <> 't'"
+FINGERPRINT_QUERY = """
+    select
+        (select md5(coalesce(string_agg(c.oid::text || ':' || c.relfilenode::text || ':' || c.xmin::text,
+                                        ',' order by c.oid), ''))
+         from pg_class c where {relations})
+        || ':' ||
+        (select count(*)::text || ':' || coalesce(sum(a.xmin::text::bigint), 0)::text
+         from pg_attribute a join pg_class c on c.oid = a.attrelid where a.attnum > 0 and {relations})
+""".format(relations=USER_RELATIONS)
+
+INSTALL_VERSION_TRIGGER = """
+create table if not exists {table} (version bigint not null);
+insert into {table} select 0 where not exists (select 1 from {table});
+create or replace function {table}_bump() returns event_trigger language plpgsql as
+$$ begin update {table} set version = version + 1; end $$;
+drop event trigger if exists {table}_bump;
+create event trigger {table}_bump on ddl_command_end execute procedure {table}_bump();
+""".format(table=VERSION_TABLE)
+
+
+class SchemaCache(object):
+    """
+    On-disk cache of reflected table descriptions for one database.
+
+    The cache is keyed by the database uri and invalidated whenever the
+    catalog fingerprint changes. The fingerprint is the counter of the
+    postmind_schema_version table when install_version_trigger was run on
+    the database, or a hash over pg_class and pg_attribute otherwise. It is
+    computed again at most every check_interval seconds, unless a statement
+    was run through PostmindContext.execute since.
+    """
+    def __init__(self, ctx, path=None, check_interval=10):
+        self.ctx = ctx
+        self.check_interval = check_interval
+        # (time, context writes, fingerprint) of the last computation
+        self._checked = None
+        if path is None:
+            path = os.path.join(os.path.expanduser("~"), ".postmind")
+        self.file_name = os.path.join(path, "schema_%s.pkl" % hashlib.sha1(ctx.uri.encode("utf-8")).hexdigest())
+        self.fingerprint = None
+        self.names = None
+        self.tables = {}
+        self.dirty = False
+
+    def install_version_trigger(self):
+        """
+        Maintain a schema version counter with an event trigger, so checking
+        the cache no longer hashes the catalog (needs superuser rights).
+        """
+        self.ctx.execute(INSTALL_VERSION_TRIGGER)
+
+    def current_fingerprint(self):
+        now, writes = time.time(), self.ctx.writes
+        if self._checked is not None and self._checked[1] == writes and now - self._checked[0] < self.check_interval:
+            return self._checked[2]
+        if self.ctx.execute("select to_regclass('%s')" % VERSION_TABLE).scalar() is not None:
+            fingerprint = "v%s" % self.ctx.execute("select max(version) from %s" % VERSION_TABLE).scalar()
+        else:
+            fingerprint = self.ctx.execute(FINGERPRINT_QUERY).scalar()
+        self._checked = (now, writes, fingerprint)
+        return fingerprint
+
+    def load(self):
+        """
+        Load the cache from disk. Returns False (and empties the cache) when
+        the catalog changed since it was written.
+        """
+        fingerprint = self.current_fingerprint()
+        self.fingerprint, self.names, self.tables = fingerprint, None, {}
+        self.dirty = False
+        try:
+            with open(self.file_name, "rb") as fp:
+                content = pickle.load(fp)
+        except Exception:
+            return False
+        if content.get("fingerprint") != fingerprint:
+            logger.info("Schema cache %s is stale" % self.file_name)
+            return False
+        self.names = content["names"]
+        self.tables = content["tables"]
+        return True
+
+    def save(self):
+        if not self.dirty or self.fingerprint is None:
+            return
+        directory = os.path.dirname(self.file_name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp = self.file_name + ".%d" % os.getpid()
+        with open(tmp, "wb") as fp:
+            pickle.dump({"fingerprint": self.fingerprint, "names": self.names, "tables": self.tables},
+                        fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.file_name)
+        self.dirty = False
+
+    def set_names(self, names):
+        self.names = list(names)
+        self.dirty = True
+
+    def get(self, name):
+        return self.tables.get(name)
+
+    def put(self, name, description):
+        self.tables[name] = description
+        self.dirty = True
+
+    def forget(self, name):
+        """
+        Drop the description of the (re)created table name, and list it
+        among the tables.
+        """
+        self.tables.pop(name, None)
+        if self.names is not None and name not in self.names:
+            self.names.append(name)
+        self.dirty = True
+
+
+def describe_table(inspector, name, schema=None):
+    """
+    Picklable description of a table: its columns with their types and
+    foreign keys.
+    """
+    fks = {}
+    try:
+        for fk in inspector.get_foreign_keys(name, schema=schema):
+            table = fk["referred_table"]
+            if fk.get("referred_schema"):
+                table = "%s.%s" % (fk["referred_schema"], table)
+            for col, ref in zip(fk["constrained_columns"], fk["referred_columns"]):
+                fks.setdefault(col, []).append("%s.%s" % (table, ref))
+    except Exception:
+        pass
+    return [{"name": col["name"], "type": col["type"], "foreign_keys": fks.get(col["name"], [])}
+            for col in inspector.get_columns(name, schema=schema)]
+
+
+def build_table(name, description, schema=None):
+    cols = [sa.Column(col["name"], col["type"], *[sa.ForeignKey(ref) for ref in col["foreign_keys"]])
+            for col in description]
+    return sa.Table(name, sa.MetaData(), *cols, schema=schema)
@@ -0,0 +1,299 @@
+"""
+Mergeable sketches of column values.
+
+HyperLogLog estimates distinct counts and CountMinSketch estimates value
+frequencies (with a list of heavy hitter candidates), both in a single
+streaming pass and in bounded memory. Sketches built from different
+partitions or days with the same parameters and hash are merged with
+merge() and serialized with to_bytes() / from_bytes().
+
+Values are hashed on the client with pandas' hash_array ("pandas" hash);
+HyperLogLog.from_sql builds the registers on the server in plain SQL with
+hashtextextended ("pg" hash). Sketches built with different hashes cannot
+be merged.
+"""
+__author__ = 'matthieu'
+
+import pickle
+import heapq
+
+import numpy as np
+import pandas as pd
+
+HLL_QUERY = """
+    select b, max(case when r = 0 then {q} + 1 else r - {p} end) as rho
+    from (select h & {mask} as b, position(B'1' in ((h >> {p}) & {qmask})::bit(64)) as r
+          from (select hashtextextended(q.v::text, 0) as h from ({query}) as q(v)
+                where q.v is not null) s) s
+    group by b
+"""
+
+HLL_COLUMNS_QUERY = """
+    select i, b, max(case when r = 0 then {q} + 1 else r - {p} end) as rho
+    from (select v.i, v.h & {mask} as b, position(B'1' in ((v.h >> {p}) & {qmask})::bit(64)) as r
+          from ({query}) as q cross join lateral (values {values}) as v(i, h)
+          where v.h is not null) s
+    group by i, b
+"""
+
+
+def hashable(values):
+    """
+    Values as a 1d array, arrays (rows of a 2d array or array objects)
+    being replaced by their repr.
+    """
+    values = np.asarray(values)
+    if values.ndim > 1 or (values.dtype == object and any(isinstance(v, np.ndarray) for v in values)):
+        values = np.array([None if v is None else repr(np.asarray(v).tolist()) for v in values], dtype=object)
+    return values
+
+
+def hash_values(values):
+    """
+    64 bits hash of each non null value (unsigned integers). Integers and
+    booleans hash as the equal floats, so a column hashes the same whether
+    a batch holds NULLs or not.
+    """
+    values = hashable(values)
+    values = values[~pd.isnull(values)]
+    if values.dtype.kind in "iub":
+        values = values.astype(np.float64)
+    try:
+        return pd.util.hash_array(values)
+    except TypeError:
+        return pd.util.hash_array(np.array([repr(v) for v in values], dtype=object))
+
+
+def bit_length(w):
+    """
+    Number of bits of each unsigned 64 bits integer (0 for 0), computed
+    with integer shifts: floats only hold 53 bits exactly.
+    """
+    w = np.array(w, dtype=np.uint64)
+    n = np.zeros(len(w), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = w >= np.uint64(1 << shift)
+        n[high] += shift
+        w[high] >>= np.uint64(shift)
+    return n + w.astype(np.int64)
+
+
+class Sketch(object):
+    def to_bytes(self):
+        return pickle.dumps(self.__dict__, protocol=2)
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls.__new__(cls)
+        sketch.__dict__.update(pickle.loads(data))
+        return sketch
+
+    def _check(self, other, *params):
+        for param in params + ("hash",):
+            if getattr(self, param) != getattr(other, param):
+                raise Exception("Cannot merge sketches with different %s" % param)
+
+
+class HyperLogLog(Sketch):
+    """
+    HyperLogLog distinct count estimator with 2 ** p registers (relative
+    error about 1.04 / sqrt(2 ** p)).
+    """
+    def __init__(self, p=14, hash="pandas"):
+        self.p = p
+        self.hash = hash
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    @classmethod
+    def from_sql(cls, ctx, query, p=14):
+        """
+        Sketch of the values of the single column query, built by the
+        database in one aggregate over 2 ** p groups.
+        """
+        sketch = cls(p, hash="pg")
+        q = 64 - p
+        df = ctx.read_sql(HLL_QUERY.format(query=query, p=p, q=q, mask=(1 << p) - 1, qmask=(1 << q) - 1))
+        sketch.registers[df["b"].values.astype(np.int64)] = df["rho"].values.astype(np.uint8)
+        return sketch
+
+    @classmethod
+    def from_sql_columns(cls, ctx, query, columns, p=14):
+        """
+        Sketches of the values of each of the columns (quoted names) of
+        query, built by the database in one scan of query.
+        """
+        sketches = [cls(p, hash="pg") for _ in columns]
+        if not columns:
+            return sketches
+        q = 64 - p
+        values = ", ".join("(%d, hashtextextended(q.%s::text, 0))" % (i, col) for i, col in enumerate(columns))
+        df = ctx.read_sql(HLL_COLUMNS_QUERY.format(query=query, values=values, p=p, q=q, mask=(1 << p) - 1,
+                                                   qmask=(1 << q) - 1))
+        for i, group in df.groupby("i"):
+            sketches[int(i)].registers[group["b"].values.astype(np.int64)] = group["rho"].values.astype(np.uint8)
+        return sketches
+
+    def update(self, values):
+        h = hash_values(values)
+        if not len(h):
+            return self
+        q = 64 - self.p
+        buckets = (h & np.uint64((1 << self.p) - 1)).astype(np.int64)
+        rho = (q - bit_length(h >> np.uint64(self.p)) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, rho)
+        return self
+
+    def merge(self, other):
+        self._check(other, "p")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1., -self.registers.astype(np.int64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class CountMinSketch(Sketch):
+    """
+    Count-Min frequency sketch of depth rows of width counters, keeping the
+    k values with the highest estimated frequency as heavy hitters.
+    """
+    def __init__(self, width=1 << 14, depth=4, k=32, hash="pandas"):
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.hash = hash
+        self.total = 0
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.candidates = {}
+
+    def _indexes(self, h):
+        # double hashing: row i uses h1 + i * h2
+        h1 = (h & np.uint64(0xffffffff)).astype(np.int64)
+        h2 = (h >> np.uint64(32)).astype(np.int64) | 1
+        return (h1[None, :] + np.arange(self.depth, dtype=np.int64)[:, None] * h2[None, :]) % self.width
+
+    def update(self, values):
+        counts = pd.Series(hashable(values)).dropna().value_counts()
+        if not len(counts):
+            return self
+        idx = self._indexes(hash_values(counts.index.values))
+        for i in range(self.depth):
+            np.add.at(self.table[i], idx[i], counts.values)
+        self.total += int(counts.values.sum())
+        self._prune(list(counts.index[:self.k]))
+        return self
+
+    def merge(self, other):
+        self._check(other, "width", "depth")
+        self.table += other.table
+        self.total += other.total
+        self._prune(list(other.candidates))
+        return self
+
+    def estimate(self, values):
+        idx = self._indexes(hash_values(pd.Index(values).values))
+        return self.table[np.arange(self.depth)[:, None], idx].min(axis=0)
+
+    def _prune(self, values):
+        values = list(self.candidates) + [v for v in values if v not in self.candidates]
+        if not values:
+            return
+        estimates = self.estimate(values)
+        self.candidates = dict(heapq.nlargest(self.k, zip(values, estimates.tolist()), key=lambda x: x[1]))
+
+    def top(self, n=None):
+        """
+        Heavy hitters as (value, estimated count) pairs, most frequent first.
+        """
+        top = sorted(self.candidates.items(), key=lambda x: -x[1])
+        return top if n is None else top[:n]
+
+
+class KLLSketch(Sketch):
+    """
+    KLL quantile sketch: compactors of geometrically decreasing capacity
+    (k for the top one) each keep values of weight 2 ** level. The rank
+    error is about 1.65 / k with high probability.
+    """
+    def __init__(self, k=200, hash=None):
+        self.k = k
+        self.hash = hash
+        self.n = 0
+        self.levels = [np.empty(0)]
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self.n += len(values)
+            self._compress()
+        return self
+
+    def merge(self, other):
+        self._check(other, "k")
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2. / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(values)
+                # an odd value out stays at this level
+                keep = values[len(values) - len(values) % 2:]
+                values = values[:len(values) - len(values) % 2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1],
+                                                         values[np.random.randint(2)::2]])
+                self.levels[level] = keep
+            level += 1
+
+    def quantiles(self, q):
+        """
+        Approximate quantiles q (array of values in [0, 1]); NaN when the
+        sketch is empty.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if not self.n:
+            return np.full(q.shape, np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2. ** level) for level, v in enumerate(self.levels)])
+        order = np.argsort(values)
+        cumulative = np.cumsum(weights[order])
+        idx = np.searchsorted(cumulative, q * cumulative[-1], side="left")
+        return values[order][np.minimum(idx, len(values) - 1)]
+
+
+def element_matrix(values):
+    """
+    (rows, positions) float matrix of the values of an array column, padded
+    with NaN; None when the values are not arrays.
+    """
+    values = np.asarray(values)
+    if values.ndim > 1:
+        return values.reshape(len(values), -1).astype(np.float64)
+    if values.dtype != object or not any(isinstance(v, (np.ndarray, list)) for v in values):
+        return None
+    rows = [np.empty(0) if v is None else np.ravel(np.asarray(v, dtype=np.float64)) for v in values]
+    out = np.full((len(rows), max(len(r) for r in rows)), np.nan)
+    for i, r in enumerate(rows):
+        out[i, :len(r)] = r
+    return out
@@ -1,5 +1,7 @@
 __author__ = 'matthieu'
 
+import logging
+
 import sqlalchemy as sa
 from prettytable import PrettyTable
 import pandas as pd
@@ -8,12 +10,36 @@ from sqlalchemy.sql.expression import func
 from .utils import *
 from .column import Column
 from .pobject import PObject
+from .plan import Relation, Project, Union
+from .export import to_csv_parallel
+from .io.npy import write_npy
+from .profile import profile
+from .sample import sample_query
+from .cache import relation_versions
+
+logger = logging.getLogger('pom')
+
+MAP_BATCH_BODY = """import numpy as np
+import pandas as pd
+values = [np.asarray(v) for v in ({args})]
+block = pd.DataFrame(dict((name, list(v) if v.ndim > 1 else v) for name, v in zip({names}, values)),
+                     columns={names})
+result = fn(block)
+if hasattr(result, "tolist"):
+    result = result.tolist()
+return {result}"""
+
+MAP_ROW_BODY = """line = loads(line)
+result = fn(line)
+return {result}"""
 
 class Table(PObject):
-    def __init__(self, ctx, name, data=None, columns=None):
+    def __init__(self, ctx, name, data=None, columns=None, plan=None):
         self.ctx = ctx
         self.name = name
-        self.data = data
+        self.plan = plan if plan is not None else Relation(data)
+        self._profiles = {}
+        self._len = None
 
         self._columns = []
         self._columns_indexes = {}
@@ -29,6 +55,14 @@ class Table(PObject):
             self._columns_indexes[col.name] = idx
             idx += 1
 
+    @property
+    def data(self):
+        return self.plan.compile()
+
+    @data.setter
+    def data(self, data):
+        self.plan = Relation(data)
+
     def _tablify(self):
         tbl = PrettyTable(["Column", "Type", "Foreign Keys", "Reference Keys"])
         tbl.align["Column"] = "l"
@@ -43,10 +77,21 @@ class Table(PObject):
             tbl.add_row([col.name, tp, col.foreign_keys_str(), col.ref_keys_str()])
         return tbl
 
-    def to_csv(self, file_name, alias="col", compression=True):
+    def to_csv(self, file_name, alias="col", compression=True, parallel=None, key=None):
+        """
+        Export to a (gzip compressed) csv file on the database server.
+
+        With parallel=n the export is split in n part files written by
+        concurrent COPY statements, plus a manifest (see
+        export.to_csv_parallel); key is the column hashed to split results
+        that are not a plain scan of a table.
+        """
+        if parallel:
+            return to_csv_parallel(self.ctx, self.data, file_name, parts=parallel, key=key,
+                                   compression=compression)
         from sqlalchemy.dialects import postgresql
 
-        c = self.data.compile(dialect=postgresql.dialect())
+        c = self.plan.query().compile(dialect=postgresql.dialect())
         if compression:
             q = "COPY (%s) TO PROGRAM 'gzip > %s'" %(c, file_name)
         else:
@@ -68,16 +113,14 @@ class Table(PObject):
         return self._tablify().get_html_string()
 
     def head(self, n=6):
-        return self.ctx.read_sql(sa.select(['*'], limit=n).select_from(self.data.alias()))
+        return self.ctx.read_sql(self.plan.limit(n))
 
     def union(self, tables):
-        from sqlalchemy import union_all
-
         if type(tables) is list:
-            datas = [self.data] + map(lambda x: x.data, tables)
+            plans = [self.plan] + map(lambda x: x.plan, tables)
         else:
-            datas = [self.data, tables.data]
-        return Table(self.ctx, gen_table_name(), union_all(*datas))#, self.data.c)
+            plans = [self.plan, tables.plan]
+        return Table(self.ctx, gen_table_name(), plan=Union(plans))
 
     def select(self, columns=None, **kwargs):
         name = gen_table_name(self.name)
@@ -92,10 +135,9 @@ class Table(PObject):
                 cols.append(col.data)
             else:
                 cols.append(col)
-        q = sa.select(cols, **kwargs)
-        if type(sort) is sa.sql.elements.UnaryExpression:
-            q = q.order_by(sort)
-        return Table(self.ctx, name, q)
+        if type(sort) is not sa.sql.elements.UnaryExpression:
+            sort = None
+        return Table(self.ctx, name, plan=Project(self.plan, cols, kwargs, sort))
 
     def __getitem__(self, item):
         if type(item) == str:
@@ -108,42 +150,177 @@ class Table(PObject):
             return self.slice(item.start, item.stop)
 
     def __len__(self):
-        res = self.ctx.execute(self.data.count())
-        return int(res.fetchall()[0][0])
-
-    def map(self, fun, restype="json"):
-        from pom.serializers import CloudPickleSerializer
-        import base64
-
-        Session = sessionmaker(bind=self.ctx)
-        session = Session()
-
-        funname = "myfun"#gen_table_name("fun_")
-        ser = CloudPickleSerializer()
-        query = """
-create or replace function {name} (line {tablename})
- returns {restype} as
-$$
-import sys
-sys.argv = []
-import json
-
-if '{name}' not in SD:
-  import cPickle
-  import base64
-  SD['{name}'] = cPickle.loads(base64.decodestring('''{code}'''))
-
-return SD['{name}'](line)
-$$ language plpythonu security definer;
-""".format(name=funname, tablename=self.name,
-           code=base64.encodestring(ser.dumps(fun)),
-           restype=restype)
-        with self.ctx.connect() as conn:
-            conn.execute(query)
-        return Table(self.ctx, funname,
-                     sa.select([sa.text("%s(%s.*)" %(funname, self.name))]).select_from(self.data))
-
-    def collect(self):
-        return self.ctx.read_sql(sa.select(['*']).select_from(self.data.alias()))
+        return self.count(exact=True)
+
+    def count(self, exact=False):
+        """
+        Number of rows of the table.
+
+        Parameters
+        ----------
+        exact: bool
+            When False, planner estimate read in constant time:
+            pg_class.reltuples for a base table (as of its last vacuum or
+            analyze), the EXPLAIN row estimate otherwise. When True, exact
+            count, kept until a relation read by the table changes (see
+            cache.relation_versions) or a statement is run through the
+            context. The count of a table that cannot be versioned
+            (foreign tables, volatile functions) is never kept
+        """
+        sql = self.ctx.to_sql(self.plan.query())
+        if not exact:
+            count = None
+            if isinstance(self.plan, Relation) and isinstance(self.plan.data, sa.Table):
+                count = estimated_counts(self.ctx, [qualified_name(self.plan.data.name,
+                                                                   self.plan.data.schema)])[0]
+            return count if count is not None else estimate_rows(self.ctx, sql)
+        versions = relation_versions(self.ctx.con, sql)
+        version = (self.ctx.writes, versions)
+        if versions is None or self._len is None or self._len[0] != version:
+            res = self.ctx.execute(sa.select([func.count()]).select_from(self.plan.query().alias()))
+            self._len = (version, int(res.fetchall()[0][0]))
+        return self._len[1]
+
+    def map(self, fun, restype="json", batch=False, batch_size=10000):
+        """
+        Apply fun to the table rows in a PL/Python function (see
+        udf.UDFRegistry).
+
+        fun is called on each row as a dict of its column values, as decoded
+        from JSON (dates and timestamps are strings).
+
+        In batch mode fun is called once per block of at most batch_size
+        rows with a DataFrame of the block columns (NumPy arrays) and returns
+        one result per row (list, array or Series). Tables whose columns
+        cannot be passed as arrays (see _batch_params) are mapped row by
+        row.
+        """
+        if batch:
+            params = self._batch_params()
+            if params is not None:
+                return self._map_batch(fun, restype, batch_size, params)
+            logger.warning("Columns of %s cannot be aggregated in arrays, mapping it row by row" % self.name)
+        result = "dumps(result)" if restype in ("json", "jsonb") else "result"
+        funname = self.ctx.udfs.register(fun, otype=restype, params="line jsonb",
+                                         body=MAP_ROW_BODY.format(result=result))
+        q = sa.select([sa.literal_column("%s(to_jsonb(q))" %funname).label("result")]).\
+            select_from(self.data.alias("q"))
+        return Table(self.ctx, gen_table_name(), q)
+
+    def _batch_params(self):
+        """
+        Parameters of the batch function, an array per column. None when a
+        column type has no SQL name (NullType, untyped expressions) or when
+        array_agg cannot aggregate an array column: NULL, empty or
+        differently shaped arrays.
+        """
+        from sqlalchemy.dialects import postgresql
+
+        dialect = postgresql.dialect()
+        params, arrays = [], []
+        for i, col in enumerate(self._columns):
+            try:
+                params.append("c%d %s[]" %(i, col.type.compile(dialect=dialect)))
+            except Exception:
+                return None
+            if isinstance(col.type, sa.ARRAY):
+                arrays.append('q."%s"' %col.name.replace('"', '""'))
+        if arrays:
+            cond = " and ".join("count(*) = count(array_dims(%s)) and count(distinct array_dims(%s)) <= 1"
+                                %(a, a) for a in arrays)
+            if not self.ctx.execute(sa.select([sa.text(cond)]).select_from(self.data.alias("q"))).scalar():
+                return None
+        return ", ".join(params)
+
+    def _map_batch(self, fun, restype, batch_size, params):
+        names = [col.name for col in self._columns]
+        result = "[dumps(r) for r in result]" if restype in ("json", "jsonb") else "result"
+        body = MAP_BATCH_BODY.format(names=repr(names),
+                                     args="".join("c%d, " %i for i in range(len(names))),
+                                     result=result)
+        funname = self.ctx.udfs.register(fun, otype="setof %s" %restype, params=params, body=body)
+        blocks = sa.select([sa.text("*"),
+                            sa.literal_column("(row_number() over () - 1) / %d" %int(batch_size)).label("_pm_block")]).\
+            select_from(self.data.alias()).alias()
+        args = ", ".join('array_agg("%s")' %name.replace('"', '""') for name in names)
+        q = sa.select([sa.literal_column("%s(%s)" %(funname, args)).label("result")]).\
+            select_from(blocks).group_by(sa.literal_column("_pm_block"))
+        return Table(self.ctx, gen_table_name(), q)
+
+    def iter_batches(self, batch_size=10000, columns=None, engine=None, records=False):
+        """
+        Iterate over the table content by DataFrames (or record arrays) of at
+        most batch_size rows. See PostmindContext.iter_sql.
+        """
+        cols = ['*'] if columns is None else [sa.column(col) for col in columns]
+        query = sa.select(cols).select_from(self.data.alias())
+        return self.ctx.iter_sql(query, batch_size=batch_size, engine=engine, records=records)
+
+    def collect(self, engine=None):
+        return self.ctx.read_sql(self.plan.query(), engine=engine)
+
+    def sample(self, n=None, fraction=None, method=None, seed=None):
+        """
+        Table of a sample of the rows: about n rows, or each row with
+        probability fraction. See sample.sample_query for the methods.
+        """
+        q = sample_query(self.ctx, self.plan.query(), n=n, fraction=fraction, method=method, seed=seed)
+        return Table(self.ctx, gen_table_name(self.name), q)
+
+    def to_numpy(self, path=None, mmap=True, chunk_bytes=1 << 25):
+        """
+        Stream the table content to a structured .npy file on the client
+        (see io.npy.write_npy) and return it memory-mapped (mmap=True) or
+        loaded in memory.
+        """
+        return write_npy(self.ctx, self.ctx.to_sql(self.plan.query()), file_name=path, mmap=mmap,
+                         chunk_bytes=chunk_bytes)
+
+    def persist(self, kind="unlogged", indexes=None, analyze=True):
+        """
+        Run the table query once into a relation and return a Table reading
+        it (see persist.MaterializationRegistry). Persisting an identical
+        plan again reuses that relation while the relations it reads are
+        unchanged; it is dropped when the context is closed.
+
+        Parameters
+        ----------
+        kind: str
+            "unlogged", "temp" (only visible from the session that created
+            it, see persist.MaterializationRegistry) or "materialized_view"
+        indexes: list
+            Columns to index, one index per item (a column name or a list of
+            column names)
+        analyze: bool
+            Collect the planner statistics of the relation
+        """
+        name = self.ctx.materializations.persist(self.ctx.to_sql(self.plan.query()), kind=kind,
+                                                 indexes=indexes, analyze=analyze)
+        data = sa.Table(name, sa.MetaData(), *[sa.Column(col.name, col.type) for col in self.data.c])
+        return Table(self.ctx, name, data)
+
+    def describe(self, k=10, quantiles=(0.25, 0.5, 0.75), refresh=False, top=None, stream=False,
+                 batch_size=100000, engine="copy"):
+        """
+        Profile of every column (see profile.profile): nulls, min / max,
+        mean / std, approximate distinct count, quantiles and top k values
+        of the top columns (all by default), computed by the database or,
+        with stream=True, estimated on the client. The result is kept on
+        the table until refresh=True.
+        """
+        key = (k, tuple(quantiles), None if top is None else tuple(top), stream)
+        if refresh or key not in self._profiles:
+            self._profiles[key] = profile(self.ctx, self.plan.query(), k=k, quantiles=quantiles, top=top,
+                                          stream=stream, batch_size=batch_size, engine=engine)
+        return self._profiles[key]
+
+    def explain(self, analyze=False):
+        """
+        SQL generated for the table and the PostgreSQL plan of that query.
+        """
+        sql = self.ctx.to_sql(self.plan.query())
+        res = self.ctx.execute("EXPLAIN %s%s" %("ANALYZE " if analyze else "", sql))
+        plan = "\n".join(row[0] for row in res)
+        return "SQL:\n%s\n\nPlan:\n%s" %(sql, plan)
 
 
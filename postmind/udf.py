@@ -0,0 +1,97 @@
+__author__ = 'matthieu'
+
+import re
+import base64
+import hashlib
+import dill
+import sqlalchemy as sa
+
+REGISTRY_TABLE = "postmind_udf"
+# function_name: prefix and 16 hex digits of the payload hash
+NAME = re.compile(r"^[a-z0-9_]*_[0-9a-f]{16}$")
+
+CREATE_REGISTRY = """create table if not exists {table} (
+    name text primary key,
+    payload text not null,
+    created timestamptz not null default now()
+);""".format(table=REGISTRY_TABLE)
+
+FUNCTION_TEMPLATE = """create or replace function {name} ({params}) returns {otype} as
+$$
+import sys
+sys.argv = []
+import base64
+from json import loads, dumps
+from postmind import pg
+
+if '{name}' not in SD:
+    import dill
+    payload = plpy.execute("select payload from {table} where name = '{name}'")[0]["payload"]
+    SD['{name}'] = dill.loads(base64.decodestring(payload))
+fn = SD['{name}']
+{body}
+$$ language plpythonu security definer;
+"""
+
+APPLY_BODY = """args, kwargs = loads(inargs)
+return fn(*args, **kwargs)"""
+
+
+class UDFRegistry(object):
+    """
+    Content-addressed registry of PL/Python functions.
+
+    Each function is named after a hash of its serialized bytes (and of its
+    signature), its payload is stored once in the postmind_udf table and the
+    DDL only runs when no function with that name exists yet, so registering
+    the same function again from any session or process is a catalog lookup
+    (or nothing at all once this registry has seen it).
+    """
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self._known = set()
+
+    def function_name(self, fun, payload, signature):
+        prefix = re.sub("[^a-z0-9_]", "_", getattr(fun, "__name__", "fun").lower())[:40]
+        digest = hashlib.sha1(payload + signature.encode("utf-8")).hexdigest()[:16]
+        return "%s_%s" % (prefix, digest)
+
+    def is_udf(self, name):
+        """
+        True when name is a function of this registry, or the name of a
+        function registered by any session.
+        """
+        return name in self._known or NAME.match(name) is not None
+
+    def register(self, fun, otype="setof jsonb", params="inargs jsonb", body=APPLY_BODY):
+        """
+        Make sure fun exists as a database function and return its name.
+
+        Parameters
+        ----------
+        fun: callable
+            Function to register, serialized with dill
+        otype: str
+            Return type of the database function
+        params: str
+            Parameters of the database function
+        body: str
+            PL/Python code calling the deserialized function, available as fn
+        """
+        payload = base64.encodestring(dill.dumps(fun))
+        name = self.function_name(fun, payload, "%s|%s|%s" % (params, otype, body))
+        if name in self._known:
+            return name
+        with self.ctx.con.begin() as conn:
+            conn.execute(sa.text("select pg_advisory_xact_lock(hashtext(:name))"), name=name)
+            exists = conn.execute(sa.text("select 1 from pg_proc where proname = :name"), name=name).first()
+            if exists is None:
+                conn.execute(CREATE_REGISTRY)
+                conn.execute(sa.text("insert into %s (name, payload) values (:name, :payload) "
+                                     "on conflict (name) do nothing" % REGISTRY_TABLE),
+                             name=name, payload=payload)
+                conn.execute(FUNCTION_TEMPLATE.format(name=name, params=params, otype=otype,
+                                                      table=REGISTRY_TABLE, body=body))
+        self._known.add(name)
+        return name
+
@@ -1,5 +1,6 @@
 __author__ = 'matthieu'
 
+import os
 import uuid
 import dill
 import base64
@@ -9,6 +10,8 @@ from sqlalchemy.sql.expression import func
 from joblib import Parallel, delayed
 import pandas as pd
 
+from .udf import APPLY_BODY
+
 def gen_table_name(prefix="tbl_"):
     return prefix + str(uuid.uuid4()).replace("-", "_")
 
@@ -37,26 +40,7 @@ def pgapply(ctx, fun, *args, **kwargs):
     otype = kwargs.pop("otype", "setof jsonb")
     metadata = kwargs.pop("meta", None)
     index = kwargs.pop("index", None)
-    funname = fun.__name__
-    query = """create or replace function {name} (inargs jsonb) returns {otype} as
-$$
-import sys
-sys.argv = []
-import base64
-from json import loads, dumps
-from postmind import pg
-
-if '{name}' not in SD:
-    import dill
-    SD['{name}'] = dill.loads(base64.decodestring('''{code}'''))
-args, kwargs = loads(inargs)
-
-return SD['{name}'](*args, **kwargs)
-$$ language plpythonu security definer;
-""".format(name=funname, otype=otype, code=base64.encodestring(dill.dumps(fun)))
-    ctx.execute(query)
-#    query = "{name}('{args}')".format(name=funname, args=json.dumps((args, kwargs)))
-#        return #Table(self.con, gen_table_name()
+    funname = ctx.udfs.register(fun, otype=otype, body=APPLY_BODY)
     query = func.__getattr__(funname)(json.dumps((args, kwargs)))
     selcols = ['*']
     if metadata != None:
@@ -67,22 +51,95 @@ $$ language plpythonu security definer;
     return q
 
 
-def execute_query(q):
-    con = sa.create_engine("postgresql://matthieu:@localhost/pom")
-    con.execute(q)
+_engines = {}
+
+def get_engine(uri):
+    """
+    Engine (and its connection pool) for uri, created once per process and
+    reused by every task the process runs.
+    """
+    key = (os.getpid(), uri)
+    if key not in _engines:
+        _engines[key] = sa.create_engine(uri)
+    return _engines[key]
+
+def _engine(con):
+    if isinstance(con, basestring):
+        return get_engine(con)
+    return con
+
+def parallel_map(ctx, fun, items, n_jobs=4, backend="processes"):
+    """
+    Run fun(item, con) for each item with joblib.
+
+    backend "processes" sends the context uri to the workers, which open a
+    pooled engine once per process; backend "threads" shares the context
+    engine between threads.
+    """
+    if backend == "threads":
+        con, jbackend = ctx.con, "threading"
+    elif backend == "processes":
+        con, jbackend = ctx.uri, None
+    else:
+        raise Exception("Unknown backend '%s'" % backend)
+    return Parallel(n_jobs=n_jobs, backend=jbackend)(delayed(fun)(item, con) for item in items)
+
+def execute_query(q, con):
+    _engine(con).execute(q)
     return True
 
-def execute_queries(queries, n_jobs=4):
-    execute_query(queries[0])
-    results = Parallel(n_jobs=n_jobs)(delayed(execute_query)(q) for q in queries[1:])
+def execute_queries(ctx, queries, n_jobs=4, backend="processes"):
+    execute_query(queries[0], ctx.con)
+    results = parallel_map(ctx, execute_query, queries[1:], n_jobs=n_jobs, backend=backend)
     return results
 
-def process_query(q):
-    import sqlalchemy as sa
+def process_query(q, con):
     try:
-        con = sa.create_engine("postgresql://matthieu:@localhost/pom")
-        df = pd.io.sql.read_sql(q[0], con)
+        df = pd.io.sql.read_sql(q[0], _engine(con))
     except:
         raise Exception("Cannot run queries %d %s" %(q[1], q[0]))
     return df
 
+def estimate_rows(ctx, query):
+    """
+    Planner estimate of the number of rows returned by query.
+    """
+    from .pg.ops import explain_rows
+
+    sql = query if isinstance(query, basestring) else ctx.to_sql(query)
+    return explain_rows(ctx.execute("EXPLAIN (FORMAT JSON) %s" % sql).fetchall()[0][0])
+
+def call_alive(ref, method):
+    """
+    Call method of the object of the weak reference ref if it is still
+    alive, for exit callbacks that must not keep their object alive.
+    """
+    obj = ref()
+    if obj is not None:
+        getattr(obj, method)()
+
+def qualified_name(name, schema=None):
+    """
+    Quoted (schema qualified) name of a relation.
+    """
+    quote = lambda x: '"%s"' % x.replace('"', '""')
+    return quote(name) if schema is None else "%s.%s" % (quote(schema), quote(name))
+
+def estimated_counts(ctx, names):
+    """
+    Row count estimates of the relations names (quoted names, see
+    qualified_name) from pg_class.reltuples, in one catalog query. The
+    estimate is None for a relation never vacuumed nor analyzed.
+    """
+    if not names:
+        return []
+    res = ctx.execute(sa.text("""
+        select n.i, c.reltuples, c.relpages
+        from unnest(cast(:names as text[])) with ordinality as n(name, i)
+        join pg_class c on c.oid = to_regclass(n.name)"""), names=list(names))
+    counts = [None] * len(names)
+    for i, reltuples, relpages in res:
+        # -1 (PostgreSQL 14+) or 0 tuples over 0 pages: never analyzed
+        if reltuples >= 0 and (reltuples > 0 or relpages > 0):
+            counts[i - 1] = int(reltuples)
+    return counts
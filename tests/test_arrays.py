@@ -0,0 +1,42 @@
+import numpy as np
+import scipy.sparse
+
+from postmind.pg import arrays
+from postmind.pg.arrays import float_array_literals, text_array_literals
+
+
+def parse(literal):
+    return [float(v) for v in literal[1:-1].split(",")] if literal != "{}" else []
+
+
+def test_integral_values():
+    assert float_array_literals(np.array([[1., -2., 0.], [3., 4., 5.]])) == ["{1, -2, 0}", "{3, 4, 5}"]
+
+
+def test_float_values_read_back():
+    values = np.random.RandomState(0).randn(50, 7)
+    values[3, 2] = np.nan
+    literals = float_array_literals(values)
+    assert len(literals) == 50
+    back = np.array([parse(literal) for literal in literals])
+    assert np.array_equal(back[~np.isnan(values)], values[~np.isnan(values)])
+    assert np.isnan(back[3, 2])
+
+
+def test_rows_split_in_blocks(monkeypatch):
+    monkeypatch.setattr(arrays, "BLOCK_VALUES", 6)
+    values = np.arange(21, dtype=float).reshape(7, 3) / 4
+    assert [parse(literal) for literal in float_array_literals(values)] == values.tolist()
+
+
+def test_sparse_matrix_is_densified_by_block(monkeypatch):
+    monkeypatch.setattr(arrays, "BLOCK_VALUES", 10)
+    dense = np.zeros((9, 5))
+    dense[1, 4] = 2.
+    dense[7, 0] = 0.5
+    assert float_array_literals(scipy.sparse.csr_matrix(dense)) == float_array_literals(dense)
+
+
+def test_text_literals_are_escaped():
+    values = np.array([["a", 'b"c'], ["d\\e", 1]], dtype=object)
+    assert text_array_literals(values) == ['{"a","b\\"c"}', '{"d\\\\e","1"}']
@@ -0,0 +1,87 @@
+import pandas as pd
+
+from postmind.cache import QueryCache, relations, functions, is_query
+
+
+class FakeResult(list):
+    def scalar(self):
+        return self[0][0] if self else None
+
+
+class FakeConnection(object):
+    """
+    Connection answering the catalog queries of the cache with the versions
+    of rows, counting the queries run.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def execute(self, statement, **params):
+        self.queries += 1
+        if "pg_proc" in str(statement):
+            return FakeResult([(False,)])
+        return FakeResult(row for row in self.rows if row[0] in params["names"])
+
+
+class FakeContext(object):
+    def __init__(self, rows):
+        self.con = FakeConnection(rows)
+
+
+def test_relations_keep_the_case_of_quoted_identifiers():
+    assert relations('select * from "MyTable" join Other using (id)') == \
+        ["MyTable", "from", "id", "join", "other", "select", "using"]
+    assert relations('select 1 from "a ""b"""') == ['a "b"', "from", "select"]
+
+
+def test_functions():
+    sql = 'select "MyFunc"(x), Lower(y) from t tablesample bernoulli (10) repeatable (1)'
+    assert functions(sql) == set(["MyFunc", "lower", "tablesample", "repeatable"])
+
+
+def test_is_query():
+    assert is_query("  SELECT 1")
+    assert is_query("explain select 1")
+    assert not is_query("with d as (delete from t returning *) select * from d")
+    assert not is_query("insert into t values (1)")
+
+
+def test_hit_until_the_version_changes():
+    rows = [("t", "r", 1, 10, 0, 0, None)]
+    ctx = FakeContext(rows)
+    cache = QueryCache(ctx, check_interval=0)
+    run = lambda: pd.DataFrame({"a": [1, 2]})
+    cache.get("select a from t", run)
+    cache.get("select a from t", run)
+    assert (cache.hits, cache.misses) == (1, 1)
+    rows[0] = ("t", "r", 1, 11, 0, 0, None)
+    cache.get("select a from t", run)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_versions_are_checked_every_interval():
+    ctx = FakeContext([("t", "r", 1, 10, 0, 0, None)])
+    cache = QueryCache(ctx, check_interval=3600)
+    run = lambda: pd.DataFrame({"a": [1]})
+    for _ in range(3):
+        cache.get("select a from t", run)
+    assert ctx.con.queries == 1
+    cache.on_execute("insert into t values (1)")
+    cache.get("select a from t", run)
+    assert ctx.con.queries == 2 and cache.misses == 2
+
+
+def test_versions_are_bounded():
+    ctx = FakeContext([("t", "r", 1, 10, 0, 0, None)])
+    cache = QueryCache(ctx, max_entries=4)
+    for i in range(10):
+        cache.get("select a + %d from t" % i, lambda: pd.DataFrame({"a": [i]}))
+    assert len(cache._versions) == 4 and len(cache._entries) == 4
+
+
+def test_foreign_tables_are_not_cached():
+    ctx = FakeContext([("f", "f", 1, 0, 0, 0, None)])
+    cache = QueryCache(ctx)
+    cache.get("select * from f", lambda: pd.DataFrame({"a": [1]}))
+    assert cache.uncached == 1 and not cache._entries
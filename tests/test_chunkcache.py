@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from postmind.io.chunkcache import ChunkCache, write_column, read_column
+
+
+def test_string_columns_round_trip(tmpdir):
+    path = str(tmpdir)
+    columns = [pd.Series(["a", "", "x" * 1000, "b"], dtype=object),
+               pd.Series(["a", None, "bc", np.nan], dtype=object),
+               pd.Series([u"\xe9t\xe9", u"", None, u"z"], dtype=object),
+               pd.Series([1, "a", None], dtype=object)]
+    encodings = []
+    for pos, values in enumerate(columns):
+        encodings.append(write_column(path, 0, pos, values))
+        back = read_column(path, 0, pos, encodings[-1], len(values))
+        assert back.dtype == object
+        assert pd.Series(back).equals(values)
+    assert encodings == ["str", "str_null", "utf8_null", "object"]
+    # the long value is not padding the others
+    assert os.path.getsize(os.path.join(path, "c00000_0.npy")) < 1200
+
+
+def test_cached_chunks_match_the_csv(tmpdir):
+    csv = tmpdir.join("data.csv")
+    csv.write("id,name,x\n1,ab,0.5\n2,,1.5\n3,c,\n4,defg,2\n5,h,3\n")
+    cache = ChunkCache(str(tmpdir.mkdir("cache")))
+    first = list(cache.frames(str(csv), chunksize=2))
+    second = list(cache.frames(str(csv), chunksize=2, usecols=["name", "x"]))
+    assert len(first) == len(second) == 3
+    for parsed, cached in zip(first, second):
+        pd.util.testing.assert_frame_equal(parsed[["name", "x"]], cached)
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from postmind.io.npy import NpyWriter, widen
+
+
+def chunk(**columns):
+    return OrderedDict((name, np.asarray(values) if not isinstance(values, np.ndarray) else values)
+                       for name, values in sorted(columns.items()))
+
+
+def objects(values):
+    out = np.empty(len(values), dtype=object)
+    out[:] = values
+    return out
+
+
+def test_strings_double_their_width(tmpdir):
+    file_name = str(tmpdir.join("s.npy"))
+    writer = NpyWriter(file_name, capacity=4)
+    rewrites = []
+    rewrite = writer._rewrite
+    writer._rewrite = lambda dtype: rewrites.append(dtype) or rewrite(dtype)
+    values = [u"x" * n for n in range(1, 41)]
+    for v in values:
+        writer.append(chunk(s=objects([v, None])))
+    writer.close()
+    out = np.load(file_name)
+    assert out["s"].tolist() == sum([[v, u""] for v in values], [])
+    assert [dtype["s"].itemsize // 4 for dtype in rewrites] == [2, 4, 8, 16, 32, 64]
+
+
+def test_integers_widen_to_floats_with_nulls(tmpdir):
+    file_name = str(tmpdir.join("i.npy"))
+    writer = NpyWriter(file_name, capacity=2)
+    writer.append(chunk(i=np.arange(3, dtype=np.int32), x=np.ones(3)))
+    writer.append(chunk(i=np.array([np.nan, 7.]), x=np.zeros(2)))
+    writer.close()
+    out = np.load(file_name)
+    assert out.dtype["i"] == np.float64
+    assert np.isnan(out["i"][3]) and out["i"][[0, 1, 2, 4]].tolist() == [0, 1, 2, 7]
+    assert out["x"].tolist() == [1, 1, 1, 0, 0]
+
+
+def test_array_column_null_in_the_first_chunk(tmpdir):
+    file_name = str(tmpdir.join("a.npy"))
+    hint = np.dtype([("a", np.float64, (0,))])
+    writer = NpyWriter(file_name, hint=hint)
+    writer.append(chunk(a=objects([None, None])))
+    writer.append(chunk(a=objects([np.arange(3.), None])))
+    writer.close()
+    out = np.load(file_name)
+    assert out["a"].shape == (4, 3)
+    assert np.isnan(out["a"][[0, 1, 3]]).all() and out["a"][2].tolist() == [0, 1, 2]
+
+
+def test_widen_keeps_wide_enough_columns():
+    a = np.dtype([("s", "U10"), ("i", np.int64)])
+    assert widen(a, np.dtype([("s", "U4"), ("i", np.int64)])) == a
+    assert widen(a, np.dtype([("s", "U15"), ("i", np.float64)])) == np.dtype([("s", "U20"), ("i", np.float64)])
+    try:
+        widen(a, np.dtype([("t", "U4"), ("i", np.int64)]))
+    except Exception as ex:
+        assert "names changed" in str(ex)
+    else:
+        raise AssertionError("widened different columns")
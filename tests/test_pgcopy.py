@@ -0,0 +1,74 @@
+import struct
+
+import numpy as np
+
+from postmind.io.pgcopy import BinaryCopyReader, SIGNATURE
+
+
+def copy_stream(rows, formats):
+    """
+    Binary COPY stream of rows, each value packed with its struct format
+    (None is NULL).
+    """
+    out = [SIGNATURE, struct.pack("!ii", 0, 0)]
+    for row in rows:
+        out.append(struct.pack("!h", len(row)))
+        for value, fmt in zip(row, formats):
+            if value is None:
+                out.append(struct.pack("!i", -1))
+            elif fmt == "text":
+                data = value.encode("utf-8")
+                out.append(struct.pack("!i", len(data)) + data)
+            else:
+                out.append(struct.pack("!i", struct.calcsize("!" + fmt)) + struct.pack("!" + fmt, value))
+    out.append(struct.pack("!h", -1))
+    return b"".join(out)
+
+
+def decode(data, fields, chunk_bytes=1 << 25, write_size=None):
+    reader = BinaryCopyReader(fields, chunk_bytes=chunk_bytes)
+    write_size = write_size or len(data)
+    for start in range(0, len(data), write_size):
+        reader.write(data[start:start + write_size])
+    reader.close()
+    return reader.columns()
+
+
+def test_fixed_columns_with_scattered_nulls():
+    rng = np.random.RandomState(0)
+    n = 5000
+    values = [i * 0.5 if i == 0 or rng.rand() < 0.5 else None for i in range(n)]
+    columns = decode(copy_stream([(i, v) for i, v in enumerate(values)], ["q", "d"]), [("a", 20), ("b", 701)])
+    assert columns["a"].tolist() == list(range(n))
+    b = columns["b"]
+    assert np.isnan(b[[v is None for v in values]]).all()
+    present = [v is not None for v in values]
+    assert b[present].tolist() == [v for v in values if v is not None]
+
+
+def test_null_runs_between_fixed_runs():
+    values = [1.] * 300 + [None] * 700 + [2.] * 3000 + [None] + [3.] * 10
+    columns = decode(copy_stream([(v,) for v in values], ["d"]), [("b", 701)])
+    b = columns["b"]
+    assert len(b) == len(values)
+    assert np.isnan(b[300:1000]).all() and np.isnan(b[4000])
+    assert (b[:300] == 1).all() and (b[1000:4000] == 2).all() and (b[4001:] == 3).all()
+
+
+def test_rows_split_across_writes():
+    rows = [(i, u"value %d" % i if i % 3 else None) for i in range(1000)]
+    columns = decode(copy_stream(rows, ["i", "text"]), [("a", 23), ("s", 25)], chunk_bytes=256, write_size=97)
+    assert columns["a"].tolist() == list(range(1000))
+    assert columns["s"].tolist() == [s for _, s in rows]
+
+
+def test_truncated_stream_raises():
+    data = copy_stream([(1,), (2,)], ["i"])
+    reader = BinaryCopyReader([("a", 23)])
+    reader.write(data[:-2])
+    try:
+        reader.close()
+    except Exception as ex:
+        assert "Truncated" in str(ex)
+    else:
+        raise AssertionError("truncated stream decoded")
@@ -0,0 +1,80 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from postmind.plan import Relation, Project
+
+
+def make_engine():
+    engine = sa.create_engine("sqlite://")
+    metadata = sa.MetaData()
+    table = sa.Table("t", metadata, sa.Column("id", sa.Integer), sa.Column("x", sa.Integer))
+    metadata.create_all(engine)
+    engine.execute(table.insert(), [{"id": i, "x": i % 3} for i in range(10)])
+    return engine, table
+
+
+def rows(engine, q):
+    return sorted(tuple(row) for row in engine.execute(q))
+
+
+def test_merged_projection_matches_nested_selects():
+    engine, table = make_engine()
+    child = Project(Relation(table), [table.c.id, table.c.x], {"whereclause": table.c.x > 0})
+    inner = child.compile()
+    plan = Project(child, [inner.c.id], {"whereclause": inner.c.id < 7})
+    nested = sa.select([inner.c.id], whereclause=inner.c.id < 7)
+    assert rows(engine, plan.query()) == rows(engine, nested)
+    assert rows(engine, plan.query()) == [(1,), (2,), (4,), (5,)]
+
+
+def test_foreign_column_is_not_merged():
+    engine, table = make_engine()
+    other = table.alias("o")
+    child = Project(Relation(table), [table.c.id.label("cid")], {"whereclause": table.c.x == 0})
+    inner = child.compile()
+    plan = Project(child, [inner.c.cid, other.c.x], {"whereclause": other.c.id == inner.c.cid})
+    nested = sa.select([inner.c.cid, other.c.x], whereclause=other.c.id == inner.c.cid)
+    assert rows(engine, plan.query()) == rows(engine, nested)
+
+
+def sql(q):
+    return " ".join(str(q.compile(dialect=postgresql.dialect())).split())
+
+
+def test_filters_are_merged_in_one_select():
+    engine, table = make_engine()
+    child = Project(Relation(table), [table.c.id, table.c.x], {"whereclause": table.c.x > 0})
+    inner = child.compile()
+    plan = Project(child, [inner.c.id], {"whereclause": inner.c.id < 7})
+    assert sql(plan.query()) == "SELECT t.id FROM t WHERE t.x > %(x_1)s AND t.id < %(id_1)s"
+
+
+def test_ordered_child_is_merged_when_its_columns_are_kept():
+    engine, table = make_engine()
+    child = Project(Relation(table), [table.c.id, table.c.x], {}, order_by=table.c.x.desc())
+    inner = child.compile()
+    plan = Project(child, [inner.c.id, inner.c.x], {"whereclause": inner.c.id < 7})
+    assert sql(plan.query()) == "SELECT t.id, t.x FROM t WHERE t.id < %(id_1)s ORDER BY t.x DESC"
+
+
+def test_aggregate_over_ordered_child_is_not_merged():
+    engine, table = make_engine()
+    child = Project(Relation(table), [table.c.id, table.c.x], {}, order_by=table.c.x.desc())
+    inner = child.compile()
+    plan = Project(child, [sa.func.count(inner.c.id)])
+    q = sql(plan.query())
+    # the ordering stays in the subquery (which SQLAlchemy 1.1 leaves unaliased)
+    assert q.startswith("SELECT count(")
+    assert "FROM (SELECT t.id AS id, t.x AS x FROM t ORDER BY t.x DESC)" in q
+    assert not q.endswith("ORDER BY t.x DESC")
+    assert rows(engine, plan.query()) == [(10,)]
+
+
+def test_distinct_over_ordered_child_is_not_merged():
+    engine, table = make_engine()
+    child = Project(Relation(table), [table.c.id, table.c.x], {}, order_by=table.c.id.desc())
+    inner = child.compile()
+    plan = Project(child, [inner.c.x], {"distinct": True})
+    q = sql(plan.query())
+    assert q.startswith("SELECT DISTINCT ") and "ORDER BY t.id DESC)" in q
+    assert rows(engine, plan.query()) == [(0,), (1,), (2,)]
@@ -0,0 +1,55 @@
+import re
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from postmind import sample
+from postmind.sample import sample_query
+
+metadata = sa.MetaData()
+t = sa.Table("t", metadata, sa.Column("id", sa.Integer), sa.Column("x", sa.Float))
+
+
+def sql(q):
+    return re.sub(r"\s+", " ", str(q.compile(dialect=postgresql.dialect()))).strip()
+
+
+def test_table_fraction_is_a_tablesample():
+    q = sample_query(None, sa.select([t.c.id]).where(t.c.x > 0), fraction=0.1, method="bernoulli", seed=3)
+    s = sql(q)
+    assert "FROM t AS _pm_sample TABLESAMPLE bernoulli(%(bernoulli_1)s) REPEATABLE (3)" in s
+    assert "WHERE _pm_sample.x > %(x_1)s" in s
+    assert "LIMIT" not in s
+
+
+def test_table_rows_are_drawn_at_random_from_the_oversample(monkeypatch):
+    monkeypatch.setattr(sample, "estimate_rows", lambda ctx, query: 100000)
+    s = sql(sample_query(None, sa.select([t.c.id]).order_by(t.c.id), n=10))
+    assert "TABLESAMPLE system" in s
+    assert s.endswith("ORDER BY random() LIMIT %(param_1)s")
+    s = sql(sample_query(None, sa.select([t.c.id]), n=10, seed=5))
+    assert "REPEATABLE (5)" in s
+    assert "ORDER BY (hashtextextended(_pm_sample::text, 5) & 2147483647) LIMIT" in s
+
+
+def test_derived_query_reservoir():
+    q = sa.select([t.c.x, sa.func.count()]).group_by(t.c.x)
+    s = sql(sample_query(None, q, n=5))
+    assert "FROM (SELECT t.x AS x, count(*) AS count_1 FROM t GROUP BY t.x) AS _pm_sample" in s
+    assert s.endswith("ORDER BY random() LIMIT %(param_1)s")
+
+
+def test_derived_query_seeded_fraction():
+    q = sa.select([t.c.x]).distinct()
+    s = sql(sample_query(None, q, fraction=0.5, seed=1))
+    assert s.endswith("WHERE (hashtextextended(_pm_sample::text, 1) & 2147483647) < 1073741824")
+
+
+def test_arguments_are_checked():
+    for kwargs in [{}, {"n": 1, "fraction": 0.1}, {"n": 1, "method": "stratified"}]:
+        try:
+            sample_query(None, sa.select([t.c.id]), **kwargs)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("accepted %r" % kwargs)
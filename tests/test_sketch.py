@@ -0,0 +1,89 @@
+import numpy as np
+
+from postmind.sketch import HyperLogLog, CountMinSketch, KLLSketch, bit_length, element_matrix, hash_values
+
+
+def test_bit_length():
+    values = [0, 1, 2, 3, 255, 256, (1 << 53) + 1, (1 << 64) - 1]
+    assert bit_length(np.array(values, dtype=np.uint64)).tolist() == [int(v).bit_length() for v in values]
+
+
+def test_integers_hash_as_floats():
+    assert (hash_values(np.array([1, 2, 3])) == hash_values(np.array([1., 2., np.nan, 3.]))).all()
+
+
+def test_hll_count():
+    rng = np.random.RandomState(0)
+    for n in (10, 1000, 100000):
+        values = rng.randint(0, 1 << 40, size=n)
+        estimate = HyperLogLog(12).update(values).count()
+        assert abs(estimate - len(np.unique(values))) <= 0.05 * n + 1
+
+
+def test_hll_merge_and_serialize():
+    a = HyperLogLog(10).update(np.arange(5000))
+    b = HyperLogLog(10).update(np.arange(2500, 7500))
+    both = HyperLogLog(10).update(np.arange(7500))
+    assert HyperLogLog.from_bytes(a.to_bytes()).merge(b).count() == both.count()
+    try:
+        a.merge(HyperLogLog(11))
+    except Exception as ex:
+        assert "different p" in str(ex)
+    else:
+        raise AssertionError("merged sketches of different sizes")
+
+
+def test_count_min_top():
+    rng = np.random.RandomState(1)
+    values = np.concatenate([np.repeat(["a", "b", "c"], [5000, 3000, 1000]),
+                             rng.randint(0, 100000, 20000).astype(str)])
+    rng.shuffle(values)
+    sketch = CountMinSketch(width=1 << 12, k=8)
+    for batch in np.array_split(values, 7):
+        sketch.update(batch)
+    top = sketch.top(3)
+    assert [v for v, _ in top] == ["a", "b", "c"]
+    for (v, n), exact in zip(top, [5000, 3000, 1000]):
+        assert exact <= n <= exact + 0.01 * len(values)
+    assert sketch.total == len(values)
+
+
+def test_count_min_merge():
+    a = CountMinSketch(k=4).update(np.array([1, 1, 2, None], dtype=object))
+    b = CountMinSketch(k=4).update(np.array([2, 2, 3], dtype=object))
+    merged = a.merge(b)
+    assert merged.total == 6
+    assert merged.estimate([1, 2, 3]).tolist() == [2, 3, 1]
+    assert merged.top(1) == [(2, 3)]
+
+
+def test_kll_quantiles_within_rank_error():
+    rng = np.random.RandomState(2)
+    values = rng.lognormal(size=200000)
+    sketch = KLLSketch(200)
+    for batch in np.array_split(values, 20):
+        sketch.update(batch)
+    assert sketch.n == len(values)
+    assert sum(len(level) for level in sketch.levels) < 2000
+    q = np.array([0.01, 0.25, 0.5, 0.75, 0.99])
+    ranks = np.searchsorted(np.sort(values), sketch.quantiles(q)) / float(len(values))
+    assert np.abs(ranks - q).max() < 0.02
+
+
+def test_kll_merge_serialize_and_empty():
+    a = KLLSketch(100).update(np.arange(0., 5000.))
+    b = KLLSketch(100).update(np.arange(5000., 10000.))
+    merged = KLLSketch.from_bytes(a.to_bytes()).merge(b)
+    assert merged.n == 10000
+    assert abs(merged.quantiles([0.5])[0] - 5000) < 300
+    assert np.isnan(KLLSketch().update([np.nan]).quantiles([0.5])).all()
+
+
+def test_element_matrix():
+    values = np.empty(3, dtype=object)
+    values[:] = [np.array([1., 2.]), None, [3.]]
+    matrix = element_matrix(values)
+    assert matrix.shape == (3, 2)
+    assert matrix[0].tolist() == [1, 2] and np.isnan(matrix[1]).all() and matrix[2, 0] == 3
+    assert element_matrix(np.array([1., 2.])) is None
+    assert element_matrix(np.ones((2, 2, 2))).shape == (2, 4)